@@ -0,0 +1,42 @@
+import argparse
+import json
+import os
+import tempfile
+
+from benchmark.world import WorldSpec, MUTATIONS
+from benchmark.runner import run_benchmark, dump_result
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmark',
+                                     description='Benchmark GitBackUp against a synthetic world')
+    parser.add_argument('--regions', type=int, default=16, help='region files in the world')
+    parser.add_argument('--chunk-fill', type=float, default=0.6, help='fraction of the chunks present in a region')
+    parser.add_argument('--players', type=int, default=8, help='playerdata files')
+    parser.add_argument('--dimensions', type=int, default=3, choices=(1, 2, 3))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--iterations', type=int, default=10, help='backups to make')
+    parser.add_argument('--pattern', default='hotspot', choices=MUTATIONS, help='mutation between two backups')
+    parser.add_argument('--intensity', type=float, default=1.0, help='scale of each mutation')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=JSON',
+                        help='override a config field, e.g. --set backup_engine=\'"fast_import"\'')
+    parser.add_argument('--workdir', default=None, help='defaults to a temporary directory')
+    parser.add_argument('--keep', action='store_true', help='keep the work directory')
+    parser.add_argument('-o', '--output', default='-', help='result JSON file, "-" for stdout')
+    args = parser.parse_args()
+
+    overrides = {}
+    for item in args.set:
+        key, _, value = item.partition('=')
+        try:
+            overrides[key] = json.loads(value)
+        except ValueError:
+            overrides[key] = value
+    spec = WorldSpec(regions=args.regions, chunk_fill=args.chunk_fill, players=args.players,
+                     dimensions=args.dimensions, seed=args.seed)
+    workdir = args.workdir or os.path.join(tempfile.gettempdir(), 'gbk-benchmark-{}'.format(os.getpid()))
+    result = run_benchmark(workdir, spec, iterations=args.iterations, pattern=args.pattern,
+                           intensity=args.intensity, overrides=overrides, keep=args.keep)
+    dump_result(result, args.output)
+
+if __name__ == '__main__':
+    main()
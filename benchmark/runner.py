@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import platform
+import shutil
+import sys
+import time
+
+from contextlib import redirect_stdout
+from git_backup import common as GL
+from git_backup import region_filter, timing
+from git_backup.backup_index import get_index
+from git_backup.config import Configure
+from git_backup.git import setup_git, count_objects, close_cat_files, run_git_cmd, ls_tree
+from git_backup.maintenance import run_maintenance
+from git_backup.ops import (create_backup, restore_backup, push_backup, list_backup, prune_backup,
+                            backup_status, get_backup_info, stop_push_workers)
+from git_backup.sizes import get_sizes, invalidate_sizes
+from git_backup.sync import walk_files
+from git_backup.utils import run_cmd
+from benchmark.stub import StubServer, StubSource, install, logger
+from benchmark.world import WorldSpec, generate_world, mutate_world
+
+def plugin_version() -> str:
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'mcdreforged.plugin.json')
+    try:
+        with open(path, 'r') as fd:
+            return json.load(fd)['version']
+    except (OSError, ValueError, KeyError):
+        return '?'
+
+def make_config(workdir: str, overrides: dict = None) -> Configure:
+    config = Configure.get_default()
+    config.enabled = True
+    config.backup_path = os.path.join(workdir, 'backup')
+    config.server_path = os.path.join(workdir, 'server')
+    config.back_wait_time = 0
+    config.git_cfg = dict(config.git_cfg, use_remote=True, remote=os.path.join(workdir, 'remote.git'),
+                          is_setup=False)
+    # maintenance is measured as its own step instead of racing the next backup
+    config.maintenance = dict(config.maintenance, enabled=False)
+    for key, value in (overrides or {}).items():
+        if isinstance(getattr(config, key, None), dict) and isinstance(value, dict):
+            value = dict(getattr(config, key), **value)
+        setattr(config, key, value)
+    return config
+
+def _repo_sizes(config) -> dict:
+    invalidate_sizes(worktree=True)
+    worktree, store = get_sizes(config)
+    objects = count_objects(config)
+    return {'worktree': worktree, 'store': store, 'packs': objects.get('packs', 0),
+            'loose': objects.get('count', 0)}
+
+def _measure(server: StubServer, func, *args, **kwargs) -> dict:
+    source = StubSource(server)
+    start = time.perf_counter()
+    func(source, *args, **kwargs)
+    return {'wall': time.perf_counter() - start, 'replies': len(source.replies)}
+
+def _push_and_wait(source: StubSource, config):
+    push_backup(source, config, logger=logger)
+    for worker in GL.push_workers.values():
+        worker.wait_idle()
+
+def verify_world(config, slot: str) -> bool:
+    """
+    Check the server world is exactly the tree of `slot`
+    """
+    target = {rel: oid for rel, (_, oid, _) in ls_tree(config, slot, config.need_backup).items()}
+    paths = {}
+    for basename in config.need_backup:
+        for rel, path, _ in walk_files(config.server_path, basename, config.ignores):
+            paths[rel] = path
+    if set(paths) != set(target):
+        return False
+    for rel, path in paths.items():
+        with open(path, 'rb') as fd:
+            data = fd.read()
+        if config.region_filter and region_filter.is_filtered(rel):
+            data = region_filter.clean(rel, data)
+        if hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest() != target[rel]:
+            return False
+    return True
+
+def _last_record(operation: str):
+    history = timing.get_history(operation)
+    return history[-1] if len(history) > 0 else None
+
+def run_benchmark(workdir: str, spec: WorldSpec, iterations: int = 10, pattern: str = 'hotspot',
+                  intensity: float = 1.0, overrides: dict = None, keep: bool = False) -> dict:
+    """
+    Generate a world in `workdir`, back it up `iterations` times with `pattern` applied in between,
+    then list, check the status, restore, push and prune once. Return the results as a JSON-able dict
+    """
+    if os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    os.makedirs(workdir)
+    server = StubServer()
+    install(server)
+    GL.plugin_unloaded = False
+
+    config = make_config(workdir, overrides)
+    GL.config = config
+    ecode, out = run_cmd([config.git_path, 'init', '-q', '--bare', config.git_cfg['remote']])
+    if ecode != 0:
+        raise RuntimeError('Can not create the remote: {}'.format(out))
+
+    start = time.perf_counter()
+    world = generate_world(config.server_path, spec)
+    world['generate'] = time.perf_counter() - start
+    # the first push prints to stdout, which may be where the result goes
+    with redirect_stdout(sys.stderr):
+        setup_git(config, logger=logger)
+    timing.load_history(config)
+
+    result = {
+        'version': plugin_version(),
+        'git': run_cmd([config.git_path, '--version'])[1].strip(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'spec': spec.to_dict(),
+        'pattern': pattern,
+        'intensity': intensity,
+        'config': {key: getattr(config, key) for key in ('backup_engine', 'incremental_copy', 'sync_manifest',
+                                                         'region_patch', 'region_filter', 'copy_threads',
+                                                         'differential_restore')},
+        'world': world,
+        'iterations': [],
+    }
+    try:
+        for i in range(iterations):
+            mutation = mutate_world(config.server_path, spec, pattern, i, intensity) if i > 0 else None
+            before = _repo_sizes(config)
+            create = _measure(server, create_backup, 'bench {}'.format(i), config, logger=logger)
+            create['record'] = _last_record('create')
+            maintenance = time.perf_counter()
+            run_maintenance(config, logger=logger)
+            after = _repo_sizes(config)
+            result['iterations'].append({
+                'iteration': i,
+                'mutation': None if mutation is None else mutation.to_dict(),
+                'create': create,
+                'maintenance': time.perf_counter() - maintenance,
+                'repository': after,
+                'growth': after['store'] - before['store'],
+            })
+
+        result['list'] = _measure(server, list_backup, config)
+        result['status'] = _measure(server, backup_status, config, logger=logger)
+
+        slot = get_backup_info(config, max(1, min(len(get_index(config)), iterations // 2 + 1)))
+        mutate_world(config.server_path, spec, pattern, iterations, intensity)
+        result['restore'] = _measure(server, restore_backup, slot, config, logger=logger)
+        result['restore']['record'] = _last_record('restore')
+        result['restore']['verified'] = verify_world(config, slot[0])
+
+        result['push'] = _measure(server, _push_and_wait, config)
+        result['push']['record'] = _last_record('push')
+        result['prune'] = _measure(server, prune_backup, config, logger=logger)
+        result['prune']['record'] = _last_record('prune')
+        result['repository'] = _repo_sizes(config)
+        result['summary'] = timing.summarize()
+    finally:
+        stop_push_workers()
+        close_cat_files()
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+def dump_result(result: dict, path: str = None):
+    text = json.dumps(result, indent=2, default=str)
+    if path is None or path == '-':
+        sys.stdout.write(text + '\n')
+    else:
+        with open(path, 'w') as fd:
+            fd.write(text + '\n')
@@ -0,0 +1,78 @@
+import logging
+import mcdreforged.api.all as MCDR
+
+logger = logging.getLogger('gbk-benchmark')
+
+class StubServer:
+    """
+    The part of `ServerInterface` the plugin operations use, without a Minecraft server behind it.
+    `save-all` is acknowledged at once, like `on_info` seeing "Saved the game"
+    """
+    def __init__(self):
+        self.logger = logger
+        self.commands = []
+        self.events = []
+        self.running = True
+
+    def rtr(self, key: str, *args, **kwargs):
+        return MCDR.RText('{} {}'.format(key, ' '.join(map(str, args))).strip())
+
+    def tr(self, key: str, *args, **kwargs):
+        return self.rtr(key, *args, **kwargs)
+
+    def execute(self, command: str):
+        self.commands.append(command)
+        if command.startswith('save-all'):
+            from git_backup import common as GL
+            GL.game_saved.set()
+
+    def say(self, text):
+        pass
+
+    def dispatch_event(self, event, args, *, on_executor_thread: bool = True):
+        self.events.append(event)
+
+    def stop(self):
+        self.running = False
+
+    def wait_for_start(self):
+        pass
+
+    def start(self):
+        self.running = True
+        return True
+
+    def is_server_running(self):
+        return self.running
+
+class StubSource:
+    """
+    A console command source collecting the replies
+    """
+    is_player = False
+    is_console = True
+
+    def __init__(self, server: StubServer):
+        self.server = server
+        self.replies = []
+
+    def get_server(self):
+        return self.server
+
+    def reply(self, message, **kwargs):
+        self.replies.append(str(message))
+
+    def has_permission(self, level: int) -> bool:
+        return True
+
+    def __str__(self):
+        return 'Benchmark'
+
+def install(server: StubServer):
+    """
+    Make `ServerInterface.get_instance()` return `server` in this process, so `tr()` works without MCDR running.
+    It has to happen before `git_backup` is first imported, the operations call `tr()` while being defined
+    """
+    MCDR.ServerInterface.get_instance = staticmethod(lambda: server)
+    from git_backup import common as GL
+    GL.server_inst = server
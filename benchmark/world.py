@@ -0,0 +1,198 @@
+import gzip
+import os
+import random
+import struct
+import time
+import uuid
+import zlib
+
+from git_backup.region import SECTOR_SIZE, CHUNK_COUNT, HEADER_SIZE, parse_header
+
+MUTATIONS = ('none', 'hotspot', 'scatter', 'explore', 'churn')
+
+# uncompressed size range and random fraction of a generated chunk, a real 1.18+ chunk is 4-20 KiB compressed
+CHUNK_RAW_SIZE = (24 * 1024, 64 * 1024)
+CHUNK_ENTROPY = 0.25
+
+class WorldSpec:
+    """
+    Shape of a synthetic world, everything is derived from `seed`
+    """
+    def __init__(self, regions: int = 16, chunk_fill: float = 0.6, players: int = 8,
+                 dimensions: int = 3, seed: int = 0):
+        self.regions = regions
+        self.chunk_fill = chunk_fill
+        self.players = players
+        self.dimensions = dimensions
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+class MutationStats:
+    def __init__(self):
+        self.files = 0
+        self.chunks = 0
+        self.bytes = 0
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+def _dimension_dirs(world: str, dimensions: int) -> list:
+    dirs = [world, os.path.join(world, 'DIM-1'), os.path.join(world, 'DIM1')]
+    return dirs[:max(1, min(dimensions, len(dirs)))]
+
+def _chunk_payload(rnd: random.Random) -> bytes:
+    """
+    An NBT-like payload: a long compressible palette run with random block state noise
+    """
+    size = rnd.randint(*CHUNK_RAW_SIZE)
+    noise = rnd.getrandbits(int(size * CHUNK_ENTROPY) * 8).to_bytes(int(size * CHUNK_ENTROPY), 'little')
+    palette = bytes(rnd.randrange(16) for _ in range(64))
+    body = (palette * (size // len(palette) + 1))[:size - len(noise)]
+    return b'\x0a\x00\x00' + body + noise + b'\x00'
+
+def _encode_chunk(rnd: random.Random) -> bytes:
+    data = zlib.compress(_chunk_payload(rnd), 6)
+    # length counts the compression type byte
+    return struct.pack('>IB', len(data) + 1, 2) + data
+
+def write_region(path: str, rnd: random.Random, fill: float, now: int = None):
+    now = int(time.time()) if now is None else now
+    locations = bytearray(SECTOR_SIZE)
+    timestamps = bytearray(SECTOR_SIZE)
+    body = bytearray()
+    sector = HEADER_SIZE // SECTOR_SIZE
+    for i in range(CHUNK_COUNT):
+        if rnd.random() >= fill:
+            continue
+        chunk = _encode_chunk(rnd)
+        count = (len(chunk) + SECTOR_SIZE - 1) // SECTOR_SIZE
+        chunk += b'\x00' * (count * SECTOR_SIZE - len(chunk))
+        struct.pack_into('>I', locations, i * 4, (sector << 8) | count)
+        struct.pack_into('>I', timestamps, i * 4, now - rnd.randrange(86400))
+        body += chunk
+        sector += count
+    with open(path, 'wb') as fd:
+        fd.write(locations)
+        fd.write(timestamps)
+        fd.write(body)
+    return HEADER_SIZE + len(body)
+
+def rewrite_chunks(path: str, rnd: random.Random, count: int, now: int = None) -> int:
+    """
+    Regenerate `count` random chunks the way the game saves them: in place if the new data fits
+    in the old sectors, otherwise appended at the end of the file. Return the bytes written
+    """
+    now = int(time.time()) if now is None else now
+    with open(path, 'r+b') as fd:
+        header = bytearray(fd.read(HEADER_SIZE))
+        locations, _ = parse_header(bytes(header))
+        fd.seek(0, os.SEEK_END)
+        end_sector = (fd.tell() + SECTOR_SIZE - 1) // SECTOR_SIZE
+        written = 0
+        for i in rnd.sample(range(CHUNK_COUNT), min(count, CHUNK_COUNT)):
+            chunk = _encode_chunk(rnd)
+            sectors = (len(chunk) + SECTOR_SIZE - 1) // SECTOR_SIZE
+            chunk += b'\x00' * (sectors * SECTOR_SIZE - len(chunk))
+            offset, old_sectors = locations[i]
+            if offset == 0 or sectors > old_sectors:
+                offset = end_sector
+                end_sector += sectors
+            fd.seek(offset * SECTOR_SIZE)
+            fd.write(chunk)
+            struct.pack_into('>I', header, i * 4, (offset << 8) | sectors)
+            struct.pack_into('>I', header, SECTOR_SIZE + i * 4, now)
+            written += len(chunk)
+        fd.seek(0)
+        fd.write(header)
+    return written + HEADER_SIZE
+
+def _write_nbt_file(path: str, rnd: random.Random, size: int) -> int:
+    data = gzip.compress(b'\x0a\x00\x00' + bytes(rnd.randrange(8) for _ in range(size)) + b'\x00', 6)
+    with open(path, 'wb') as fd:
+        fd.write(data)
+    return len(data)
+
+def _region_paths(world: str, spec: WorldSpec) -> list:
+    paths = []
+    dims = _dimension_dirs(world, spec.dimensions)
+    side = max(1, int(spec.regions ** 0.5))
+    for i in range(spec.regions):
+        # the overworld gets most of the regions, like a real world
+        dim = dims[0] if i % 4 != 3 or len(dims) == 1 else dims[1 + i // 4 % (len(dims) - 1)]
+        x, z = i % side - side // 2, i // side - side // 2
+        paths.append(os.path.join(dim, 'region', 'r.{}.{}.mca'.format(x, z)))
+    return paths
+
+def generate_world(root: str, spec: WorldSpec, name: str = 'world') -> dict:
+    """
+    Create `root/name` and return `{'files': n, 'bytes': n}` of the generated world
+    """
+    rnd = random.Random(spec.seed)
+    world = os.path.join(root, name)
+    for dim in _dimension_dirs(world, spec.dimensions):
+        os.makedirs(os.path.join(dim, 'region'), exist_ok=True)
+    os.makedirs(os.path.join(world, 'playerdata'), exist_ok=True)
+    files = size = 0
+    for path in _region_paths(world, spec):
+        size += write_region(path, rnd, spec.chunk_fill)
+        files += 1
+    for _ in range(spec.players):
+        pid = uuid.UUID(int=rnd.getrandbits(128), version=4)
+        size += _write_nbt_file(os.path.join(world, 'playerdata', '{}.dat'.format(pid)), rnd, 4096)
+        files += 1
+    size += _write_nbt_file(os.path.join(world, 'level.dat'), rnd, 2048)
+    with open(os.path.join(world, 'session.lock'), 'wb') as fd:
+        fd.write(b'\xe2\x98\x83')
+    return {'files': files + 1, 'bytes': size}
+
+def mutate_world(root: str, spec: WorldSpec, pattern: str, iteration: int,
+                 intensity: float = 1.0, name: str = 'world') -> MutationStats:
+    """
+    Apply one round of `pattern` between two backups:
+
+    - `none`: nothing is saved
+    - `hotspot`: players stay in a few regions, their chunks are saved again
+    - `scatter`: a few chunks of every region change
+    - `explore`: new regions are generated next to the existing ones
+    - `churn`: whole regions are regenerated, chunks move around in the file
+    """
+    if pattern not in MUTATIONS:
+        raise ValueError('Unknown mutation pattern "{}"'.format(pattern))
+    rnd = random.Random('{}-{}-{}'.format(spec.seed, pattern, iteration))
+    world = os.path.join(root, name)
+    stats = MutationStats()
+    if pattern == 'none':
+        return stats
+    now = int(time.time())
+    regions = [p for p in _region_paths(world, spec) if os.path.isfile(p)]
+    if pattern == 'hotspot':
+        for path in rnd.sample(regions, max(1, int(len(regions) * 0.1 * intensity))):
+            stats.bytes += rewrite_chunks(path, rnd, int(64 * intensity), now)
+            stats.chunks += int(64 * intensity)
+            stats.files += 1
+    elif pattern == 'scatter':
+        for path in regions:
+            stats.bytes += rewrite_chunks(path, rnd, max(1, int(4 * intensity)), now)
+            stats.chunks += max(1, int(4 * intensity))
+            stats.files += 1
+    elif pattern == 'explore':
+        dim = os.path.join(world, 'region')
+        for i in range(max(1, int(2 * intensity))):
+            path = os.path.join(dim, 'r.{}.{}.mca'.format(1000 + iteration, i))
+            stats.bytes += write_region(path, rnd, spec.chunk_fill, now)
+            stats.chunks += int(CHUNK_COUNT * spec.chunk_fill)
+            stats.files += 1
+    elif pattern == 'churn':
+        for path in rnd.sample(regions, max(1, int(len(regions) * 0.25 * intensity))):
+            stats.bytes += write_region(path, rnd, spec.chunk_fill, now)
+            stats.chunks += int(CHUNK_COUNT * spec.chunk_fill)
+            stats.files += 1
+    # the game always saves these
+    for pid in sorted(os.listdir(os.path.join(world, 'playerdata'))):
+        stats.bytes += _write_nbt_file(os.path.join(world, 'playerdata', pid), rnd, 4096)
+        stats.files += 1
+    stats.bytes += _write_nbt_file(os.path.join(world, 'level.dat'), rnd, 2048)
+    stats.files += 1
+    return stats
@@ -3,14 +3,19 @@ import re
 import time
 
 from typing import Optional
-from git_backup import common as GL
+from git_backup import common as GL, governor
 from git_backup.constants import (Prefix, CONFIG_FILE, PLUGIN_ABBR,
                                   TRIGGER_BACKUP_EVENT, TRIGGER_RESTORE_EVENT)
 from git_backup.config import Configure
-from git_backup.ops import (create_backup, restore_backup, push_backup, list_backup,
-                            prune_backup, backup_status, command_run, get_backup_info)
-from git_backup.git import setup_git
+from git_backup.ops import (create_backup, restore_backup, push_backup, list_backup, list_pre_restore,
+                            prune_backup, backup_status, timing_stats, measure_filter, command_run, get_backup_info,
+                            rollover_shard, consolidate_store, check_backup_needed, get_push_worker, stop_push_workers,
+                            find_region, backfill_index, export_backup)
+from git_backup.git import setup_git, close_cat_files
+from git_backup.restore import parse_restore_spec
 from git_backup.backup_timer import flush_backup_timer, cancel_backup_timer
+from git_backup.push_worker import get_remotes, get_last_push_time
+from git_backup.timing import load_history
 from git_backup.utils import debug_message, tr, print_message
 
 HelpMessage: MCDR.RTextBase
@@ -32,6 +37,7 @@ def on_load(server: MCDR.PluginServerInterface, old):
         init_time = not GL.config.git_cfg['is_setup']
         setup_git(GL.config, logger=server.logger)
         save_config(server)
+        load_history(GL.config)
 
         register_command(server)
         register_event_listeners(server)
@@ -39,6 +45,11 @@ def on_load(server: MCDR.PluginServerInterface, old):
 
         if init_time:
             GL.config.last_backup_time = GL.config.last_push_time = time.time()
+        if len(GL.config.remotes) > 0:
+            # a remote added to the list gets the whole history in the background
+            for remote in get_remotes(GL.config):
+                if get_last_push_time(GL.config, remote) <= 0:
+                    get_push_worker(GL.config, remote, logger=server.logger).request()
         GL.backup_timer = flush_backup_timer(GL.backup_timer, _timed_make_backup,
                                              server.get_plugin_command_source(), GL.config)
     else:
@@ -52,13 +63,29 @@ def on_load(server: MCDR.PluginServerInterface, old):
 def on_unload(server):
     GL.abort_restore = True
     GL.plugin_unloaded = True
+    # wake up a backup waiting for the save
+    GL.game_saved.set()
     cancel_backup_timer(GL.backup_timer)
+    stop_push_workers()
+    close_cat_files()
     save_config(server)
 
+def on_player_joined(server: MCDR.PluginServerInterface, player: str, info: MCDR.Info):
+    GL.online_players.add(player)
+    GL.players_active = True
+
+def on_player_left(server: MCDR.PluginServerInterface, player: str):
+    GL.online_players.discard(player)
+
+def on_server_stop(server: MCDR.PluginServerInterface, return_code: int):
+    GL.online_players.clear()
+
 def on_info(server: MCDR.PluginServerInterface, info: MCDR.Info):
     if not info.is_user:
         if info.content in GL.config.saved_world_keywords:
-            GL.game_saved = True
+            GL.game_saved.set()
+        elif any(keyword in info.content for keyword in GL.config.throttle['lag_keywords']):
+            governor.report_lag()
 
 ######## Commands ########
 
@@ -72,6 +99,11 @@ def register_command(server: MCDR.PluginServerInterface):
         runs(cmd_help_message).
         on_error(MCDR.UnknownArgument, print_unknown_argument_message, handled=True).
         then(get_literal_node('status').runs(lambda src: cmd_backup_status(src))).
+        then(
+            get_literal_node('stats').
+            runs(lambda src: cmd_timing_stats(src)).
+            then(MCDR.Text('operation').runs(lambda src, ctx: cmd_timing_stats(src, ctx['operation'])))
+        ).
         then(
             get_literal_node('make').
             runs(lambda src: cmd_create_backup(src, None)).
@@ -80,17 +112,73 @@ def register_command(server: MCDR.PluginServerInterface):
         then(
             get_literal_node('back').
             runs(lambda src: cmd_restore_backup(src, ':1')).
-            then(MCDR.Text('slot').runs(lambda src, ctx: cmd_restore_backup(src, ctx['slot'])))
+            then(
+                MCDR.Text('slot').
+                runs(lambda src, ctx: cmd_restore_backup(src, ctx['slot'])).
+                then(MCDR.GreedyText('spec').runs(lambda src, ctx: cmd_restore_backup(src, ctx['slot'], ctx['spec'])))
+            )
         ).
         then(get_literal_node('confirm').runs(cmd_confirm_restore)).
         then(get_literal_node('abort').runs(cmd_trigger_abort)).
         then(
             get_literal_node('list').
             runs(lambda src: cmd_list_backup(src)).
-            then(MCDR.Text('limit').runs(lambda src, ctx: cmd_list_backup(src, ctx['limit'])))
+            then(MCDR.Integer('page').runs(lambda src, ctx: cmd_list_backup(src, ctx['page']))).
+            then(MCDR.Literal('pre').runs(lambda src: cmd_list_pre_restore(src))).
+            then(
+                MCDR.Literal('find').then(
+                    MCDR.Text('keyword').
+                    runs(lambda src, ctx: cmd_list_backup(src, keyword=ctx['keyword'])).
+                    then(MCDR.Integer('page').runs(lambda src, ctx: cmd_list_backup(src, ctx['page'], keyword=ctx['keyword'])))
+                )
+            ).
+            then(
+                MCDR.Literal('date').then(
+                    MCDR.Text('since').
+                    runs(lambda src, ctx: cmd_list_backup(src, since=ctx['since'])).
+                    then(
+                        MCDR.Text('until').
+                        runs(lambda src, ctx: cmd_list_backup(src, since=ctx['since'], until=ctx['until'])).
+                        then(MCDR.Integer('page').runs(lambda src, ctx: cmd_list_backup(src, ctx['page'], since=ctx['since'], until=ctx['until'])))
+                    )
+                )
+            )
+        ).
+        then(
+            get_literal_node('find').
+            then(MCDR.Literal('backfill').runs(lambda src: cmd_backfill_index(src))).
+            then(
+                MCDR.Integer('x').then(
+                    MCDR.Integer('z').
+                    runs(lambda src, ctx: cmd_find_region(src, ctx['x'], ctx['z'])).
+                    then(MCDR.Text('dimension').runs(lambda src, ctx: cmd_find_region(src, ctx['x'], ctx['z'], ctx['dimension'])))
+                )
+            )
+        ).
+        then(
+            get_literal_node('push').
+            runs(lambda src: cmd_push_backup(src)).
+            then(MCDR.Text('remote').runs(lambda src, ctx: cmd_push_backup(src, ctx['remote'])))
+        ).
+        then(
+            get_literal_node('prune').
+            runs(lambda src: cmd_prune_backup(src)).
+            then(MCDR.Literal('dry').runs(lambda src: cmd_prune_backup(src, dry_run=True)))
+        ).
+        then(get_literal_node('rollover').runs(lambda src: cmd_rollover_shard(src))).
+        then(get_literal_node('consolidate').runs(lambda src: cmd_consolidate_store(src))).
+        then(
+            get_literal_node('export').then(
+                MCDR.Text('slot').
+                runs(lambda src, ctx: cmd_export_backup(src, ctx['slot'])).
+                then(MCDR.Text('format').runs(lambda src, ctx: cmd_export_backup(src, ctx['slot'], ctx['format'])))
+            )
         ).
-        then(get_literal_node('push').runs(lambda src: cmd_push_backup(src))).
-        then(get_literal_node('prune').runs(lambda src: cmd_prune_backup(src)))
+        then(
+            get_literal_node('measure').
+            runs(lambda src: cmd_measure_filter(src)).
+            then(MCDR.Integer('count').runs(lambda src, ctx: cmd_measure_filter(src, ctx['count'])))
+        )
     )
 
 def cmd_help_message(source: MCDR.CommandSource):
@@ -120,17 +208,17 @@ def cmd_help_message(source: MCDR.CommandSource):
         )
 
 @MCDR.new_thread(f'{PLUGIN_ABBR} - create')
-def cmd_create_backup(source: MCDR.CommandSource, comment: Optional[str]):
+def cmd_create_backup(source: MCDR.CommandSource, comment: Optional[str], group: dict = None):
     cancel_backup_timer(GL.backup_timer)
 
-    create_backup(source, comment, GL.config, logger=GL.server_inst.logger)
-    if GL.config.push_interval > 0 and GL.config.last_push_time + GL.config.push_interval < time.time():
-        print_message(source, f'There are out {GL.config.push_interval} sec not push, pushing now...', tell=False)
-        push_backup(source, GL.config, logger=GL.server_inst.logger)
+    create_backup(source, comment, GL.config, logger=GL.server_inst.logger, group=group)
+    rollover_shard(source, GL.config, logger=GL.server_inst.logger)
+    if group is None or group.get('push', True):
+        push_backup(source, GL.config, due_only=True, logger=GL.server_inst.logger)
 
     GL.backup_timer = flush_backup_timer(GL.backup_timer, _timed_make_backup, source, GL.config)
 
-def cmd_restore_backup(source: MCDR.CommandSource, bid: str or int):
+def cmd_restore_backup(source: MCDR.CommandSource, bid: str or int, spec: str = None):
     try:
         slot, date, comment = get_backup_info(
             GL.config, int(bid[1:]) if isinstance(bid, str) and bid[0] == ':' else bid)
@@ -140,13 +228,26 @@ def cmd_restore_backup(source: MCDR.CommandSource, bid: str or int):
         GL.slot_selected = None
         GL.date_selected = None
         GL.comment_selected = None
+        GL.spec_selected = None
         return
+    if spec is not None:
+        try:
+            parse_restore_spec(GL.config, slot, spec)
+        except ValueError as e:
+            print_message(source, tr('restore_backup.bad_spec', spec, e), tell=False)
+            GL.slot_selected = None
+            GL.spec_selected = None
+            return
 
     GL.slot_selected = slot
     GL.date_selected = date
     GL.comment_selected = comment
+    GL.spec_selected = spec
     GL.abort_restore = False
-    print_message(source, tr('restore_backup.echo_action', slot, date, comment), tell=False)
+    if spec is None:
+        print_message(source, tr('restore_backup.echo_action', slot, date, comment), tell=False)
+    else:
+        print_message(source, tr('restore_backup.echo_partial', spec, slot, date, comment), tell=False)
     print_message(
         source,
         command_run(tr('restore_backup.confirm_hint', Prefix), tr('restore_backup.confirm_hover'), '{0} confirm'.format(Prefix))
@@ -162,40 +263,87 @@ def cmd_confirm_restore(source: MCDR.CommandSource):
         slot = GL.slot_selected
         date = GL.date_selected
         comment = GL.comment_selected
+        spec = GL.spec_selected
         GL.slot_selected = None
         GL.date_selected = None
         GL.comment_selected = None
+        GL.spec_selected = None
 
-        restore_backup(source, (slot, date, comment), GL.config, logger=GL.server_inst.logger)
+        restore_backup(source, (slot, date, comment), GL.config, logger=GL.server_inst.logger, spec=spec)
 
 def cmd_trigger_abort(source: MCDR.CommandSource):
     GL.abort_restore = True
     GL.slot_selected = None
     GL.date_selected = None
     GL.comment_selected = None
+    GL.spec_selected = None
     print_message(source, tr('trigger_abort.abort'), tell=False)
 
 @MCDR.new_thread(f'{PLUGIN_ABBR} - list')
-def cmd_list_backup(source: MCDR.CommandSource, limit: int = None):
-    list_backup(source, GL.config, limit=limit)
+def cmd_list_backup(source: MCDR.CommandSource, page: int = 1, keyword: str = None,
+                    since: str = None, until: str = None):
+    list_backup(source, GL.config, page=page, keyword=keyword, since=since, until=until)
+
+@MCDR.new_thread(f'{PLUGIN_ABBR} - list')
+def cmd_list_pre_restore(source: MCDR.CommandSource):
+    list_pre_restore(source, GL.config)
+
+@MCDR.new_thread(f'{PLUGIN_ABBR} - find')
+def cmd_find_region(source: MCDR.CommandSource, x: int, z: int, dimension: str = None):
+    find_region(source, GL.config, x, z, dimension)
+
+@MCDR.new_thread(f'{PLUGIN_ABBR} - backfill')
+def cmd_backfill_index(source: MCDR.CommandSource):
+    backfill_index(source, GL.config, logger=GL.server_inst.logger)
 
 @MCDR.new_thread(f'{PLUGIN_ABBR} - push')
-def cmd_push_backup(source: MCDR.CommandSource):
-    push_backup(source, GL.config, logger=GL.server_inst.logger)
+def cmd_push_backup(source: MCDR.CommandSource, remote: str = None):
+    push_backup(source, GL.config, name=remote, logger=GL.server_inst.logger)
 
 @MCDR.new_thread(f'{PLUGIN_ABBR} - prune')
-def cmd_prune_backup(source: MCDR.CommandSource):
-    prune_backup(source, GL.config, logger=GL.server_inst.logger)
+def cmd_prune_backup(source: MCDR.CommandSource, dry_run: bool = False):
+    prune_backup(source, GL.config, dry_run=dry_run, logger=GL.server_inst.logger)
+
+@MCDR.new_thread(f'{PLUGIN_ABBR} - export')
+def cmd_export_backup(source: MCDR.CommandSource, bid: str, fmt: str = None):
+    export_backup(source, GL.config, bid, fmt, logger=GL.server_inst.logger)
+
+@MCDR.new_thread(f'{PLUGIN_ABBR} - measure')
+def cmd_measure_filter(source: MCDR.CommandSource, count: int = 10):
+    measure_filter(source, GL.config, count, logger=GL.server_inst.logger)
 
 @MCDR.new_thread(f'{PLUGIN_ABBR} - status')
 def cmd_backup_status(source: MCDR.CommandSource):
     backup_status(source, GL.config, logger=GL.server_inst.logger)
 
+@MCDR.new_thread(f'{PLUGIN_ABBR} - rollover')
+def cmd_rollover_shard(source: MCDR.CommandSource):
+    rollover_shard(source, GL.config, force=True, logger=GL.server_inst.logger)
+
+@MCDR.new_thread(f'{PLUGIN_ABBR} - consolidate')
+def cmd_consolidate_store(source: MCDR.CommandSource):
+    consolidate_store(source, GL.config, logger=GL.server_inst.logger)
+
+@MCDR.new_thread(f'{PLUGIN_ABBR} - stats')
+def cmd_timing_stats(source: MCDR.CommandSource, operation: str = None):
+    timing_stats(source, GL.config, operation)
+
 ######## Utils ########
 
-def _timed_make_backup():
+def _timed_make_backup(group: dict = None):
     source = GL.server_inst.get_plugin_command_source()
-    cmd_create_backup(source, comment=None)
+    reason = check_backup_needed(GL.config, None if group is None else group['paths'])
+    if reason is not None:
+        # the world as of now is what the last backup holds, the next check is an interval away
+        if group is None:
+            print_message(source, tr('create_backup.skip.skipped', reason), tell=False)
+            GL.config.last_backup_time = time.time()
+        else:
+            print_message(source, tr('create_backup.skip.group_skipped', group['name'], reason), tell=False)
+            group['last_backup_time'] = time.time()
+        GL.backup_timer = flush_backup_timer(GL.backup_timer, _timed_make_backup, source, GL.config)
+        return
+    cmd_create_backup(source, comment=None, group=group)
 
 def print_unknown_argument_message(source: MCDR.CommandSource, error: MCDR.UnknownArgument):
     print_message(source, command_run(
@@ -211,6 +359,7 @@ def register_event_listeners(server: MCDR.PluginServerInterface):
 def load_config(server: MCDR.ServerInterface, source: MCDR.CommandSource or None = None):
     GL.config = server.load_config_simple(CONFIG_FILE, target_class=Configure,
                                           in_data_folder=False, source_to_reply=source)
+    governor.configure(GL.config)
 
 def save_config(server: MCDR.ServerInterface):
     server.save_config_simple(GL.config, CONFIG_FILE, in_data_folder=False)
\ No newline at end of file
@@ -0,0 +1,256 @@
+import os
+import json
+
+from threading import Lock
+from typing import List, Optional
+from git_backup.constants import SHARD_REF
+from git_backup.git import run_git_cmd, resolve_ref, read_commit
+from git_backup.utils import get_metadata_path, debug_message
+
+INDEX_FILE = 'index.json'
+SHARD_DIR = 'shards'
+
+class BackupIndex:
+    """
+    The backups on the backup branch, oldest first, with the data git does not keep cheaply
+    (changed bytes, repository size delta). `head` is the branch tip the index was built for.
+    The backups of the sealed shards come before them in `sealed`, they are listed and looked up
+    as one sequence but never change
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.head = None
+        self.entries: List[dict] = []
+        self.sealed: List[dict] = []
+        self.positions = {}
+
+    def load(self):
+        self.head = None
+        self.entries = []
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'r') as fd:
+                    data = json.load(fd)
+                self.head = data['head']
+                self.entries = data['entries']
+            except (ValueError, KeyError, TypeError):
+                self.head = None
+                self.entries = []
+        self._reindex()
+        return self
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fd:
+            json.dump({'head': self.head, 'entries': self.entries}, fd, separators=(',', ':'))
+        os.replace(tmp, self.path)
+
+    def _reindex(self):
+        self.positions = {ent['hash']: i for i, ent in enumerate(self.sealed + self.entries)}
+
+    def _get(self, pos: int) -> dict:
+        n = len(self.sealed)
+        return self.sealed[pos] if pos < n else self.entries[pos - n]
+
+    def __len__(self):
+        return len(self.sealed) + len(self.entries)
+
+    def by_index(self, idx: int) -> Optional[dict]:
+        """
+        `idx` 1 is the latest backup
+        """
+        if 1 <= idx <= len(self):
+            return self._get(len(self) - idx)
+        return None
+
+    def index_of(self, ent: dict) -> int:
+        return len(self) - self.positions[ent['hash']]
+
+    def by_hash(self, bid: str) -> Optional[dict]:
+        pos = self.positions.get(bid)
+        if pos is not None:
+            return self._get(pos)
+        if len(bid) < 4:
+            return None
+        found = [ent for ent in self.sealed + self.entries if ent['hash'].startswith(bid)]
+        return found[0] if len(found) == 1 else None
+
+    def is_sealed(self, oid: str) -> bool:
+        pos = self.positions.get(oid)
+        return pos is not None and pos < len(self.sealed)
+
+    def append(self, ent: dict):
+        self.positions[ent['hash']] = len(self)
+        self.entries.append(ent)
+        self.head = ent['hash']
+
+    def truncate(self, oid: str) -> bool:
+        pos = self.positions.get(oid)
+        if pos is None or pos < len(self.sealed):
+            return False
+        del self.entries[pos - len(self.sealed) + 1:]
+        self._reindex()
+        self.head = oid
+        return True
+
+    def query(self, keyword: str = None, since: float = None, until: float = None) -> List[dict]:
+        """
+        Return the matched backups, latest first
+        """
+        res = []
+        for ent in reversed(self.sealed + self.entries):
+            if since is not None and ent['time'] < since:
+                continue
+            if until is not None and ent['time'] > until:
+                continue
+            if keyword is not None and keyword.lower() not in ent['comment'].lower():
+                continue
+            res.append(ent)
+        return res
+
+_index: Optional[BackupIndex] = None
+_index_lock = Lock()
+
+def parse_subject(subject: str):
+    """
+    Split a backup commit subject `<date>[=<comment>]` into `(date, comment)`
+    """
+    a = subject.split('=', 1)
+    return (a[0], a[1]) if len(a) == 2 else (a[0], '')
+
+def make_entry(oid: str, time_: int, subject: str, changed_bytes=None, size_delta=None) -> dict:
+    date, comment = parse_subject(subject)
+    return {
+        'hash': oid,
+        'time': time_,
+        'date': date,
+        'comment': comment,
+        'changed_bytes': changed_bytes,
+        'size_delta': size_delta,
+    }
+
+def _log_entries(config, rev: str) -> List[dict]:
+    ecode, out = run_git_cmd(config, 'log', '--first-parent', '--format=%H %ct %s', rev, '--')
+    entries = []
+    if ecode == 0:
+        for line in reversed(out.splitlines()):
+            oid, ct, subject = (line.split(' ', 2) + [''])[:3]
+            entries.append(make_entry(oid, int(ct), subject))
+    return entries
+
+def rebuild_index(config, index: BackupIndex):
+    index.entries = _log_entries(config, 'HEAD')
+    index.head = index.entries[-1]['hash'] if len(index.entries) > 0 else None
+    index._reindex()
+    index.save()
+    debug_message(config.debug, 'backup index rebuilt,', len(index.entries), 'entries')
+
+def save_shard_entries(config, name: str, entries: List[dict]):
+    path = get_metadata_path(config, SHARD_DIR)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    tmp = os.path.join(path, name + '.json.tmp')
+    with open(tmp, 'w') as fd:
+        json.dump([dict(ent, shard=name) for ent in entries], fd, separators=(',', ':'))
+    os.replace(tmp, os.path.join(path, name + '.json'))
+
+def load_sealed(config) -> List[dict]:
+    """
+    The backups of every sealed shard, oldest first. A shard without its saved entries,
+    e.g. in a clone, is read from git once
+    """
+    ecode, out = run_git_cmd(config, 'for-each-ref', '--sort=refname', '--format=%(refname)', SHARD_REF + '/')
+    res = []
+    for ref in out.splitlines() if ecode == 0 else []:
+        name = ref[len(SHARD_REF) + 1:]
+        path = get_metadata_path(config, SHARD_DIR, name + '.json')
+        entries = None
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r') as fd:
+                    entries = json.load(fd)
+            except ValueError:
+                entries = None
+        if entries is None:
+            save_shard_entries(config, name, _log_entries(config, ref))
+            with open(path, 'r') as fd:
+                entries = json.load(fd)
+        res.extend(entries)
+    return res
+
+def _load_index(config) -> BackupIndex:
+    global _index
+    path = get_metadata_path(config, INDEX_FILE)
+    if _index is None or _index.path != path:
+        _index = BackupIndex(path).load()
+        _index.sealed = load_sealed(config)
+        _index._reindex()
+    return _index
+
+def reload_sealed(config):
+    with _index_lock:
+        index = _load_index(config)
+        index.sealed = load_sealed(config)
+        index._reindex()
+
+def get_index(config) -> BackupIndex:
+    """
+    Return the backup index, rebuilt from git if it does not match the branch tip
+    """
+    with _index_lock:
+        index = _load_index(config)
+        if index.head != resolve_ref(config, 'HEAD'):
+            rebuild_index(config, index)
+        return index
+
+def record_backup(config, changed_bytes: int = None, size_delta: int = None):
+    """
+    Append the commit just made on the backup branch
+    """
+    commit = read_commit(config, 'HEAD')
+    if commit is None:
+        return
+    oid, headers, message = commit
+    with _index_lock:
+        index = _load_index(config)
+        if index.head is None or index.head != headers.get('parent'):
+            rebuild_index(config, index)
+            return
+        ct = int(headers.get('committer', '0 0').split()[-2])
+        index.append(make_entry(oid, ct, message.split('\n', 1)[0], changed_bytes, size_delta))
+        index.save()
+
+def rewrite_index(config, mapping: dict):
+    """
+    Keep the backups in `mapping` under their new hashes after the history was rewritten.
+    The changed bytes of a backup whose predecessor was dropped no longer describe a single step
+    """
+    with _index_lock:
+        index = _load_index(config)
+        entries = []
+        previous_kept = True
+        for ent in index.entries:
+            new = mapping.get(ent['hash'])
+            if new is None:
+                previous_kept = False
+                continue
+            ent = dict(ent, hash=new)
+            if not previous_kept:
+                ent['changed_bytes'] = ent['size_delta'] = None
+            entries.append(ent)
+            previous_kept = True
+        index.entries = entries
+        index.head = entries[-1]['hash'] if len(entries) > 0 else None
+        index._reindex()
+        index.save()
+
+def truncate_index(config, oid: str):
+    """
+    Drop the backups after `oid`, after the branch was reset to it
+    """
+    with _index_lock:
+        index = _load_index(config)
+        if index.truncate(oid):
+            index.save()
+        else:
+            rebuild_index(config, index)
@@ -1,6 +1,8 @@
 import mcdreforged.api.all as MCDR
+import os
 import time
 from threading import Timer
+from typing import Optional
 from git_backup.utils import print_message, get_format_time
 from git_backup.constants import MIN_INTERVAL
 
@@ -15,15 +17,57 @@ def cancel_backup_timer(backup_timer):
     if backup_timer is not None:
         backup_timer.cancel()
 
+def _covered(config, path: str) -> bool:
+    path = path.replace(os.sep, '/').strip('/')
+    for file in config.need_backup:
+        file = file.replace(os.sep, '/')
+        if path == file or path.startswith(file + '/'):
+            return True
+    return False
+
+def get_schedules(config) -> list:
+    """
+    The schedule groups that can run: an interval of at least `MIN_INTERVAL`
+    and paths that all lie in `need_backup`, a full backup has to hold them too
+    """
+    return [group for group in config.schedules
+            if group.get('interval', 0) >= MIN_INTERVAL and len(group.get('paths', [])) > 0 and
+            all(_covered(config, path) for path in group['paths'])]
+
+def next_backup(config) -> Optional[tuple]:
+    """
+    Return `(time, group)` of the next scheduled backup, `group` is None for a full backup.
+    None if nothing is scheduled
+    """
+    res = None
+    if config.backup_interval >= MIN_INTERVAL:
+        res = (config.last_backup_time + config.backup_interval, None)
+    for group in get_schedules(config):
+        t = group.get('last_backup_time', 0) + group['interval']
+        if res is None or t < res[0]:
+            res = (t, group)
+    return res
+
 def flush_backup_timer(backup_timer, call, source: MCDR.PluginCommandSource, config):
+    """
+    Start a timer calling `call(group)` for whichever of the full backup and the schedule groups is due first
+    """
     cancel_backup_timer(backup_timer)
     backup_timer = None
-    if config.backup_interval >= MIN_INTERVAL:
-        now = time.time()
-        t = max(2, config.backup_interval - (now - config.last_backup_time))
-        print_message(source, 'Next backup time: ' + get_format_time(now + t), tell=False)
-        backup_timer = new_timer(t, call)
-    else:
+    if config.backup_interval < MIN_INTERVAL:
         print_message(source, 'backup_timer can not be flushed, ' + 
             f'config.backup_interval {config.backup_interval} < MIN_INTERVAL {MIN_INTERVAL}', tell=False)
-    return backup_timer
\ No newline at end of file
+    valid = get_schedules(config)
+    for group in config.schedules:
+        if group not in valid:
+            print_message(source, f'schedule {group.get("name")} is ignored, its interval is below ' +
+                f'MIN_INTERVAL {MIN_INTERVAL} or a path of it is not in need_backup', tell=False)
+    nxt = next_backup(config)
+    if nxt is not None:
+        now = time.time()
+        t, group = nxt
+        t = max(2, t - now)
+        name = '' if group is None else f' ({group["name"]})'
+        print_message(source, 'Next backup time: ' + get_format_time(now + t) + name, tell=False)
+        backup_timer = new_timer(t, call, args=[group])
+    return backup_timer
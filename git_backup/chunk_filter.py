@@ -0,0 +1,158 @@
+import inspect
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from git_backup import region_filter
+from git_backup.fast_import import quote_path
+from git_backup.git import run_git_cmd, get_cat_file, ls_tree
+from git_backup.utils import get_metadata_path, run_cmd, decode_output, log_info
+
+FILTER_NAME = 'gbk-region'
+FILTER_SCRIPT = 'region_filter.py'
+ATTRIBUTES = ['*.mca filter={}'.format(FILTER_NAME), '*.mcc filter={}'.format(FILTER_NAME)]
+
+def _command(script: str, *args) -> str:
+    # git runs the filter through sh, even on Windows
+    return ' '.join('"{}"'.format(a.replace('\\', '/')) for a in (sys.executable, script) + args)
+
+def _attributes_path(config) -> str:
+    return os.path.join(config.backup_path, '.git', 'info', 'attributes')
+
+def is_installed(config) -> bool:
+    ecode, _ = run_git_cmd(config, 'config', '--get', 'filter.{}.process'.format(FILTER_NAME))
+    return ecode == 0
+
+def install_region_filter(config, logger=None):
+    """
+    Install the region filter when `region_filter` is on. When it is turned off after being on,
+    keep a smudge only filter so the canonical blobs already in history still check out as region files
+    """
+    if not config.region_filter and not is_installed(config):
+        return
+    script = get_metadata_path(config, FILTER_SCRIPT)
+    with open(script, 'w', encoding='utf-8') as fd:
+        fd.write(inspect.getsource(region_filter))
+    key = 'filter.{}.'.format(FILTER_NAME)
+    if config.region_filter:
+        run_git_cmd(config, 'config', key + 'process', _command(script, 'process'))
+        run_git_cmd(config, 'config', key + 'clean', _command(script, 'clean') + ' %f')
+        run_git_cmd(config, 'config', key + 'required', 'true')
+    else:
+        run_git_cmd(config, 'config', key + 'process', _command(script, 'process', '--smudge-only'))
+        run_git_cmd(config, 'config', '--unset', key + 'clean')
+        run_git_cmd(config, 'config', '--unset', key + 'required')
+    run_git_cmd(config, 'config', key + 'smudge', _command(script, 'smudge') + ' %f')
+
+    path = _attributes_path(config)
+    lines = []
+    if os.path.isfile(path):
+        with open(path, 'r', encoding='utf-8') as fd:
+            lines = fd.read().splitlines()
+    missing = [line for line in ATTRIBUTES if line not in lines]
+    if len(missing) > 0:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as fd:
+            fd.write('\n'.join(lines + missing) + '\n')
+    log_info(logger, 'region filter: {}'.format('installed' if config.region_filter else 'smudge only'))
+
+class _Import:
+    def __init__(self, config, path: str):
+        self.path = path
+        run_cmd([config.git_path, 'init', '-q', '--bare', path])
+        self.proc = subprocess.Popen([config.git_path, '-C', path, 'fast-import', '--quiet', '--done'],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.bytes = 0
+
+    def write(self, data: bytes):
+        self.proc.stdin.write(data)
+
+    def blob(self, rel: str, data: bytes):
+        self.write('M 100644 inline {}\n'.format(quote_path(rel)).encode('utf-8'))
+        self.write(b'data %d\n' % len(data))
+        self.write(data)
+        self.write(b'\n')
+        self.bytes += len(data)
+
+    def finish(self):
+        self.proc.stdin.write(b'done\n')
+        self.proc.stdin.close()
+        out = decode_output(self.proc.stdout.read())
+        if self.proc.wait() != 0:
+            raise RuntimeError('git fast-import error: {}'.format(out))
+
+    def kill(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+
+def _repack(config, path: str):
+    start = time.time()
+    ecode, out = run_cmd([config.git_path, '-C', path, 'repack', '-a', '-d', '-f', '-q'], config.debug)
+    if ecode != 0:
+        raise RuntimeError('git repack error({0}): {1}'.format(ecode, out))
+    elapsed = time.time() - start
+    size = 0
+    pack_dir = os.path.join(path, 'objects', 'pack')
+    for name in os.listdir(pack_dir):
+        size += os.path.getsize(os.path.join(pack_dir, name))
+    return size, elapsed
+
+def measure_region_filter(config, commits: list, logger=None) -> dict:
+    """
+    Replay `commits` (oldest first) into two scratch repositories, one storing the region files as
+    the game writes them and one storing the canonical form, fully repack both and compare
+    """
+    workdir = get_metadata_path(config, 'measure')
+    if os.path.isdir(workdir):
+        shutil.rmtree(workdir)
+    imports = []
+    res = {'commits': len(commits), 'clean_time': 0.0, 'smudge_time': 0.0, 'region_files': 0}
+    try:
+        raw, canonical = imports = [_Import(config, os.path.join(workdir, 'raw.git')),
+                                    _Import(config, os.path.join(workdir, 'canonical.git'))]
+        cat_file = get_cat_file(config)
+        previous = {}
+        for oid in commits:
+            tree = ls_tree(config, oid, config.need_backup)
+            header = 'commit refs/heads/main\ncommitter GitBackUp <measure@local> 0 +0000\ndata 0\n'.encode('utf-8')
+            raw.write(header)
+            canonical.write(header)
+            for rel in previous:
+                if rel not in tree:
+                    raw.write('D {}\n'.format(quote_path(rel)).encode('utf-8'))
+                    canonical.write('D {}\n'.format(quote_path(rel)).encode('utf-8'))
+            for rel, (_, blob, _) in tree.items():
+                if previous.get(rel) == blob:
+                    continue
+                data = cat_file.query(blob)[3]
+                if region_filter.is_filtered(rel):
+                    res['region_files'] += 1
+                    start = time.time()
+                    data = region_filter.smudge(rel, data)
+                    res['smudge_time'] += time.time() - start
+                    raw.blob(rel, data)
+                    start = time.time()
+                    data = region_filter.clean(rel, data)
+                    res['clean_time'] += time.time() - start
+                    canonical.blob(rel, data)
+                else:
+                    raw.blob(rel, data)
+                    canonical.blob(rel, data)
+            raw.write(b'\n')
+            canonical.write(b'\n')
+            previous = {rel: blob for rel, (_, blob, _) in tree.items()}
+        for imp in imports:
+            imp.finish()
+        res['raw_bytes'] = raw.bytes
+        res['canonical_bytes'] = canonical.bytes
+        res['raw_pack'], res['raw_repack_time'] = _repack(config, raw.path)
+        res['canonical_pack'], res['canonical_repack_time'] = _repack(config, canonical.path)
+    finally:
+        for imp in imports:
+            imp.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+    log_info(logger, 'region filter measure: {}'.format(res))
+    return res
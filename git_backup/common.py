@@ -1,5 +1,5 @@
 import mcdreforged.api.all as MCDR
-from threading import Lock, Timer
+from threading import Event, Lock, Timer
 from git_backup.config import Configure
 
 server_inst: MCDR.PluginServerInterface
@@ -8,11 +8,17 @@ config: Configure
 operation_lock = Lock()
 operation_name = MCDR.RText('?')
 
-game_saved: bool = False
+game_saved = Event()
+online_players = set()
+# whether a player was online since the last backup, unknown after a reload so assumed
+players_active: bool = True
 abort_restore: bool = False
 plugin_unloaded: bool = False
 slot_selected: str = None
 date_selected: str = None
 comment_selected: str = None
+spec_selected: str = None
 
-backup_timer: Timer = None
\ No newline at end of file
+backup_timer: Timer = None
+push_gate = None
+push_workers = {}
\ No newline at end of file
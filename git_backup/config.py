@@ -5,6 +5,7 @@ class Configure(Serializable):
     debug: bool = False
     enabled: bool = False
     turn_off_auto_save: bool = True
+    save_timeout: int = 60
     git_path: str = 'git'
     git_cfg: Dict[str, Any] = {
         'use_remote': False,
@@ -17,12 +18,47 @@ class Configure(Serializable):
         'ssh_command': 'ssh',
     }
     backup_interval: int = 60 * 60 * 24 # 1 day
+    # skip a scheduled backup when need_backup did not change since the last one
+    precheck: bool = True
+    # the game rewrites these on every auto save, even on an idle server
+    precheck_ignores: List[str] = [
+        'level.dat',
+        'level.dat_old',
+    ]
+    skip_if_no_players: bool = False
+    # paths of need_backup backed up on their own interval, each backup a commit touching only them, e.g.
+    # {'name': 'players', 'paths': ['world/playerdata', 'world/advancements', 'world/stats'], 'interval': 300, 'push': False}
+    schedules: List[Dict[str, Any]] = []
     last_backup_time: float = 0
     push_interval: int = 60 * 60 * 24 # 1 day
     last_push_time: float = 0
+    push_bandwidth_limit: int = 0 # bytes per second, 0 is unlimited
+    push_concurrency: int = 2
+    # when not empty, replaces the remote of git_cfg, e.g.
+    # {'name': 'disk2', 'url': '/mnt/disk2/world.git', 'push_interval': 0, 'priority': 10, 'bandwidth_limit': None}
+    remotes: List[Dict[str, Any]] = []
+    push_retry: Dict[str, Any] = {
+        'max_attempts': 5,
+        'backoff': 30,
+        'backoff_max': 60 * 30,
+    }
     back_wait_time: int = 15
+    differential_restore: bool = True
+    pre_restore_keep: int = 3
+    list_page_size: int = 10
+    # prune keeps every backup of the last keep_all seconds, then the latest of each `every` seconds
+    # for backups younger than `within` (0 is any age), and drops the rest
+    retention: Dict[str, Any] = {
+        'enabled': False,
+        'keep_all': 60 * 60 * 24, # 1 day
+        'rules': [
+            {'every': 60 * 60, 'within': 60 * 60 * 24 * 7}, # hourly for 1 week
+            {'every': 60 * 60 * 24, 'within': 60 * 60 * 24 * 90}, # daily for 90 days
+            {'every': 60 * 60 * 24 * 7, 'within': 0}, # weekly beyond
+        ],
+    }
+    timing_history_size: int = 200
     backup_path: str = './git_backup'
-    cache_path: str = './git_backup_cache'
     server_path: str = './server'
     need_backup: List[str] = [
         'world',
@@ -30,17 +66,80 @@ class Configure(Serializable):
     ignores: List[str] = [
         'session.lock',
     ]
+    backup_engine: str = 'copy' # 'copy' or 'fast_import'
+    incremental_copy: bool = True
+    sync_manifest: bool = True
+    region_patch: bool = True
+    region_filter: bool = False
+    # let the game save again once the changed files are copied, git works from the copy
+    # the fast_import engine keeps that copy in .git/gbk/snapshot, a second copy of the world on disk without reflink
+    snapshot_backup: bool = True
+    reflink: bool = True
+    # keep backups from taking the CPU and the disk from the server
+    throttle: Dict[str, Any] = {
+        'copy_rate_limit': 0, # bytes per second of the copies and of fast-import, 0 is unlimited
+        'nice': 0, # niceness of the git processes, 0 leaves it alone
+        'ionice_idle': False, # run the git processes in the idle I/O class
+        'pack_threads': 0, # pack.threads of git, 0 lets git decide
+        'pack_window_memory': '', # pack.windowMemory of git, e.g. '256m'
+        # for adaptive_cooldown seconds after a lag warning, copy at no more than adaptive_rate
+        # and run new git processes at the lowest priorities
+        'adaptive': False,
+        'adaptive_rate': 8 * 1024 * 1024, # 8 MiB/s
+        'adaptive_cooldown': 60,
+        'lag_keywords': [
+            "Can't keep up!",
+        ],
+    }
+    copy_threads: int = 4
+    copy_split_size: int = 8 * 1024 * 1024 # 8 MiB
+    maintenance: Dict[str, Any] = {
+        'enabled': True,
+        'full_interval': 60 * 60 * 24 * 7, # 1 week
+        'full_pack_count': 50,
+        'full_size_growth': 1.5,
+        'last_full_time': 0,
+        'last_full_size': 0,
+    }
+    # seal the history into a read-only shard every period seconds, or once the active shard's
+    # packs and loose objects reach max_size bytes, 0 disables either
+    shard: Dict[str, Any] = {
+        'enabled': False,
+        'period': 60 * 60 * 24 * 30, # 30 days
+        'max_size': 0,
+        'last_rollover_time': 0,
+    }
+    # a bare repository several instances borrow objects from through git alternates,
+    # `consolidate` moves the objects of this instance into it
+    shared_store: Dict[str, Any] = {
+        'enabled': False,
+        'path': '../shared_objects.git',
+        'instance': '', # the name of this instance in the store, the directory of backup_path if empty
+        'prune_expire': '2.weeks.ago', # consolidate deletes the objects no instance reaches once older than this, 'never' keeps them
+    }
+    # `export` streams a slot from the object store into an archive under path
+    export: Dict[str, Any] = {
+        'path': './git_backup_exports',
+        'format': 'tar.gz', # 'tar', 'tar.gz', 'tar.zst' or 'zip'
+        'threads': 0, # threads of pigz / zstd, 0 uses every core
+    }
     # 0:guest 1:user 2:helper 3:admin 4:owner
     minimum_permission_level: Dict[str, int] = {
         'help':    0,
         'status':  1,
+        'stats':   1,
         'list':    1,
+        'find':    1,
         'make':    1,
         'back':    2,
         'confirm': 1,
         'abort':   1,
         'push':    2,
         'prune':   2,
+        'rollover': 3,
+        'consolidate': 3,
+        'measure': 2,
+        'export':  2,
         'pull':    2
     }
     saved_world_keywords: List[str] = [
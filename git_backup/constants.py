@@ -6,6 +6,12 @@ Prefix = '!!gbk'
 PLUGIN_ABBR = 'GBU'
 CONFIG_FILE = os.path.join('config', 'GitBackUp.json')
 MIN_INTERVAL = 30
+METADATA_DIR = os.path.join('.git', 'gbk')
+MANIFEST_FILE = 'manifest.json'
+SNAPSHOT_DIR = 'snapshot'
+PRE_RESTORE_REF = 'refs/gbk/pre-restore'
+SHARD_REF = 'refs/gbk/shards'
+EXPORT_REF = 'refs/gbk/export'
 
 BACKUP_DONE_EVENT 		= LiteralEvent('{}.backup_done'.format(PLUGIN_ID))
 RESTORE_DONE_EVENT 		= LiteralEvent('{}.restore_done'.format(PLUGIN_ID))
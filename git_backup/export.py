@@ -0,0 +1,100 @@
+import gzip
+import os
+import re
+import shutil
+import subprocess
+
+from threading import Lock
+from typing import Optional
+from git_backup.constants import EXPORT_REF
+from git_backup.git import git_argv, run_git_cmd, get_cat_file
+from git_backup.governor import command_prefix
+from git_backup.utils import decode_output, log_info
+
+EXPORT_FORMATS = ('tar', 'tar.gz', 'tar.zst', 'zip')
+BUFFER_SIZE = 1024 * 1024
+
+_export_lock = Lock()
+
+def export_name(slot: str, date: str) -> str:
+    return '{}_{}'.format(re.sub(r'[^0-9A-Za-z-]+', '-', date).strip('-'), slot[:10])
+
+def _compressor(fmt: str, threads: int) -> Optional[list]:
+    """
+    The command compressing a tar stream on stdin, None to compress it in process
+    """
+    if fmt == 'tar.zst':
+        zstd = shutil.which('zstd')
+        if zstd is None:
+            raise RuntimeError('zstd is not found, it is needed for tar.zst')
+        return [zstd, '-q', '-c', '-T{}'.format(threads)]
+    pigz = shutil.which('pigz')
+    if pigz is not None:
+        return [pigz, '-c', '-n'] + (['-p', str(threads)] if threads > 0 else [])
+    gz = shutil.which('gzip')
+    return None if gz is None else [gz, '-c', '-n']
+
+def export_slot(config, oid: str, name: str, fmt: str = None, logger=None) -> Optional[tuple]:
+    """
+    Stream the `need_backup` paths of commit `oid` from the object store into `<export.path>/<name>.<fmt>`,
+    the files under the folder `name`. `git archive` reads the blobs (through the region filter, so region files come
+    out as the game wrote them) and a compressor process packs its output, both through pipes with bounded memory.
+    The working tree and the index of `backup_path` are never touched, a ref keeps the commit from being pruned meanwhile.
+    Return `(path, size)`, None if another export is running
+    """
+    cfg = config.export
+    fmt = fmt or cfg['format']
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError('{} is not one of {}'.format(fmt, ', '.join(EXPORT_FORMATS)))
+    if not _export_lock.acquire(blocking=False):
+        return None
+    ref = '{}/{}'.format(EXPORT_REF, oid)
+    folder = os.path.abspath(cfg['path'])
+    path = os.path.join(folder, '{}.{}'.format(name, fmt))
+    part = path + '.part'
+    try:
+        run_git_cmd(config, 'update-ref', ref, oid)
+        # a path of need_backup missing from the slot would fail the whole archive
+        paths = [p.replace(os.sep, '/') for p in config.need_backup
+                 if get_cat_file(config, check=True).query('{}:{}'.format(oid, p.replace(os.sep, '/'))) is not None]
+        if len(paths) == 0:
+            raise RuntimeError('{} holds none of {}'.format(oid, config.need_backup))
+        os.makedirs(folder, exist_ok=True)
+        archive = git_argv(config, 'archive', '--format=zip' if fmt == 'zip' else '--format=tar',
+                           '--prefix={}/'.format(name), oid, '--', *paths)
+        compressor = None if fmt in ('tar', 'zip') else _compressor(fmt, max(0, cfg['threads']))
+        with open(part, 'wb') as fd:
+            src = subprocess.Popen(archive, stdout=fd if fmt in ('tar', 'zip') else subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+            try:
+                if compressor is not None:
+                    dst = subprocess.Popen([*command_prefix(), *compressor], stdin=src.stdout, stdout=fd,
+                                           stderr=subprocess.PIPE)
+                    # the compressor holds the only read end, git gets SIGPIPE if it dies
+                    src.stdout.close()
+                    err = decode_output(dst.stderr.read())
+                    if dst.wait() != 0:
+                        raise RuntimeError('{} error({}): {}'.format(compressor[0], dst.returncode, err))
+                elif fmt == 'tar.gz':
+                    with gzip.GzipFile(fileobj=fd, mode='wb', mtime=0) as gz:
+                        while True:
+                            buf = src.stdout.read(BUFFER_SIZE)
+                            if len(buf) == 0:
+                                break
+                            gz.write(buf)
+                err = decode_output(src.stderr.read())
+                if src.wait() != 0:
+                    raise RuntimeError('git archive error({}): {}'.format(src.returncode, err))
+            except BaseException:
+                src.kill()
+                src.wait()
+                raise
+        os.replace(part, path)
+        size = os.path.getsize(path)
+        log_info(logger, 'exported {} to {} ({} bytes)'.format(oid, path, size))
+        return path, size
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
+        run_git_cmd(config, 'update-ref', '-d', ref)
+        _export_lock.release()
@@ -0,0 +1,138 @@
+import os
+import time
+import subprocess
+
+from git_backup import region_filter
+from git_backup.git import git_argv, resolve_ref, run_git_cmd
+from git_backup.governor import throttle_io
+from git_backup.manifest import Manifest
+from git_backup.sync import SyncStats, walk_files, COPY_BUFFER_SIZE
+from git_backup.utils import debug_message, log_info, decode_output
+
+def quote_path(rel: str) -> str:
+    if rel.startswith('"') or '\n' in rel:
+        return '"' + rel.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+    return rel
+
+def _write_data(stdin, data: bytes):
+    stdin.write(b'data %d\n' % len(data))
+    stdin.write(data)
+    stdin.write(b'\n')
+
+def _write_file(stdin, rel: str, path: str, filtered: bool = False):
+    if filtered:
+        # the blob has to be what the clean filter of `git add` would store
+        with open(path, 'rb') as fd:
+            data = fd.read()
+        throttle_io(len(data))
+        stdin.write('M 100644 inline {}\n'.format(quote_path(rel)).encode('utf-8'))
+        _write_data(stdin, region_filter.clean(rel, data))
+        return len(data)
+    with open(path, 'rb') as fd:
+        size = os.fstat(fd.fileno()).st_size
+        stdin.write('M 100644 inline {}\n'.format(quote_path(rel)).encode('utf-8'))
+        stdin.write(b'data %d\n' % size)
+        remain = size
+        while remain > 0:
+            buf = fd.read(min(remain, COPY_BUFFER_SIZE))
+            if len(buf) == 0:
+                raise RuntimeError('{} was truncated while reading'.format(path))
+            throttle_io(len(buf))
+            stdin.write(buf)
+            remain -= len(buf)
+        stdin.write(b'\n')
+    return size
+
+def fast_import_commit(config, message: str, manifest: Manifest, ref: str = None,
+                       paths=None, allow_empty: bool = False, source_path: str = None, logger=None) -> SyncStats:
+    """
+    Commit `paths` (default `need_backup`) of `source_path` (default `server_path`) onto `ref`
+    (default the backup branch) by streaming the files changed since `manifest.head` into `git fast-import`,
+    the working tree of `backup_path` is never touched.
+    A snapshot as `source_path` has to keep the mtime of the world files, the manifest matches on it.
+
+    A path without manifest entries is replaced as a whole.
+    The manifest is updated for the new commit only when committing onto the backup branch
+    """
+    stats = SyncStats()
+    branch_ref = 'refs/heads/{}'.format(config.git_cfg['branch_name'])
+    if ref is None:
+        ref = branch_ref
+    if paths is None:
+        paths = config.need_backup
+    if source_path is None:
+        source_path = config.server_path
+    parent = resolve_ref(config, branch_ref)
+    # without the commit the manifest describes, every file has to be streamed again
+    entries = {} if parent is None or manifest.head != parent else dict(manifest.entries)
+
+    changed = []
+    deleted = []
+    rebuilt = []
+    for basename in paths:
+        prefix = basename.replace(os.sep, '/')
+        sub = prefix + '/'
+        old = {rel: ent for rel, ent in entries.items() if rel == prefix or rel.startswith(sub)}
+        if len(old) == 0:
+            rebuilt.append(prefix)
+        seen = set()
+        for rel, path, st in walk_files(source_path, basename, config.ignores):
+            stats.files_total += 1
+            stats.bytes_total += st.st_size
+            seen.add(rel)
+            ent = old.get(rel)
+            if ent is None or ent[0] != st.st_size or ent[1] != st.st_mtime_ns:
+                changed.append((rel, path))
+            entries[rel] = [st.st_size, st.st_mtime_ns]
+        for rel in old:
+            if rel not in seen:
+                deleted.append(rel)
+                del entries[rel]
+    if not allow_empty and len(rebuilt) == 0 and len(changed) == 0 and len(deleted) == 0:
+        raise RuntimeError('nothing to commit, {} is unchanged'.format(', '.join(paths)))
+
+    name, email = config.git_cfg['user_name'], config.git_cfg['user_email']
+    now = int(time.time())
+    proc = subprocess.Popen(git_argv(config, 'fast-import', '--quiet', '--done'),
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    try:
+        stdin = proc.stdin
+        stdin.write('commit {}\n'.format(ref).encode('utf-8'))
+        stdin.write('committer {} <{}> {} {}\n'.format(name, email, now, time.strftime('%z')).encode('utf-8'))
+        _write_data(stdin, message.encode('utf-8'))
+        if parent is not None:
+            stdin.write('from {}\n'.format(parent).encode('utf-8'))
+        for prefix in rebuilt:
+            stdin.write('D {}\n'.format(quote_path(prefix)).encode('utf-8'))
+        for rel in deleted:
+            stdin.write('D {}\n'.format(quote_path(rel)).encode('utf-8'))
+            stats.files_deleted += 1
+        for rel, path in changed:
+            stats.bytes_copied += _write_file(stdin, rel, path,
+                                              filtered=config.region_filter and region_filter.is_filtered(rel))
+            stats.files_copied += 1
+        stdin.write(b'\ndone\n')
+        stdin.close()
+    except BrokenPipeError:
+        pass
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    out = decode_output(proc.stdout.read())
+    ecode = proc.wait()
+    debug_message(config.debug, 'fast-import:', ecode, out)
+    if ecode != 0:
+        raise RuntimeError('git fast-import error({0}): {1}'.format(ecode, out))
+
+    log_info(logger, 'fast-import: streamed {} files, deleted {}'.format(stats.files_copied, stats.files_deleted))
+    if ref == branch_ref:
+        # fast-import moved the branch under the index, without this `git status` shows every file as staged
+        # and the copy engine would commit against a stale index after switching back
+        ecode, out = run_git_cmd(config, 'read-tree', branch_ref)
+        if ecode != 0:
+            raise RuntimeError('git read-tree error({0}): {1}'.format(ecode, out))
+        manifest.entries = entries
+        manifest.head = resolve_ref(config, branch_ref)
+        manifest.save()
+    return stats.finish()
@@ -2,11 +2,14 @@ import os
 import sys
 import subprocess
 
-from git_backup.utils import debug_message, log_info, log_warning, run_sh_cmd, get_format_time
+from threading import Lock
+from typing import Optional
+from git_backup.governor import command_prefix, git_config_args
+from git_backup.utils import debug_message, log_info, log_warning, run_cmd, get_format_time
 
 def setup_git(config, logger=None):
     # check git
-    ecode, out = run_sh_cmd('{git} --version'.format(git=config.git_path), config.debug)
+    ecode, out = run_cmd([config.git_path, '--version'], config.debug)
     if ecode != 0:
         raise RuntimeError('Can not found git at "{}"'.format(config.git_path))
     log_info(logger, out.strip())
@@ -27,15 +30,22 @@ def setup_git(config, logger=None):
         # init git
         log_info(logger, 'git is initing')
         _run_git_cmd_hp('init')
-        _run_git_cmd_hp('config', 'user.email', '"{}"'.format(config.git_cfg['user_email']))
-        _run_git_cmd_hp('config', 'user.name', '"{}"'.format(config.git_cfg['user_name']))
+        _run_git_cmd_hp('config', 'user.email', config.git_cfg['user_email'])
+        _run_git_cmd_hp('config', 'user.name', config.git_cfg['user_name'])
         _run_git_cmd_hp('config', 'credential.helper', 'store')
         _run_git_cmd_hp('config', 'core.autocrlf', 'false')
-        _run_git_cmd_hp('config', 'core.sshCommand', '"{}"'.format(config.git_cfg['ssh_command']))
+        _run_git_cmd_hp('config', 'core.sshCommand', config.git_cfg['ssh_command'])
     else:
-        _run_git_cmd_hp('config', 'user.email', '"{}"'.format(config.git_cfg['user_email']))
-        _run_git_cmd_hp('config', 'user.name', '"{}"'.format(config.git_cfg['user_name']))
-        _run_git_cmd_hp('config', 'core.sshCommand', '"{}"'.format(config.git_cfg['ssh_command']))
+        _run_git_cmd_hp('config', 'user.email', config.git_cfg['user_email'])
+        _run_git_cmd_hp('config', 'user.name', config.git_cfg['user_name'])
+        _run_git_cmd_hp('config', 'core.sshCommand', config.git_cfg['ssh_command'])
+
+    from git_backup.shared_store import setup_shared_store
+    setup_shared_store(config, logger=logger)
+
+    # before the first commit, so the region files of the setup commit are stored in the canonical form
+    from git_backup.chunk_filter import install_region_filter
+    install_region_filter(config, logger=logger)
 
     log_info(logger, 'git email: ' + run_git_cmd(config, 'config', 'user.email')[1].strip())
     log_info(logger, 'git user: ' + run_git_cmd(config, 'config', 'user.name')[1].strip())
@@ -46,10 +56,12 @@ def setup_git(config, logger=None):
     
     if not config.git_cfg['is_setup']:
         _run_git_cmd_hp('add', '--all')
-        _run_git_cmd_hp('commit', '-m', '"{}=Setup commit"'.format(get_format_time()))
+        _run_git_cmd_hp('commit', '-m', '{}=Setup commit'.format(get_format_time()))
     else:    
         _run_git_cmd_hp('clean', '-df')
-        _run_git_cmd_hp('restore', '.')
+        # the fast-import engine never keeps a copy of the world in the working tree
+        if config.backup_engine != 'fast_import':
+            _run_git_cmd_hp('restore', '.')
 
     try:
         _run_git_cmd_hp('branch', config.git_cfg['branch_name'])
@@ -57,16 +69,21 @@ def setup_git(config, logger=None):
     _run_git_cmd_hp('switch', config.git_cfg['branch_name'])
 
     # push
-    if config.git_cfg['use_remote']:
-        try:
-            _run_git_cmd_hp('remote', 'add', config.git_cfg['remote_name'], config.git_cfg['remote'])
-        except: pass
-        ecode, out = run_git_cmd(config, 'remote', 'get-url', config.git_cfg['remote_name'])
-        if ecode != 0 or out.strip() != config.git_cfg['remote']:
-            log_info(logger, 'new url: ' + config.git_cfg['remote'])
-            _run_git_cmd_hp('remote', 'set-url', config.git_cfg['remote_name'], config.git_cfg['remote'])
-
-        log_info(logger, 'git remote: {}'.format(config.git_cfg['remote']))
+    if config.git_cfg['use_remote'] and len(config.remotes) > 0:
+        # every remote is pushed to by the push workers, the first push included
+        from git_backup.push_worker import get_remotes, is_local_url
+        for remote in get_remotes(config):
+            url = remote['url']
+            if is_local_url(url):
+                path = os.path.expanduser(url[len('file://'):] if url.startswith('file://') else url)
+                if not os.path.isdir(path):
+                    log_info(logger, 'git init --bare {}'.format(path))
+                    ecode, out = run_cmd([config.git_path, 'init', '-q', '--bare', path], config.debug)
+                    if ecode != 0:
+                        raise RuntimeError('Init remote {0} error({1}): {2}'.format(remote['name'], ecode, out))
+            _setup_remote(config, remote['name'], url, logger=logger)
+    elif config.git_cfg['use_remote']:
+        _setup_remote(config, config.git_cfg['remote_name'], config.git_cfg['remote'], logger=logger)
 
         try:
             _run_git_cmd_hp('pull', '--set-upstream', config.git_cfg['remote_name'], config.git_cfg['branch_name'])
@@ -74,10 +91,8 @@ def setup_git(config, logger=None):
 
         if not config.git_cfg['is_setup']:
             proc = subprocess.Popen(
-                '{git} -C {path} push -u {remote_name} {branch}'.format(
-                git=config.git_path, path=config.backup_path,
-                remote_name=config.git_cfg['remote_name'], branch=config.git_cfg['branch_name']),
-                shell=True,
+                [config.git_path, '-C', config.backup_path, 'push', '-u',
+                 config.git_cfg['remote_name'], config.git_cfg['branch_name']],
                 stdout=sys.stdout, stderr=sys.stdout, stdin=sys.stdin,
                 bufsize=-1)
             ecode = proc.wait()
@@ -86,8 +101,171 @@ def setup_git(config, logger=None):
 
     config.git_cfg['is_setup'] = True
 
-def run_git_cmd(config, child: str, *args):
-    command = '{git} -C {path} --no-pager {child} {args}'.format(
-        git=config.git_path, path=config.backup_path, child=child, args=' '.join(args))
+def _setup_remote(config, name: str, url: str, logger=None):
+    ecode, out = run_git_cmd(config, 'remote', 'get-url', name)
+    if ecode != 0:
+        ecode, out = run_git_cmd(config, 'remote', 'add', name, url)
+    elif out.strip() != url:
+        log_info(logger, 'new url: ' + url)
+        ecode, out = run_git_cmd(config, 'remote', 'set-url', name, url)
+    if ecode != 0:
+        raise RuntimeError('Init git error({0}): {1}'.format(ecode, out))
+    log_info(logger, 'git remote {}: {}'.format(name, url))
+
+def git_argv(config, child: str, *args) -> list:
+    return [*command_prefix(), config.git_path, *git_config_args(), '-C', config.backup_path, '--no-pager', child, *args]
+
+def run_git_cmd(config, child: str, *args, input: bytes = None):
     debug_message(config.debug, 'child:', type(child), child, 'args:', args)
-    return run_sh_cmd(command, config.debug)
\ No newline at end of file
+    return run_cmd(git_argv(config, child, *args), config.debug, input=input)
+
+class CatFileBatch:
+    """
+    A long-lived `git cat-file --batch` (or `--batch-check`) process,
+    so repeated object lookups do not spawn a process each
+    """
+    def __init__(self, config, check: bool = False):
+        self.git_path = config.git_path
+        self.backup_path = config.backup_path
+        self.check = check
+        self.lock = Lock()
+        self.proc: Optional[subprocess.Popen] = None
+
+    def _ensure_proc(self):
+        if self.proc is None or self.proc.poll() is not None:
+            self.proc = subprocess.Popen(
+                [self.git_path, '-C', self.backup_path, 'cat-file',
+                 '--batch-check' if self.check else '--batch'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                bufsize=-1)
+        return self.proc
+
+    def query(self, rev: str):
+        """
+        Return `(oid, type, size, content)`, `content` is None for `--batch-check`.
+        Return None if `rev` does not name an object
+        """
+        with self.lock:
+            proc = self._ensure_proc()
+            try:
+                proc.stdin.write(rev.encode('utf-8') + b'\n')
+                proc.stdin.flush()
+                header = proc.stdout.readline().decode('utf-8').split()
+                if len(header) != 3:
+                    return None
+                oid, type_, size = header[0], header[1], int(header[2])
+                content = None
+                if not self.check:
+                    content = proc.stdout.read(size + 1)[:size]
+                return oid, type_, size, content
+            except (OSError, ValueError):
+                self.close()
+                raise
+
+    def copy_to(self, rev: str, fd, buffer_size: int = 1024 * 1024) -> Optional[int]:
+        """
+        Stream the content of blob `rev` into the file object `fd` with bounded memory,
+        return the size written or None if `rev` does not exist
+        """
+        assert not self.check
+        with self.lock:
+            proc = self._ensure_proc()
+            try:
+                proc.stdin.write(rev.encode('utf-8') + b'\n')
+                proc.stdin.flush()
+                header = proc.stdout.readline().decode('utf-8').split()
+                if len(header) != 3:
+                    return None
+                size = remain = int(header[2])
+                while remain > 0:
+                    buf = proc.stdout.read(min(remain, buffer_size))
+                    if len(buf) == 0:
+                        raise OSError('git cat-file exited unexpectedly')
+                    fd.write(buf)
+                    remain -= len(buf)
+                proc.stdout.read(1)
+                return size
+            except (OSError, ValueError):
+                self.close()
+                raise
+
+    def close(self):
+        proc, self.proc = self.proc, None
+        if proc is not None and proc.poll() is None:
+            try:
+                proc.stdin.close()
+                proc.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                proc.kill()
+
+_batches = {}
+_batches_lock = Lock()
+
+def get_cat_file(config, check: bool = False) -> CatFileBatch:
+    key = (config.git_path, os.path.abspath(config.backup_path), check)
+    with _batches_lock:
+        batch = _batches.get(key)
+        if batch is None:
+            batch = _batches[key] = CatFileBatch(config, check=check)
+        return batch
+
+def close_cat_files():
+    with _batches_lock:
+        for batch in _batches.values():
+            batch.close()
+        _batches.clear()
+
+def count_objects(config) -> dict:
+    """
+    Parse `git count-objects -v`, the sizes are in bytes
+    """
+    ecode, out = run_git_cmd(config, 'count-objects', '-v')
+    if ecode != 0:
+        raise RuntimeError('count-objects error({0}): {1}'.format(ecode, out))
+    res = {}
+    for line in out.splitlines():
+        k, _, v = line.partition(':')
+        try:
+            res[k.strip()] = int(v.strip())
+        except ValueError:
+            continue
+    for k in ('size', 'size-pack', 'size-garbage'):
+        res[k] = res.get(k, 0) * 1024
+    return res
+
+def ls_tree(config, rev: str, paths=()) -> dict:
+    """
+    Return `{path: (mode, oid, size)}` of every blob under `paths` in the tree of `rev`
+    """
+    ecode, out = run_git_cmd(config, 'ls-tree', '-r', '-l', '-z', '--full-tree', rev, '--',
+                             *[p.replace(os.sep, '/') for p in paths])
+    if ecode != 0:
+        raise RuntimeError('ls-tree error({0}): {1}'.format(ecode, out))
+    res = {}
+    for item in out.split('\0'):
+        if len(item) == 0:
+            continue
+        info, _, path = item.partition('\t')
+        mode, type_, oid, size = info.split()
+        if type_ == 'blob':
+            res[path] = (mode, oid, int(size))
+    return res
+
+def resolve_ref(config, ref: str) -> Optional[str]:
+    res = get_cat_file(config, check=True).query(ref)
+    return None if res is None else res[0]
+
+def read_commit(config, rev: str):
+    """
+    Return `(oid, headers, message)` of commit `rev`, or None if it does not exist
+    """
+    res = get_cat_file(config).query(rev + '^{commit}')
+    if res is None:
+        return None
+    oid, _, _, content = res
+    head, _, message = content.decode('utf-8', errors='replace').partition('\n\n')
+    headers = {}
+    for line in head.splitlines():
+        k, _, v = line.partition(' ')
+        headers.setdefault(k, v)
+    return oid, headers, message
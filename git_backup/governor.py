@@ -0,0 +1,128 @@
+import contextlib
+import shutil
+import time
+
+from threading import Lock, local
+
+class RateLimiter:
+    """
+    A token bucket shared by every copy thread: `rate` bytes per second, bursts of at most a quarter second.
+    A thread takes its bytes under the lock and sleeps off the debt outside, so the threads queue up fairly.
+    Each caller passes the rate it is limited to, a thread running at full speed leaves the bucket alone
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.tokens = 0.0
+        self.last = time.monotonic()
+
+    def consume(self, size: int, rate: int):
+        if rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(rate / 4, self.tokens + (now - self.last) * rate)
+            self.last = now
+            self.tokens -= size
+            wait = -self.tokens / rate
+        if wait > 0:
+            time.sleep(wait)
+
+limiter = RateLimiter()
+_throttle: dict = {}
+_tools: dict = {}
+_lag_until = 0.0
+# the restore thread lifts the limits for itself only, see `suspended()`
+_local = local()
+
+def configure(config):
+    """
+    Take the `throttle` settings of `config`, the copies and the git processes started afterwards follow them
+    """
+    global _throttle
+    _throttle = config.throttle
+    for tool in ('nice', 'ionice'):
+        if tool not in _tools:
+            _tools[tool] = shutil.which(tool)
+
+def report_lag():
+    """
+    The server fell behind, back off for `adaptive_cooldown` seconds
+    """
+    global _lag_until
+    if _throttle.get('adaptive', False):
+        _lag_until = time.time() + _throttle.get('adaptive_cooldown', 60)
+
+def is_suspended() -> bool:
+    return getattr(_local, 'suspended', 0) > 0
+
+def lagging() -> bool:
+    return not is_suspended() and time.time() < _lag_until
+
+@contextlib.contextmanager
+def suspended():
+    """
+    Run at full speed inside, for the work done while the server is stopped.
+    It only covers the calling thread, maintenance and pushes running beside it keep their limits
+    """
+    _local.suspended = getattr(_local, 'suspended', 0) + 1
+    try:
+        yield
+    finally:
+        _local.suspended -= 1
+
+def bind(func):
+    """
+    Wrap `func` to run as suspended as the calling thread is, for the work it hands to a thread pool
+    """
+    if not is_suspended():
+        return func
+    def run(*args, **kwargs):
+        with suspended():
+            return func(*args, **kwargs)
+    return run
+
+def copy_rate() -> int:
+    """
+    The byte rate copies are limited to now, 0 is unlimited
+    """
+    if is_suspended():
+        return 0
+    rate = _throttle.get('copy_rate_limit', 0)
+    if lagging():
+        slow = _throttle.get('adaptive_rate', 0)
+        if slow > 0:
+            rate = slow if rate <= 0 else min(rate, slow)
+    return rate
+
+def throttle_io(size: int):
+    limiter.consume(size, copy_rate())
+
+def command_prefix() -> list:
+    """
+    `nice`/`ionice` to run a child process with, while lagging the lowest priorities
+    """
+    if is_suspended():
+        return []
+    nice = _throttle.get('nice', 0)
+    idle = _throttle.get('ionice_idle', False)
+    if lagging():
+        nice, idle = 19, True
+    res = []
+    if nice > 0 and _tools.get('nice'):
+        res += [_tools['nice'], '-n', str(nice)]
+    if idle and _tools.get('ionice'):
+        res += [_tools['ionice'], '-c', '3']
+    return res
+
+def git_config_args() -> list:
+    """
+    `-c` options capping the threads and the delta window memory of the packing git commands
+    """
+    res = []
+    threads = _throttle.get('pack_threads', 0)
+    if threads > 0:
+        res += ['-c', 'pack.threads={}'.format(threads)]
+    memory = _throttle.get('pack_window_memory', '')
+    if memory:
+        res += ['-c', 'pack.windowMemory={}'.format(memory)]
+    return res
@@ -0,0 +1,97 @@
+import mcdreforged.api.all as MCDR
+import time
+
+from threading import Lock
+from git_backup.constants import PLUGIN_ABBR
+from git_backup.git import run_git_cmd, count_objects
+from git_backup.sizes import invalidate_sizes
+from git_backup.timing import OperationTimer, record_operation
+from git_backup.utils import log_info, log_warning, log_except, get_format_time
+
+# held by a maintenance run and by every operation that deletes packs or objects (prune's gc),
+# a repack must never see its packs removed underneath it
+maintenance_lock = Lock()
+# decision, start time, total duration and [(step, duration, exit code), ...] of the last run
+last_maintenance: dict = {}
+
+def _run_step(config, steps: list, name: str, *args):
+    start = time.time()
+    ecode, out = run_git_cmd(config, *args)
+    steps.append((name, time.time() - start, ecode))
+    return ecode, out
+
+def need_full_repack(config, objects: dict) -> str or None:
+    """
+    Return the reason why a full repack is due, or None
+    """
+    cfg = config.maintenance
+    now = time.time()
+    if cfg['full_interval'] > 0 and now - cfg['last_full_time'] >= cfg['full_interval']:
+        return 'interval'
+    if cfg['full_pack_count'] > 0 and objects.get('packs', 0) >= cfg['full_pack_count']:
+        return 'packs {}'.format(objects.get('packs', 0))
+    last_size = cfg['last_full_size']
+    if cfg['full_size_growth'] > 0 and last_size > 0 and \
+            objects.get('size-pack', 0) + objects.get('size', 0) >= last_size * cfg['full_size_growth']:
+        return 'size growth'
+    return None
+
+def run_maintenance(config, logger=None):
+    steps = []
+    start = time.time()
+    objects = count_objects(config)
+    reason = need_full_repack(config, objects)
+    if reason is not None:
+        decision = 'full ({})'.format(reason)
+        ecode, out = _run_step(config, steps, 'gc', 'gc', '--quiet')
+        if ecode != 0:
+            log_warning(logger, f'[{PLUGIN_ABBR}] git gc failed: {out}')
+        else:
+            objects = count_objects(config)
+            config.maintenance['last_full_time'] = time.time()
+            config.maintenance['last_full_size'] = objects.get('size-pack', 0) + objects.get('size', 0)
+    else:
+        decision = 'incremental'
+        # --geometric needs git 2.33, older git packs the loose objects into a new pack instead
+        ecode, _ = _run_step(config, steps, 'repack', 'repack', '-d', '-q', '--geometric=2', '--write-midx')
+        if ecode != 0:
+            _run_step(config, steps, 'repack', 'repack', '-d', '-q')
+            _run_step(config, steps, 'multi-pack-index', 'multi-pack-index', 'write')
+        _run_step(config, steps, 'commit-graph', 'commit-graph', 'write', '--reachable', '--split')
+    invalidate_sizes()
+    last_maintenance.clear()
+    last_maintenance.update(decision=decision, time=start, duration=time.time() - start, steps=steps)
+    timer = OperationTimer('maintenance')
+    timer.start_time = start
+    for name, dur, _ in steps:
+        timer.add_phase(name, dur)
+    # the failed --geometric repack of an old git is retried, only the last step of a kind counts
+    record_operation(config, timer, all(ecode == 0 for ecode in {name: ecode for name, _, ecode in steps}.values()))
+    log_info(logger, f'[{PLUGIN_ABBR}] maintenance {format_maintenance()}')
+
+@MCDR.new_thread(f'{PLUGIN_ABBR} - maintenance')
+def schedule_maintenance(config, logger=None):
+    """
+    Run the repository maintenance in the background, skipped if a previous run is still going.
+    It runs outside the operation lock: a backup, a restore, a push or a list may run beside it, they only add
+    objects or read them, and git repacks safely while objects are added. Only what holds `maintenance_lock` waits for it
+    """
+    if not config.maintenance['enabled']:
+        return
+    if not maintenance_lock.acquire(blocking=False):
+        log_info(logger, f'[{PLUGIN_ABBR}] maintenance is already running, skipped')
+        return
+    try:
+        run_maintenance(config, logger=logger)
+    except Exception as e:
+        log_except(logger, f'[{PLUGIN_ABBR}] maintenance error: {e}')
+    finally:
+        maintenance_lock.release()
+
+def format_maintenance() -> str or None:
+    if len(last_maintenance) == 0:
+        return None
+    return '{0} at {1}, took {2:.1f}s ({3})'.format(
+        last_maintenance['decision'], get_format_time(last_maintenance['time']), last_maintenance['duration'],
+        ', '.join('{0} {1:.1f}s{2}'.format(name, dur, '' if ecode == 0 else ' failed')
+                  for name, dur, ecode in last_maintenance['steps']))
@@ -0,0 +1,55 @@
+import os
+import json
+
+from git_backup.constants import MANIFEST_FILE
+from git_backup.utils import get_metadata_path
+
+class Manifest:
+    """
+    Stat data of the files last synced from `server_path`,
+    keyed by the '/' separated path relative to `server_path`.
+    `head` is the commit whose tree holds exactly these files, if known
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.head = None
+        self.entries = {}
+
+    def load(self):
+        self.head = None
+        self.entries = {}
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'r') as fd:
+                    data = json.load(fd)
+                self.head = data.get('head')
+                self.entries = data.get('entries', {})
+            except (ValueError, AttributeError):
+                self.head = None
+                self.entries = {}
+        return self
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fd:
+            json.dump({'head': self.head, 'entries': self.entries}, fd, separators=(',', ':'))
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        self.head = None
+        self.entries = {}
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def match(self, rel: str, st: os.stat_result) -> bool:
+        ent = self.entries.get(rel)
+        return ent is not None and ent[0] == st.st_size and ent[1] == st.st_mtime_ns
+
+    def update_prefix(self, prefix: str, entries: dict):
+        sub = prefix + '/'
+        for rel in [rel for rel in self.entries if rel == prefix or rel.startswith(sub)]:
+            del self.entries[rel]
+        self.entries.update(entries)
+
+def load_manifest(config) -> Manifest:
+    return Manifest(get_metadata_path(config, MANIFEST_FILE)).load()
@@ -1,16 +1,34 @@
 import mcdreforged.api.all as MCDR
+import fnmatch
 import functools
-import time
 import os
+import time
 
 from typing import Callable, Optional, Any
-from git_backup import common as GL
-from git_backup.constants import (Prefix, PLUGIN_ABBR,
+from git_backup import common as GL, governor
+from git_backup.constants import (Prefix, PLUGIN_ABBR, PRE_RESTORE_REF, SNAPSHOT_DIR,
                                   BACKUP_DONE_EVENT, RESTORE_DONE_EVENT)
-from git_backup.git import run_git_cmd
+from git_backup.git import run_git_cmd, read_commit, resolve_ref, count_objects
+from git_backup.fast_import import fast_import_commit
+from git_backup.export import export_slot, export_name
+from git_backup.chunk_filter import measure_region_filter
+from git_backup.backup_timer import get_schedules
+from git_backup.backup_index import get_index, record_backup, truncate_index, parse_subject
+from git_backup.maintenance import schedule_maintenance, format_maintenance, maintenance_lock
+from git_backup.manifest import load_manifest
+from git_backup.region_index import index_backup, find_changes, backfill_region_index
+from git_backup.push_worker import (PushWorker, PushGate, get_remotes, get_last_push_time, push_due,
+                                    remote_lag, remote_key)
+from git_backup.shared_store import store_path, instance_name, consolidate
+from git_backup.shards import list_shards, rollover_due, seal_shard, graft_sealed
+from git_backup.sizes import get_sizes, set_worktree_size, invalidate_sizes
+from git_backup.restore import diff_restore, partial_restore
+from git_backup.retention import plan_retention, estimate_reclaim, apply_retention
+from git_backup.sync import SyncStats, sync_files, copy_files, walk_files
+from git_backup.timing import OperationTimer, record_operation, summarize
 from git_backup.utils import (debug_message, tr, log_info, log_except, print_message,
-                              mkdir, copy_files, rmtree, get_format_time,
-                              get_dir_size, format_dir_size)
+                              mkdir, get_format_time, parse_format_time, get_metadata_path,
+                              format_dir_size)
 
 def single_op(name: MCDR.RTextBase):
     def wrapper(func: Callable):
@@ -28,44 +46,88 @@ def single_op(name: MCDR.RTextBase):
     return wrapper
 
 @single_op(tr('operations.create'))
-def create_backup(source: MCDR.CommandSource, comment: Optional[str], config, logger=None):
-    comment = ('"{date}"' if comment is None else '"{date}={comment}"').format(
+def create_backup(source: MCDR.CommandSource, comment: Optional[str], config, logger=None, group: dict = None):
+    """
+    Back up `need_backup`, or with a schedule `group` a commit touching only the paths of the group
+    """
+    if comment is None and group is not None:
+        comment = group['name']
+    comment = ('{date}' if comment is None else '{date}={comment}').format(
         date=get_format_time(), comment=comment)
+    paths = None if group is None else group['paths']
+    timer = OperationTimer('create')
+    success = False
+    save_off_time = None
+
+    def resume_saving():
+        nonlocal save_off_time
+        if save_off_time is None:
+            return
+        source.get_server().execute('save-on')
+        elapsed = time.time() - save_off_time
+        save_off_time = None
+        timer.add_phase('save_off', elapsed)
+        print_message(source, tr('create_backup.save_resumed', round(elapsed, 1)), tell=False)
+
     try:
-        GL.game_saved = False
+        GL.game_saved.clear()
         if config.turn_off_auto_save:
             source.get_server().execute('save-off')
-        source.get_server().execute('save-all flush')
-        while not GL.game_saved:
-            time.sleep(0.01)
-            if GL.plugin_unloaded:
-                print_message(source, tr('create_backup.abort.plugin_unload'), tell=False)
-                raise InterruptedError('InterruptedError')
+            save_off_time = time.time()
+        with timer.phase('save_wait'):
+            source.get_server().execute('save-all flush')
+            saved = GL.game_saved.wait(config.save_timeout if config.save_timeout > 0 else None)
+        saved_time = time.time()
+        if GL.plugin_unloaded:
+            print_message(source, tr('create_backup.abort.plugin_unload'), tell=False)
+            raise InterruptedError('InterruptedError')
+        if not saved:
+            print_message(source, tr('create_backup.abort.save_timeout', config.save_timeout), tell=False)
+            raise InterruptedError('No save message in {} seconds'.format(config.save_timeout))
 
         # start backup
         print_message(source, tr('create_backup.start'), tell=False)
         start_time = time.time()
-
-        mkdir(config.backup_path)
-        for file in config.need_backup:
-            copy_files(config.server_path, config.backup_path, file, config.ignores,
-                       logger=logger)
-        print_message(source, tr('create_backup.commit'), tell=False)
-        run_git_cmd(config, 'add', '--all')
-        ecode, out = run_git_cmd(config, 'commit', '-m', comment)
-        if ecode != 0:
-            print_message(source, '[git] failed to commit')
-            raise RuntimeError(f'{out}')
-
-        ecode, out = run_git_cmd(config, 'gc')
-        if ecode != 0:
-            print_message(source, '[git] failed to gc ')
-            raise RuntimeError(f'{out}')
+        store_size = get_sizes(config)[1]
+
+        # the copy the commit was made from, its region headers tell the chunks that changed
+        snapshot_path = config.backup_path
+        if config.backup_engine == 'fast_import':
+            snapshot_path = None
+            if config.snapshot_backup:
+                with timer.phase('snapshot'):
+                    snapshot_path = snapshot_world(config, paths=paths, logger=logger)
+                resume_saving()
+            print_message(source, tr('create_backup.commit'), tell=False)
+            with timer.phase('fast_import'):
+                stats = fast_import_commit(config, comment, load_manifest(config), paths=paths,
+                                           source_path=snapshot_path, logger=logger)
+            log_info(logger, f'Backup fast-import: {stats}')
+            invalidate_sizes()
+            print_message(source, tr('create_backup.streamed', stats.files_copied, stats.files_deleted,
+                                     format_dir_size(stats.bytes_copied), stats.throughput()), tell=False)
+        else:
+            # the copy in the working tree is the snapshot, git reads only that
+            stats = copy_and_commit(source, comment, config, logger=logger, timer=timer, paths=paths,
+                                    after_copy=resume_saving if config.snapshot_backup else None)
+        timer.add_io(stats.bytes_copied, stats.files_copied + stats.files_deleted)
+        with timer.phase('index'):
+            record_backup(config, changed_bytes=stats.bytes_copied, size_delta=get_sizes(config)[1] - store_size)
+            try:
+                index_backup(config, resolve_ref(config, 'HEAD'), saved_time, paths=paths, source_path=snapshot_path)
+            except Exception as e:
+                # the backup is made, `find backfill` indexes it later
+                log_except(logger, f'[{PLUGIN_ABBR}] Error indexing the region files: {e}')
 
         # done
         end_time = time.time()
         print_message(source, tr('create_backup.success', round(end_time - start_time, 1)), tell=False)
-        
+        if group is None:
+            GL.players_active = len(GL.online_players) > 0
+            # a full backup holds the paths of every group too
+            for g in config.schedules:
+                g['last_backup_time'] = end_time
+        success = True
     except InterruptedError as e:
         log_except(logger, f'[{PLUGIN_ABBR}] {e}')
     except Exception as e:
@@ -73,30 +135,208 @@ def create_backup(source: MCDR.CommandSource, comment: Optional[str], config, lo
         print_message(source, tr('create_backup.fail'), tell=False)
     else:
         source.get_server().dispatch_event(BACKUP_DONE_EVENT, (source,))
+        schedule_maintenance(config, logger=logger)
     finally:
-        if config.turn_off_auto_save:
-            source.get_server().execute('save-on')
-        config.last_backup_time = time.time()
-
-@single_op(tr('operations.push'))
-def push_backup(source: MCDR.CommandSource, config, logger=None):
-    if not config.git_cfg['use_remote']:
-        print_message(source, 'Not allowed remote', tell=False)
+        resume_saving()
+        if group is None:
+            config.last_backup_time = time.time()
+        else:
+            group['last_backup_time'] = time.time()
+        _record_timer(config, timer, success, logger=logger)
+
+def check_backup_needed(config, paths: list = None) -> Optional[MCDR.RTextBase]:
+    """
+    Return why a scheduled backup of `paths` (default `need_backup`) can be skipped, None if it has to run.
+    The stat data of the files is compared with the manifest of the last backup,
+    changes of the files matching `precheck_ignores` alone do not count
+    """
+    if paths is None:
+        paths = config.need_backup
+    if config.skip_if_no_players and not GL.players_active:
+        return tr('create_backup.skip.no_players')
+    if not config.precheck:
+        return None
+    manifest = load_manifest(config)
+    if manifest.head is None or manifest.head != resolve_ref(config, 'HEAD'):
+        return None
+    prefixes = [file.replace(os.sep, '/') for file in paths]
+    entries = [rel for rel in manifest.entries if any(rel == p or rel.startswith(p + '/') for p in prefixes)]
+    seen = 0
+    for file in paths:
+        for rel, _, st in walk_files(config.server_path, file, config.ignores):
+            name = rel.rsplit('/', 1)[-1]
+            if any(fnmatch.fnmatch(name, pattern) for pattern in config.precheck_ignores):
+                seen += rel in manifest.entries
+                continue
+            if not manifest.match(rel, st):
+                return None
+            seen += 1
+    if seen != len(entries):
+        # a file was deleted
+        return None
+    return tr('create_backup.skip.unchanged')
+
+def _record_timer(config, timer: OperationTimer, success: bool, logger=None):
+    try:
+        record = record_operation(config, timer, success)
+    except Exception as e:
+        log_except(logger, f'[{PLUGIN_ABBR}] Error recording timing: {e}')
         return
-    print_message(source, tr('push_backup.push'), tell=False)
-    ecode, out = run_git_cmd(config, 'push', '-f', '-q')
+    debug_message(config.debug, 'timing', record)
+
+def snapshot_world(config, paths: list = None, logger=None) -> str:
+    """
+    Mirror `paths` (default `need_backup`) into a snapshot directory kept between backups, so only the files changed
+    since the last backup are copied (cloned where the file system supports reflinks).
+    Return the directory, it stands in for `server_path` once saving is back on
+    """
+    path = get_metadata_path(config, SNAPSHOT_DIR)
+    stats = SyncStats()
+    for file in paths or config.need_backup:
+        sync_files(config.server_path, path, file, config.ignores, region_patch=config.region_patch,
+                   threads=config.copy_threads, split_size=config.copy_split_size, stats=stats,
+                   reflink=config.reflink, logger=logger)
+    log_info(logger, f'Backup snapshot: {stats.finish()}')
+    return path
+
+def copy_and_commit(source: MCDR.CommandSource, comment: str, config, logger=None,
+                    timer: OperationTimer = None, paths: list = None, after_copy: Callable = None):
+    timer = timer or OperationTimer('create')
+    scoped = paths is not None
+    if paths is None:
+        paths = config.need_backup
+    mkdir(config.backup_path)
+    stats = SyncStats()
+    manifest = None
+    with timer.phase('copy'):
+        if config.incremental_copy:
+            manifest = load_manifest(config) if config.sync_manifest else None
+            for file in paths:
+                sync_files(config.server_path, config.backup_path, file, config.ignores,
+                           manifest=manifest, region_patch=config.region_patch,
+                           threads=config.copy_threads, split_size=config.copy_split_size,
+                           stats=stats, reflink=config.reflink, logger=logger)
+            if manifest is not None:
+                manifest.head = None
+                manifest.save()
+        else:
+            for file in paths:
+                copy_files(config.server_path, config.backup_path, file, config.ignores,
+                           threads=config.copy_threads, split_size=config.copy_split_size,
+                           stats=stats, logger=logger)
+    log_info(logger, f'Backup copy: {stats.finish()}')
+    if after_copy is not None:
+        after_copy()
+    print_message(source, tr('create_backup.synced', stats.files_copied, stats.files_deleted,
+                             stats.regions_patched, stats.chunks_changed, stats.throughput()), tell=False)
+    print_message(source, tr('create_backup.commit'), tell=False)
+    with timer.phase('add'):
+        run_git_cmd(config, 'add', '--all', *(['--'] + paths if scoped else []))
+    with timer.phase('commit'):
+        ecode, out = run_git_cmd(config, 'commit', '-m', comment)
     if ecode != 0:
-        print_message(source, tr('push_backup.fail', ecode), tell=False)
-        log_except(logger, f'[{PLUGIN_ABBR}] Pushing error: {out}')
+        print_message(source, '[git] failed to commit')
+        raise RuntimeError(f'{out}')
+    if manifest is not None:
+        manifest.head = resolve_ref(config, 'HEAD')
+        manifest.save()
+    if not scoped:
+        set_worktree_size(config, stats.bytes_total)
+    invalidate_sizes()
+    return stats
+
+def _on_push_done(remote: dict, ok: bool, requesters: list, error: str):
+    for source in requesters:
+        if ok:
+            print_message(source, tr('push_backup.success', remote['name']), tell=False)
+        else:
+            print_message(source, tr('push_backup.fail', remote['name'], error), tell=False)
+
+def get_push_worker(config, remote: dict, logger=None) -> PushWorker:
+    """
+    The push worker of `remote`, the workers of all the remotes share one gate
+    so at most `push_concurrency` of them push at once
+    """
+    if GL.push_gate is None:
+        GL.push_gate = PushGate(config.push_concurrency)
+    worker = GL.push_workers.get(remote['name'])
+    if worker is not None and remote_key(worker.remote) == remote_key(remote):
+        # the same remote, the dict may be a new one (the legacy remote, a reloaded config) holding the push times
+        worker.remote = remote
+        return worker
+    old = worker
+    worker = GL.push_workers[remote['name']] = PushWorker(
+        config, remote, GL.push_gate, logger=logger, on_done=_on_push_done)
+    if old is not None:
+        # the push running finishes on the old settings, the one queued moves to the new worker
+        pending = old.pending
+        requesters = old.stop(kill=False)
+        for source in requesters:
+            worker.request(source)
+        if pending:
+            worker.request()
+    return worker
+
+def stop_push_workers():
+    for worker in GL.push_workers.values():
+        worker.stop()
+    GL.push_workers.clear()
+    GL.push_gate = None
+
+def push_backup(source: MCDR.CommandSource, config, name: str = None, due_only: bool = False, logger=None):
+    """
+    Queue a push of every remote, or only of the remote `name`, on their push workers.
+    With `due_only`, only the remotes whose push interval has passed.
+    It does not take the operation lock
+    """
+    remotes = get_remotes(config)
+    if len(remotes) == 0:
+        print_message(source, 'Not allowed remote', tell=False)
         return
-
-    config.last_push_time = time.time()
-    print_message(source, tr('push_backup.success'), tell=False)
+    if name is not None:
+        remotes = [r for r in remotes if r['name'] == name]
+        if len(remotes) == 0:
+            print_message(source, tr('push_backup.unknown_remote', name), tell=False)
+            return
+    if due_only:
+        now = time.time()
+        remotes = [r for r in remotes if push_due(config, r, now)]
+    for remote in remotes:
+        if get_push_worker(config, remote, logger=logger).request(source):
+            print_message(source, tr('push_backup.push', remote['name']), tell=False)
+        else:
+            print_message(source, tr('push_backup.merged', remote['name']), tell=False)
+
+def format_push_state(config, remote: dict) -> MCDR.RTextBase:
+    last_push_time = get_last_push_time(config, remote)
+    last = tr('push_status.never') if last_push_time <= 0 else get_format_time(last_push_time)
+    lag = remote_lag(config, remote)
+    last = tr('push_status.last', last, '?' if lag is None else lag)
+    worker = GL.push_workers.get(remote['name'])
+    state, info = ('idle', None) if worker is None else worker.state()
+    name = remote['name']
+    if state == 'pushing':
+        if info is None or info.phase is None:
+            return tr('push_status.starting', name, last)
+        eta = info.eta()
+        return tr('push_status.pushing', name, info.phase, info.percent, info.transferred or '-', info.rate or '-',
+                  '-' if eta is None else f'{eta:.0f}', last)
+    if state == 'retry':
+        error = (worker.last_error or '').strip().splitlines()
+        return tr('push_status.retry', name, worker.attempt, f'{info:.0f}', error[0] if len(error) > 0 else '-', last)
+    if state == 'queued':
+        return tr('push_status.queued', name, last)
+    return tr('push_status.idle', name, last)
 
 @single_op(tr('operations.restore'))
-def restore_backup(source: MCDR.CommandSource, slot_info: tuple, config, logger=None):
+def restore_backup(source: MCDR.CommandSource, slot_info: tuple, config, logger=None, spec: str = None):
+    """
+    Restore the world to a slot, or with `spec` only the files it selects (see `parse_restore_spec`)
+    """
     back_wait_time = config.back_wait_time
     slot = None
+    timer = OperationTimer('restore')
+    success = False
     try:
         slot, date, comment = slot_info
         print_message(source, tr('do_restore.countdown.intro', back_wait_time), tell=False)
@@ -111,65 +351,182 @@ def restore_backup(source: MCDR.CommandSource, slot_info: tuple, config, logger=
                 if GL.abort_restore:
                     print_message(source, tr('do_restore.abort'), tell=False)
                     return
-
-        source.get_server().stop()
-        log_info(logger, 'Wait for server to stop')
-        source.get_server().wait_for_start()
-
-        log_info(logger, 'Backup current world to avoid idiot')
-        rmtree(config.cache_path)
-        mkdir(config.cache_path)
-        for file in config.need_backup:
-            copy_files(config.server_path, config.cache_path, file, config.ignores,
-                       logger=logger)
-        with open(os.path.join(config.cache_path, 'info.txt'), 'w') as f:
-            f.write('Overwrite time: {}\n'.format(get_format_time()))
-            f.write('Confirmed by: {}'.format(source))
-
-        ecode, out = run_git_cmd(config, 'clean', '-df')
-        if ecode != 0:
-            print_message(source, '[git] failed to clean -df')
-            raise RuntimeError(f'{out}')
-        ecode, out = run_git_cmd(config, 'reset', '--hard', slot)
-        log_info(logger, f'{out}')
-        if ecode == 0:
-            # if os.path.exists(config.cache_path):
-            # 	rmtree(config.cache_path)
-            for file in config.need_backup:
-                if file in ('.gitignore', '.git'):
-                    continue
-                copy_files(config.backup_path, config.server_path, file, config.ignores,
-                           logger=logger)
-            log_info(logger, f'Backup to {date}({comment})')
-
-        log_info(logger, 'Starting server')
-        source.get_server().start()
+        # the countdown is not part of the restore
+        timer = OperationTimer('restore')
+
+        # the server is stopped, the restore does not need to leave it room
+        with governor.suspended():
+            with timer.phase('stop'):
+                source.get_server().stop()
+                log_info(logger, 'Wait for server to stop')
+                source.get_server().wait_for_start()
+
+            log_info(logger, 'Backup current world to avoid idiot')
+            with timer.phase('snapshot'):
+                snapshot_before_restore(source, config, slot if spec is None else '{} {}'.format(slot, spec),
+                                        logger=logger)
+
+            # a slot of a sealed shard is committed again on top of the branch instead of rewinding it
+            sealed = get_index(config).is_sealed(slot)
+            target = slot
+
+            manifest = load_manifest(config)
+            stats = None
+            if spec is not None:
+                # the branch stays where it is, the next backup records the restored files
+                with timer.phase('restore'):
+                    stats = partial_restore(config, slot, spec, manifest, logger=logger)
+                print_message(source, tr('restore_backup.partial', spec, stats.files_copied, stats.files_deleted,
+                                         format_dir_size(stats.bytes_copied)), tell=False)
+                log_info(logger, f'Restored {spec} to {date}({comment})')
+            elif config.differential_restore:
+                with timer.phase('restore'):
+                    stats = diff_restore(config, slot, manifest, logger=logger)
+                if stats is not None:
+                    # the working tree is left alone, the index keeps the stat data of unchanged entries
+                    with timer.phase('reset'):
+                        if sealed:
+                            target = graft_sealed(config, slot, comment)
+                        ecode, out = run_git_cmd(config, 'reset', '-q', '--mixed', target)
+                    if ecode != 0:
+                        print_message(source, '[git] failed to reset')
+                        raise RuntimeError(f'{out}')
+                    truncate_index(config, target)
+                    if config.backup_engine == 'fast_import':
+                        manifest.entries = {}
+                        for file in config.need_backup:
+                            for rel, _, st in walk_files(config.server_path, file, config.ignores):
+                                manifest.entries[rel] = [st.st_size, st.st_mtime_ns]
+                        manifest.head = resolve_ref(config, 'HEAD')
+                        manifest.save()
+                    else:
+                        manifest.clear()
+                    invalidate_sizes()
+                    print_message(source, tr('restore_backup.diff', stats.files_copied, stats.files_deleted,
+                                             format_dir_size(stats.bytes_copied), format_dir_size(stats.bytes_skipped)),
+                                  tell=False)
+                    log_info(logger, f'Backup to {date}({comment})')
+                else:
+                    log_info(logger, 'Slot contains symbolic links, restoring it as a whole')
+
+            if stats is None:
+                manifest.clear()
+                with timer.phase('reset'):
+                    ecode, out = run_git_cmd(config, 'clean', '-df')
+                    if ecode != 0:
+                        print_message(source, '[git] failed to clean -df')
+                        raise RuntimeError(f'{out}')
+                    if sealed:
+                        target = graft_sealed(config, slot, comment)
+                    ecode, out = run_git_cmd(config, 'reset', '--hard', target)
+                log_info(logger, f'{out}')
+                if ecode == 0:
+                    truncate_index(config, target)
+                    stats = SyncStats()
+                    with timer.phase('restore'):
+                        for file in config.need_backup:
+                            if file in ('.gitignore', '.git'):
+                                continue
+                            copy_files(config.backup_path, config.server_path, file, config.ignores,
+                                       threads=config.copy_threads, split_size=config.copy_split_size,
+                                       stats=stats, logger=logger)
+                    log_info(logger, f'Restore copy: {stats.finish()}')
+                    set_worktree_size(config, stats.bytes_total)
+                    invalidate_sizes()
+                    log_info(logger, f'Backup to {date}({comment})')
+
+            if stats is not None:
+                timer.add_io(stats.bytes_copied, stats.files_copied + stats.files_deleted)
+            log_info(logger, 'Starting server')
+        with timer.phase('start'):
+            source.get_server().start()
+        success = stats is not None
     except Exception as e:
         log_except(logger, f'triggered by {source}\n{e}')
         print_message(source, tr('restore_backup.fail', slot), tell=False)
     else:
         source.get_server().dispatch_event(RESTORE_DONE_EVENT,
                                            (source, slot, date, comment))
+    finally:
+        if 'stop' in timer.phases:
+            _record_timer(config, timer, success, logger=logger)
 
-def list_backup(source: MCDR.CommandSource, config, limit: int = None):
-    ecode, out = run_git_cmd(config, 'log', '--pretty=oneline', '--no-decorate', '' if limit is None else '-{}'.format(limit))
+def snapshot_before_restore(source: MCDR.CommandSource, config, slot: str, logger=None) -> str:
+    """
+    Record the current world as a commit under `PRE_RESTORE_REF`, keeping the latest `pre_restore_keep` ones
+    """
+    now = time.time()
+    base = ref = '{}/{}'.format(PRE_RESTORE_REF, time.strftime('%Y%m%d-%H%M%S', time.localtime(now)))
+    # two restores within the same second would reuse the name and fast-import refuses non fast-forward
+    # updates, so take the next free suffix; it sorts after the bare name like a later time does
+    n = 0
+    while run_git_cmd(config, 'rev-parse', '--verify', '-q', ref)[0] == 0:
+        n += 1
+        ref = '{}.{:02d}'.format(base, n)
+    message = '{}=Pre-restore snapshot\n\nOverwrite time: {}\nConfirmed by: {}\nRestoring to: {}\n'.format(
+        get_format_time(now), get_format_time(now), source, slot)
+    stats = fast_import_commit(config, message, load_manifest(config), ref=ref, allow_empty=True, logger=logger)
+    log_info(logger, f'Pre-restore snapshot {ref}: {stats}')
+    snapshots = list_snapshots(config)
+    for oid, refname, _, _ in snapshots[max(0, config.pre_restore_keep):]:
+        run_git_cmd(config, 'update-ref', '-d', refname)
+    return resolve_ref(config, ref)
+
+def list_snapshots(config):
+    """
+    Return `[(oid, ref, date, comment), ...]` of the pre-restore snapshots, latest first
+    """
+    ecode, out = run_git_cmd(config, 'for-each-ref', '--sort=-refname',
+                             '--format=%(objectname) %(refname) %(contents:subject)', PRE_RESTORE_REF + '/')
     if ecode != 0:
-        print_message(source, out)
+        raise RuntimeError('for-each-ref error({0}): {1}'.format(ecode, out))
+    res = []
+    for line in out.splitlines():
+        oid, ref, subject = (line.split(' ', 2) + [''])[:3]
+        res.append((oid, ref) + parse_subject(subject))
+    return res
+
+def list_pre_restore(source: MCDR.CommandSource, config):
+    print_message(source, tr('list_backup.pre_restore_title'), prefix='')
+    for i, (oid, _, date, comment) in enumerate(list_snapshots(config)):
+        slot = oid[:10]
+        print_message(source, MCDR.RTextList(
+            MCDR.RText(tr('list_backup.slot.header', 'pre:{}'.format(i + 1))),
+            ' ',
+            format_slot_info(slot, date, comment),
+            command_run(
+                MCDR.RText('[▷] ', color=MCDR.RColor.green),
+                tr('list_backup.slot.restore', slot),
+                f'{Prefix} back {slot}'
+            )
+        ), prefix='')
+
+def list_backup(source: MCDR.CommandSource, config, page: int = 1, keyword: str = None,
+                since: str = None, until: str = None):
+    try:
+        since_time = None if since is None else parse_format_time(since)
+        until_time = None if until is None else parse_format_time(until, end=True)
+    except ValueError:
+        print_message(source, tr('list_backup.wrong_date'))
         return
-    lines = out.splitlines()
+    index = get_index(config)
+    entries = index.query(keyword=keyword, since=since_time, until=until_time)
+    page_size = max(1, config.list_page_size)
+    pages = max(1, (len(entries) + page_size - 1) // page_size)
+    page = min(max(1, page), pages)
 
     print_message(source, tr('list_backup.title'), prefix='')
 
-    backup_size = get_dir_size(config.backup_path)
+    backup_size = sum(get_sizes(config))
 
-    latest = None
-    debug_message(config.debug, 'whiling lines', len(lines))
-    for i, l in enumerate(lines):
-        debug_message(config.debug, 'parsing line:', i, ':', l)
-        slot_idx = i + 1
-        slot, date, comment = parse_backup_info(l)
-        slot = slot[:10]
-        slot_info = format_slot_info(slot, date, comment)
+    debug_message(config.debug, 'listing page', page, 'of', len(entries), 'entries')
+    for ent in entries[(page - 1) * page_size:page * page_size]:
+        slot_idx = index.index_of(ent)
+        slot = ent['hash'][:10]
+        slot_info = format_slot_info(slot, ent['date'], ent['comment'])
+        if ent['changed_bytes'] is not None:
+            slot_info.set_hover_text(tr('list_backup.slot.detail', format_dir_size(ent['changed_bytes']),
+                                        format_dir_size(ent['size_delta'] or 0)))
         # noinspection PyTypeChecker
         header = MCDR.RTextList(
             MCDR.RText(tr('list_backup.slot.header', slot_idx)),
@@ -183,41 +540,239 @@ def list_backup(source: MCDR.CommandSource, config, limit: int = None):
                 f'{Prefix} back {slot}'
             )
         )
-        if i == 0:
-            latest = text
-
-        text = header + text
-        print_message(source, text, prefix='')
+        print_message(source, header + text, prefix='')
+    latest = index.by_index(1)
     if latest is not None:
+        slot = latest['hash'][:10]
         latest = MCDR.RTextList(
             MCDR.RText(tr('list_backup.slot.header', 'latest')),
             ' ',
-            latest
+            format_slot_info(slot, latest['date'], latest['comment']),
+            command_run(
+                MCDR.RText('[▷] ', color=MCDR.RColor.green),
+                tr('list_backup.slot.restore', slot),
+                f'{Prefix} back {slot}'
+            )
         )
         print_message(source, latest, prefix='')
 
+    print_message(source, tr('list_backup.page', page, pages, len(entries)), prefix='')
     print_message(source, tr('list_backup.total_space', format_dir_size(backup_size)), prefix='')
 
+def find_region(source: MCDR.CommandSource, config, x: int, z: int, dimension: str = None):
+    """
+    List the backups that changed the chunk holding block `x` `z`, each with a restore of its region file
+    """
+    hits, indexed, total = find_changes(config, x, z, dimension)
+    index = get_index(config)
+    rx, rz = x >> 9, z >> 9
+    print_message(source, tr('find_region.title', x, z, f'r.{rx}.{rz}.mca', x >> 4, z >> 4), prefix='')
+    page_size = max(1, config.list_page_size)
+    for ent, dim, exact in hits[:page_size]:
+        slot = ent['hash'][:10]
+        spec = f'{dim}:{rx},{rz}'
+        # noinspection PyTypeChecker
+        text = MCDR.RTextList(
+            MCDR.RText(tr('list_backup.slot.header', index.index_of(ent))),
+            ' ',
+            format_slot_info(slot, ent['date'], ent['comment']),
+            ' ',
+            MCDR.RText(dim or '.', color=MCDR.RColor.aqua).set_hover_text(
+                tr('find_region.chunk' if exact else 'find_region.region')),
+            ' ',
+            command_run(
+                MCDR.RText('[▷] ', color=MCDR.RColor.green),
+                tr('find_region.restore', spec, slot),
+                f'{Prefix} back {slot} {spec}'
+            )
+        )
+        print_message(source, text, prefix='')
+    print_message(source, tr('find_region.count', len(hits), min(len(hits), page_size)), prefix='')
+    if indexed < total:
+        print_message(source, command_run(tr('find_region.partial', indexed, total, Prefix),
+                                          tr('find_region.backfill_hover'), f'{Prefix} find backfill'), prefix='')
+
+def backfill_index(source: MCDR.CommandSource, config, logger=None):
+    """
+    Index the region files of the backups made before the region index, next to the other operations:
+    it only reads the history
+    """
+    print_message(source, tr('find_region.backfill.start'), tell=False)
+    start_time = time.time()
+    try:
+        count = backfill_region_index(config, logger=logger)
+    except Exception as e:
+        log_except(logger, f'[{PLUGIN_ABBR}] Error backfilling the region index: {e}')
+        print_message(source, tr('find_region.backfill.fail'), tell=False)
+        return
+    if count is None:
+        print_message(source, tr('find_region.backfill.running'), tell=False)
+    else:
+        print_message(source, tr('find_region.backfill.success', count, round(time.time() - start_time, 1)), tell=False)
+
+def export_backup(source: MCDR.CommandSource, config, bid: str, fmt: str = None, logger=None):
+    """
+    Export slot `bid` (`:<index>`, a hash or `pre:<index>`) as an archive, next to the other operations:
+    it only reads the object store
+    """
+    try:
+        slot, date, _ = get_backup_info(config, int(bid[1:]) if bid.startswith(':') else bid)
+    except Exception as e:
+        log_except(logger, f'[{PLUGIN_ABBR}] {e}')
+        print_message(source, tr('restore_backup.get_info.fail'), tell=False)
+        return
+    fmt = fmt or config.export['format']
+    print_message(source, tr('export_backup.start', slot[:10], fmt), tell=False)
+    start_time = time.time()
+    try:
+        res = export_slot(config, slot, export_name(slot, date), fmt, logger=logger)
+    except Exception as e:
+        log_except(logger, f'[{PLUGIN_ABBR}] Error exporting {slot}: {e}')
+        print_message(source, tr('export_backup.fail', slot[:10], e), tell=False)
+        return
+    if res is None:
+        print_message(source, tr('export_backup.running'), tell=False)
+    else:
+        print_message(source, tr('export_backup.success', slot[:10], res[0], format_dir_size(res[1]),
+                                 round(time.time() - start_time, 1)), tell=False)
+
 @single_op(tr('operations.prune'))
-def prune_backup(source: MCDR.CommandSource, config, logger=None):
+def prune_backup(source: MCDR.CommandSource, config, dry_run: bool = False, logger=None):
+    """
+    Thin the backups by the retention policy when it is enabled, then drop the unreachable objects.
+    A dry run only reports what the retention policy would drop and the estimated space it frees
+    """
+    if dry_run:
+        try:
+            plan = plan_retention(config)
+            estimated = estimate_reclaim(config, plan)
+        except Exception as e:
+            log_except(logger, e)
+            print_message(source, tr('prune_backup.fail'), tell=False)
+            return
+        print_message(source, tr('prune_backup.dry_run', len(plan.kept), len(plan.dropped),
+                                 format_dir_size(estimated)), tell=False)
+        for ent in plan.dropped[:config.list_page_size]:
+            print_message(source, format_slot_info(ent['hash'][:10], ent['date'], ent['comment']),
+                          tell=False, prefix='')
+        return
+
+    timer = OperationTimer('prune')
+    success = False
     try:
         print_message(source, tr('prune_backup.start'), tell=False)
-
-        ecode, out = run_git_cmd(config, 'reflog', 'expire --expire-unreachable=now --all')
-        if ecode != 0:
-            print_message(source, '[git] failed to expire reflog')
-            raise RuntimeError(f'{out}')
-        ecode, out = run_git_cmd(config, 'gc', '--prune=now')
-        if ecode != 0:
-            print_message(source, '[git] failed to gc')
-            raise RuntimeError(f'{out}')
+        objects = count_objects(config)
+        before = objects.get('size', 0) + objects.get('size-pack', 0)
+
+        # retention rewrites the branch and gc deletes packs, neither may run beside a maintenance repack
+        with maintenance_lock:
+            if config.retention['enabled']:
+                with timer.phase('retention'):
+                    plan = plan_retention(config)
+                    apply_retention(config, plan, logger=logger)
+                if len(plan.dropped) > 0:
+                    print_message(source, tr('prune_backup.retention', len(plan.kept), len(plan.dropped)), tell=False)
+
+            with timer.phase('expire'):
+                ecode, out = run_git_cmd(config, 'reflog', 'expire', '--expire-unreachable=now', '--all')
+            if ecode != 0:
+                print_message(source, '[git] failed to expire reflog')
+                raise RuntimeError(f'{out}')
+            with timer.phase('gc'):
+                ecode, out = run_git_cmd(config, 'gc', '--prune=now')
+            if ecode != 0:
+                print_message(source, '[git] failed to gc')
+                raise RuntimeError(f'{out}')
         
-        backup_size = format_dir_size(get_dir_size(config.backup_path))
-
-        print_message(source, tr('prune_backup.success', backup_size), tell=False)
+        invalidate_sizes()
+        backup_size = format_dir_size(sum(get_sizes(config)))
+        objects = count_objects(config)
+        reclaimed = before - objects.get('size', 0) - objects.get('size-pack', 0)
+
+        print_message(source, tr('prune_backup.success', backup_size, format_dir_size(max(0, reclaimed))), tell=False)
+        if store_path(config) is not None:
+            print_message(source, tr('prune_backup.shared_store', Prefix), tell=False)
+        success = True
     except Exception as e:
         log_except(logger, e)
         print_message(source, tr('prune_backup.fail'), tell=False)
+    finally:
+        _record_timer(config, timer, success, logger=logger)
+
+@single_op(tr('operations.rollover'))
+def rollover_shard(source: MCDR.CommandSource, config, force: bool = False, logger=None):
+    """
+    Seal the active shard when it is due by `shard`, or right away with `force`
+    """
+    reason = 'manual' if force else rollover_due(config)
+    if reason is None:
+        return
+    timer = OperationTimer('rollover')
+    success = False
+    print_message(source, tr('rollover_shard.start', reason), tell=False)
+    try:
+        # the seal repacks, it must not run beside a maintenance repack
+        with timer.phase('wait'):
+            maintenance_lock.acquire()
+        try:
+            with timer.phase('seal'):
+                name = seal_shard(config, logger=logger)
+        finally:
+            maintenance_lock.release()
+        print_message(source, tr('rollover_shard.success', name, round(timer.phases['seal'], 1)), tell=False)
+        success = True
+    except Exception as e:
+        log_except(logger, e)
+        print_message(source, tr('rollover_shard.fail'), tell=False)
+    finally:
+        _record_timer(config, timer, success, logger=logger)
+
+@single_op(tr('operations.consolidate'))
+def consolidate_store(source: MCDR.CommandSource, config, logger=None):
+    """
+    Move the objects of this instance into the shared store and report the objects the instances share
+    """
+    timer = OperationTimer('consolidate')
+    success = False
+    print_message(source, tr('consolidate_store.start', instance_name(config)), tell=False)
+    try:
+        # both repacks must not run beside a maintenance repack
+        with timer.phase('wait'):
+            maintenance_lock.acquire()
+        try:
+            with timer.phase('consolidate'):
+                res = consolidate(config, logger=logger)
+        finally:
+            maintenance_lock.release()
+        print_message(source, tr('consolidate_store.success', format_dir_size(res['local_before']),
+                                 format_dir_size(res['local_after']), format_dir_size(res['store_before']),
+                                 format_dir_size(res['store']),
+                                 round(timer.phases['consolidate'], 1)), tell=False)
+        print_message(source, tr('consolidate_store.shared', res['shared'], res['objects'], res['instances'],
+                                 format_dir_size(res['saved'])), tell=False)
+        success = True
+    except Exception as e:
+        log_except(logger, e)
+        print_message(source, tr('consolidate_store.fail'), tell=False)
+    finally:
+        _record_timer(config, timer, success, logger=logger)
+
+@single_op(tr('operations.measure'))
+def measure_filter(source: MCDR.CommandSource, config, count: int = 10, logger=None):
+    entries = get_index(config).entries[-max(2, count):]
+    print_message(source, tr('measure_filter.start', len(entries)), tell=False)
+    try:
+        res = measure_region_filter(config, [ent['hash'] for ent in entries], logger=logger)
+    except Exception as e:
+        log_except(logger, e)
+        print_message(source, tr('measure_filter.fail'), tell=False)
+        return
+    saved = 1 - res['canonical_pack'] / res['raw_pack'] if res['raw_pack'] > 0 else 0
+    print_message(source, tr('measure_filter.result', res['commits'], res['region_files'],
+                             format_dir_size(res['raw_pack']), f"{res['raw_repack_time']:.1f}",
+                             format_dir_size(res['canonical_pack']), f"{res['canonical_repack_time']:.1f}",
+                             f'{saved * 100:.1f}', f"{res['clean_time']:.1f}", f"{res['smudge_time']:.1f}"),
+                  tell=False)
 
 def backup_status(source: MCDR.CommandSource, config, logger=None):
     try:
@@ -227,24 +782,54 @@ def backup_status(source: MCDR.CommandSource, config, logger=None):
         return
     slot_info = format_slot_info(slot[:10], date, comment)
 
-    dir_size = get_dir_size(config.backup_path)
-    true_size = get_dir_size(os.path.join(config.backup_path, '.git'))
-    cache_size = dir_size - true_size
+    cache_size, true_size = get_sizes(config)
+    dir_size = cache_size + true_size
     
     now = time.time()
 
     eta_backup = max(0, config.backup_interval - (now - config.last_backup_time))
-    eta_push = max(0, config.push_interval - (now - config.last_push_time))
+    remotes = get_remotes(config)
+    etas = [max(0, r.get('push_interval', 0) - (now - get_last_push_time(config, r)))
+            for r in remotes if r.get('push_interval', 0) >= 0]
 
     msg = tr('status',
              get_format_time(now),
              slot_info,
              f'{eta_backup:.1f}',
-             f'{eta_push:.1f}' if config.git_cfg['use_remote'] else '-',
+             f'{min(etas):.1f}' if len(etas) > 0 else '-',
              format_dir_size(dir_size),
              format_dir_size(true_size),
              format_dir_size(cache_size))
     print_message(source, msg, tell=False, prefix='')
+    for group in get_schedules(config):
+        eta = max(0, group['interval'] - (now - group.get('last_backup_time', 0)))
+        print_message(source, tr('schedule.status', group['name'], f'{eta:.1f}', ', '.join(group['paths'])),
+                      tell=False, prefix='')
+    for remote in remotes:
+        print_message(source, format_push_state(config, remote), tell=False, prefix='')
+    shards = list_shards(config)
+    if len(shards) > 0:
+        print_message(source, tr('rollover_shard.status', len(shards), shards[-1][0],
+                                 len(get_index(config).entries)), tell=False, prefix='')
+    if governor.lagging():
+        rate = governor.copy_rate()
+        print_message(source, tr('throttle.lagging', format_dir_size(rate) + '/s' if rate > 0 else '-'),
+                      tell=False, prefix='')
+    maintenance = format_maintenance()
+    print_message(source, tr('maintenance.never') if maintenance is None else tr('maintenance.status', maintenance),
+                  tell=False, prefix='')
+
+def timing_stats(source: MCDR.CommandSource, config, operation: str = None):
+    summary = summarize(operation)
+    print_message(source, tr('stats.title'), tell=False, prefix='')
+    if len(summary) == 0:
+        print_message(source, tr('stats.empty'), tell=False, prefix='')
+        return
+    for op, data in summary.items():
+        print_message(source, tr('stats.operation', op, data['count'],
+                                 format_dir_size(data['bytes']), data['files']), tell=False, prefix='')
+        for name, (p50, p95) in data['phases'].items():
+            print_message(source, tr('stats.phase', name, f'{p50:.2f}', f'{p95:.2f}'), tell=False, prefix='')
 
 def command_run(message: Any, text: Any, command: str) -> MCDR.RTextBase:
     fancy_text = message.copy() if isinstance(message, MCDR.RTextBase) else MCDR.RText(message)
@@ -252,30 +837,35 @@ def command_run(message: Any, text: Any, command: str) -> MCDR.RTextBase:
 
 def parse_backup_info(line: str):
     slot, cmn = line.split(' ', 1)
-    a = cmn.split('=', 1)
-    date, comment = a if len(a) == 2 else (a[0], '')
+    date, comment = parse_subject(cmn)
     return slot, date, comment
 
 def get_backup_info(config, bid: str or int):
-    use_hash = True
-    bid_ = bid
     if isinstance(bid, int):
-        use_hash = False
-        bid_ = '-{}'.format(bid_)
+        if bid < 1:
+            raise RuntimeError('Index {} is out of range'.format(bid))
+        ent = get_index(config).by_index(bid)
+        if ent is None:
+            raise RuntimeError('Index {} is out of range'.format(bid))
+        return ent['hash'], ent['date'], ent['comment']
     elif not isinstance(bid, str):
         raise TypeError('bid must be "int" or "str"')
-    ecode, out = run_git_cmd(config, 'log', '--pretty=oneline', '--no-decorate', bid_, '--')
-    if ecode != 0:
-        raise RuntimeError('Get log error: ({0}){1}'.format(ecode, out))
-    lines = out.splitlines()
-
-    if use_hash:
-        if len(lines) == 0:
-            raise RuntimeError('Can not found commit by hash "{}"'.format(bid))
-        return parse_backup_info(lines[0])
-    if len(lines) < bid:
-        raise RuntimeError('Index {} is out of range'.format(bid))
-    return parse_backup_info(lines[bid - 1])
+    if bid.startswith('pre:'):
+        snapshots = list_snapshots(config)
+        idx = int(bid[4:])
+        if not 1 <= idx <= len(snapshots):
+            raise RuntimeError('Pre-restore snapshot {} is out of range'.format(idx))
+        oid, _, date, comment = snapshots[idx - 1]
+        return oid, date, comment
+    ent = get_index(config).by_hash(bid)
+    if ent is not None:
+        return ent['hash'], ent['date'], ent['comment']
+    # not on the backup branch, ask git
+    commit = read_commit(config, bid)
+    if commit is None:
+        raise RuntimeError('Can not found commit by hash "{}"'.format(bid))
+    oid, _, message = commit
+    return parse_backup_info('{} {}'.format(oid, message.split('\n', 1)[0]))
 
 def format_slot_info(slot, date, comment) -> Optional[MCDR.RTextBase]:
     if comment is None or len(comment) == 0:
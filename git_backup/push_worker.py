@@ -0,0 +1,328 @@
+import inspect
+import os
+import re
+import subprocess
+import sys
+import time
+
+from threading import Thread, Condition
+from typing import Optional, List
+from git_backup import throttle
+from git_backup.constants import PLUGIN_ABBR, SHARD_REF
+from git_backup.git import git_argv, run_git_cmd
+from git_backup.timing import OperationTimer, record_operation
+from git_backup.utils import get_metadata_path, debug_message, decode_output, log_info, log_warning, log_except
+
+THROTTLE_SCRIPT = 'throttle.py'
+# "Writing objects:  45% (123/270), 1.20 MiB | 500.00 KiB/s"
+PROGRESS_RE = re.compile(r'^(?:remote: )?([A-Za-z ]+):\s+(\d+)% \((\d+)/(\d+)\)(?:, ([\d.]+ \w+))?(?: \| ([\d.]+ \S+))?')
+
+class PushProgress:
+    def __init__(self):
+        self.phase = None
+        self.percent = 0
+        self.transferred = None
+        self.rate = None
+        self.phase_start = time.time()
+
+    def update(self, line: str) -> bool:
+        m = PROGRESS_RE.match(line.strip())
+        if m is None:
+            return False
+        phase = m.group(1).strip()
+        if phase != self.phase:
+            self.phase = phase
+            self.phase_start = time.time()
+        self.percent = int(m.group(2))
+        self.transferred = m.group(5)
+        self.rate = m.group(6)
+        return True
+
+    def eta(self) -> Optional[float]:
+        """
+        Seconds left in the current phase, extrapolated from its progress so far
+        """
+        if self.percent <= 0 or self.percent >= 100:
+            return None
+        elapsed = time.time() - self.phase_start
+        return elapsed * (100 - self.percent) / self.percent
+
+def _quote(arg: str) -> str:
+    return '"{}"'.format(arg.replace('\\', '/'))
+
+def is_local_url(url: str) -> bool:
+    return url.startswith('file://') or not re.match(r'^([a-z+]+://|[^/\\]+@[^/\\]+:)', url) and \
+        (os.path.isabs(url) or url.startswith(('.', '~')))
+
+def get_remotes(config) -> List[dict]:
+    """
+    The remotes to push to, highest priority first.
+    Without `remotes`, the single remote of `git_cfg` with the global push interval
+    """
+    if not config.git_cfg['use_remote']:
+        return []
+    if len(config.remotes) == 0:
+        return [{
+            'name': config.git_cfg['remote_name'],
+            'url': config.git_cfg['remote'],
+            'push_interval': config.push_interval if config.push_interval > 0 else -1,
+            'priority': 0,
+            'bandwidth_limit': None,
+            'legacy': True,
+        }]
+    return sorted(config.remotes, key=lambda r: -r.get('priority', 0))
+
+def remote_key(remote: dict) -> tuple:
+    """
+    The settings of `remote` a push worker works by, without the push times it records
+    """
+    return tuple(remote.get(k) for k in ('name', 'url', 'priority', 'bandwidth_limit', 'push_interval', 'legacy'))
+
+def get_last_push_time(config, remote: dict) -> float:
+    return config.last_push_time if remote.get('legacy') else remote.get('last_push_time', 0)
+
+def set_last_push_time(config, remote: dict, t: float):
+    if remote.get('legacy'):
+        config.last_push_time = t
+    else:
+        remote['last_push_time'] = t
+        config.last_push_time = max(config.last_push_time, t)
+
+def push_due(config, remote: dict, now: float) -> bool:
+    """
+    A remote with `push_interval` 0 gets every backup, a negative interval means manual pushes only
+    """
+    interval = remote.get('push_interval', 0)
+    return interval == 0 or interval > 0 and get_last_push_time(config, remote) + interval <= now
+
+def remote_lag(config, remote: dict) -> Optional[int]:
+    """
+    Commits on the backup branch the remote does not have yet, None if it was never pushed to
+    """
+    branch = config.git_cfg['branch_name']
+    ecode, out = run_git_cmd(config, 'rev-list', '--count',
+                             'refs/remotes/{}/{}..refs/heads/{}'.format(remote['name'], branch, branch))
+    if ecode != 0:
+        return None
+    try:
+        return int(out.strip())
+    except ValueError:
+        return None
+
+def push_env_args(config, remote: dict) -> tuple:
+    """
+    Return `(env, args)` running the transport of a push to `remote` through the throttle relay,
+    `({}, [])` when there is no limit. A remote over http can not be throttled
+    """
+    limit = remote.get('bandwidth_limit')
+    if limit is None:
+        limit = config.push_bandwidth_limit
+    url = remote['url']
+    if limit <= 0:
+        return {}, []
+    script = get_metadata_path(config, THROTTLE_SCRIPT)
+    with open(script, 'w', encoding='utf-8') as fd:
+        fd.write(inspect.getsource(throttle))
+    relay = '{} {} {}'.format(_quote(sys.executable), _quote(script), int(limit))
+    if re.match(r'^[a-z+]+://', url) and not url.startswith(('ssh://', 'git+ssh://', 'file://')):
+        return {}, []
+    if is_local_url(url):
+        # a local remote runs receive-pack itself, the pack is what it reads from stdin
+        return {}, ['--receive-pack={} git-receive-pack'.format(relay)]
+    return {'GIT_SSH_COMMAND': '{} {}'.format(relay, config.git_cfg['ssh_command'])}, []
+
+class PushGate:
+    """
+    Let at most `limit` pushes run at once, a waiting push of a higher priority goes first
+    """
+    def __init__(self, limit: int):
+        self.limit = max(1, limit)
+        self.cond = Condition()
+        self.active = 0
+        self.waiting = []
+
+    def acquire(self, priority: int, cancelled=lambda: False) -> bool:
+        with self.cond:
+            self.waiting.append(priority)
+            try:
+                while self.active >= self.limit or max(self.waiting) > priority:
+                    if cancelled():
+                        return False
+                    self.cond.wait(1)
+                self.active += 1
+                return True
+            finally:
+                self.waiting.remove(priority)
+                self.cond.notify_all()
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+class PushWorker:
+    """
+    Pushes to one remote in a thread of its own, so backups and restores never wait for the network.
+    Requests made while a push is queued are merged into it, a request made while pushing queues one more push.
+    A failed push is retried with exponential backoff
+    """
+    def __init__(self, config, remote: dict, gate: PushGate, logger=None, on_done=None):
+        self.config = config
+        self.remote = remote
+        self.gate = gate
+        self.logger = logger
+        self.on_done = on_done
+        self.cond = Condition()
+        self.pending = False
+        self.requesters = []
+        self.running = False
+        self.pushing = False
+        self.stopped = False
+        self.attempt = 0
+        self.retry_at = None
+        self.last_error = None
+        self.last_result = None
+        self.progress: Optional[PushProgress] = None
+        self.proc: Optional[subprocess.Popen] = None
+        self.thread = Thread(target=self._loop, name=f'{PLUGIN_ABBR} - push {remote["name"]}', daemon=True)
+        self.thread.start()
+
+    def request(self, source=None) -> bool:
+        """
+        Queue a push, return False if it was merged into one already queued
+        """
+        with self.cond:
+            merged = self.pending
+            self.pending = True
+            if source is not None:
+                self.requesters.append(source)
+            # a new request skips the backoff, the user wants it now
+            self.retry_at = None
+            self.cond.notify_all()
+            return not merged
+
+    def stop(self, kill: bool = True):
+        """
+        Stop the worker, a push running is killed unless `kill` is False, then it finishes first.
+        Return the requesters of the push queued
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+            proc = self.proc
+            requesters, self.requesters = self.requesters, []
+        if kill and proc is not None and proc.poll() is None:
+            proc.kill()
+        return requesters
+
+    def wait_idle(self, timeout: float = None) -> bool:
+        end = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while self.pending or self.running:
+                left = None if end is None else end - time.time()
+                if left is not None and left <= 0:
+                    return False
+                self.cond.wait(left)
+            return True
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while not self.stopped and (not self.pending or
+                                            (self.retry_at is not None and time.time() < self.retry_at)):
+                    self.cond.wait(None if self.retry_at is None else max(0.0, self.retry_at - time.time()))
+                if self.stopped:
+                    return
+                self.pending = False
+                self.running = True
+                requesters, self.requesters = self.requesters, []
+            ok = False
+            if self.gate.acquire(self.remote.get('priority', 0), lambda: self.stopped):
+                try:
+                    ok = self._push()
+                except Exception as e:
+                    self.last_error = str(e)
+                    log_except(self.logger, f'[{PLUGIN_ABBR}] Pushing error: {e}')
+                finally:
+                    self.gate.release()
+            with self.cond:
+                self.running = False
+                self.pushing = False
+                self.progress = None
+                retry = self.config.push_retry
+                if ok:
+                    self.attempt = 0
+                    self.retry_at = None
+                elif not self.stopped and self.attempt < retry['max_attempts']:
+                    self.attempt += 1
+                    delay = min(retry['backoff_max'], retry['backoff'] * 2 ** (self.attempt - 1))
+                    self.retry_at = time.time() + delay
+                    self.pending = True
+                    self.requesters.extend(requesters)
+                    requesters = []
+                else:
+                    self.attempt = 0
+                    self.retry_at = None
+                self.cond.notify_all()
+            if self.on_done is not None and (ok or len(requesters) > 0):
+                self.on_done(self.remote, ok, requesters, self.last_error)
+
+    def _push(self) -> bool:
+        config = self.config
+        remote = self.remote['name']
+        env, args = push_env_args(config, self.remote)
+        timer = OperationTimer('push')
+        self.progress = PushProgress()
+        self.pushing = True
+        with timer.phase('push'):
+            proc = subprocess.Popen(
+                git_argv(config, 'push', '-f', '--progress', *args, remote, config.git_cfg['branch_name'],
+                         # the sealed shards go along, they are only ever added
+                         '{0}/*:{0}/*'.format(SHARD_REF)),
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                env=dict(os.environ, **env) if len(env) > 0 else None)
+            with self.cond:
+                self.proc = proc
+            output = []
+            line = bytearray()
+            while True:
+                b = proc.stderr.read(1)
+                if len(b) == 0 or b in b'\r\n':
+                    text = decode_output(bytes(line))
+                    if len(text) > 0 and not self.progress.update(text):
+                        output.append(text)
+                    line.clear()
+                    if len(b) == 0:
+                        break
+                else:
+                    line += b
+            ecode = proc.wait()
+            with self.cond:
+                self.proc = None
+        record_operation(config, timer, ecode == 0)
+        debug_message(config.debug, 'push:', ecode, output)
+        if ecode != 0:
+            self.last_error = '\n'.join(output[-5:])
+            log_warning(self.logger, f'[{PLUGIN_ABBR}] Pushing error({ecode}): {self.last_error}')
+            self.last_result = (time.time(), False)
+            return False
+        now = time.time()
+        set_last_push_time(config, self.remote, now)
+        self.last_error = None
+        self.last_result = (now, True)
+        log_info(self.logger, f'[{PLUGIN_ABBR}] pushed to {remote}')
+        return True
+
+    def state(self) -> tuple:
+        """
+        `('pushing', progress)`, `('retry', seconds to the retry)`, `('queued', None)` or `('idle', None)`
+        """
+        with self.cond:
+            if self.pushing:
+                return 'pushing', self.progress
+            if self.pending and self.retry_at is not None:
+                return 'retry', max(0.0, self.retry_at - time.time())
+            if self.pending or self.running:
+                # a running push still waiting for the gate is queued too
+                return 'queued', None
+            return 'idle', None
@@ -0,0 +1,82 @@
+import os
+import shutil
+import struct
+
+SECTOR_SIZE = 4096
+CHUNK_COUNT = 1024
+HEADER_SIZE = SECTOR_SIZE * 2
+REGION_SUFFIXES = ('.mca', '.mcr')
+
+def is_region_file(name: str) -> bool:
+    return name.endswith(REGION_SUFFIXES)
+
+def parse_header(header: bytes):
+    """
+    Split the 8 KiB region header into the location table `[(sector offset, sector count), ...]`
+    and the timestamp table `[last save time, ...]`
+    """
+    locations = []
+    for i in range(CHUNK_COUNT):
+        entry, = struct.unpack_from('>I', header, i * 4)
+        locations.append((entry >> 8, entry & 0xff))
+    timestamps = list(struct.unpack_from('>{}I'.format(CHUNK_COUNT), header, SECTOR_SIZE))
+    return locations, timestamps
+
+def read_header(path: str):
+    with open(path, 'rb') as fd:
+        header = fd.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE:
+        return None
+    return header
+
+def diff_chunks(old_header: bytes, new_header: bytes, since: int = None):
+    """
+    Return the indexes of the chunks whose location or timestamp differ between two headers.
+    Chunks saved at or after `since` are included too, because the timestamp only has second precision
+    """
+    old_loc, old_ts = parse_header(old_header)
+    new_loc, new_ts = parse_header(new_header)
+    changed = []
+    for i in range(CHUNK_COUNT):
+        if old_loc[i] != new_loc[i] or old_ts[i] != new_ts[i] or (since is not None and new_ts[i] >= since):
+            changed.append(i)
+    return changed
+
+def patch_region(src_path: str, dst_path: str):
+    """
+    Bring the staged copy `dst_path` up to date with `src_path` by writing the header and
+    the sectors of the changed chunks only. The sectors freed by the server are left as they are.
+
+    Return `(chunks changed, bytes written)`, or `None` if the file has to be copied as a whole
+    """
+    new_header = read_header(src_path)
+    if new_header is None or not os.path.isfile(dst_path):
+        return None
+    old_header = read_header(dst_path)
+    if old_header is None:
+        return None
+    src_size = os.path.getsize(src_path)
+    # the staged copy carries the mtime of the source at the previous sync
+    since = int(os.stat(dst_path).st_mtime)
+    changed = diff_chunks(old_header, new_header, since=since)
+
+    locations, _ = parse_header(new_header)
+    written = HEADER_SIZE
+    with open(src_path, 'rb') as src, open(dst_path, 'r+b') as dst:
+        for i in changed:
+            offset, count = locations[i]
+            if offset < 2 or count == 0:
+                continue
+            start = offset * SECTOR_SIZE
+            length = min(count * SECTOR_SIZE, src_size - start)
+            if length <= 0:
+                continue
+            src.seek(start)
+            dst.seek(start)
+            dst.write(src.read(length))
+            written += length
+        dst.seek(0)
+        dst.write(new_header)
+        dst.truncate(src_size)
+    shutil.copystat(src_path, dst_path)
+    return len(changed), written
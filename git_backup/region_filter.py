@@ -0,0 +1,230 @@
+"""
+Git clean/smudge filter for region (`.mca`) and external chunk (`.mcc`) files.
+
+The game compresses every chunk on its own, so one changed block gives a new zlib stream and git can not
+delta a region file against its previous version. `clean` stores the chunks uncompressed, in index order,
+each one starting on a sector boundary; `smudge` compresses them again and lays them out one after another.
+Data that is not in the canonical form passes `smudge` unchanged and data that can not be parsed passes
+`clean` unchanged, so history made before the filter was installed still checks out.
+
+This file only uses the standard library, it is copied into the repository and run by git:
+`python region_filter.py process [--smudge-only]` speaks the long-running filter protocol,
+`python region_filter.py clean|smudge` filters stdin to stdout
+"""
+import gzip
+import struct
+import sys
+import zlib
+
+SECTOR_SIZE = 4096
+CHUNK_COUNT = 1024
+HEADER_SIZE = SECTOR_SIZE * 2
+
+REGION_MAGIC = b'GBK-REGION-v1\n'
+MCC_MAGIC = b'GBK-MCC-v1\n'
+# chunk table of the canonical form: canonical sector offset and stored length of every chunk
+TABLE_SIZE = CHUNK_COUNT * 8
+
+COMPRESSION_GZIP = 1
+COMPRESSION_ZLIB = 2
+COMPRESSION_EXTERNAL = 0x80
+
+def is_filtered(path: str) -> bool:
+    return path.endswith(('.mca', '.mcc'))
+
+def _pad(buf: bytearray):
+    buf += b'\x00' * (-len(buf) % SECTOR_SIZE)
+
+def _decompress(type_: int, data: bytes):
+    if type_ == COMPRESSION_ZLIB:
+        return zlib.decompress(data)
+    if type_ == COMPRESSION_GZIP:
+        return gzip.decompress(data)
+    return None
+
+def _compress(type_: int, data: bytes) -> bytes:
+    if type_ == COMPRESSION_ZLIB:
+        return zlib.compress(data, 6)
+    return gzip.compress(data, 6, mtime=0)
+
+def clean_region(data: bytes) -> bytes:
+    """
+    Region file to the canonical form, `data` itself if it is not a region file
+    """
+    if len(data) < HEADER_SIZE or data.startswith(REGION_MAGIC):
+        return data
+    out = bytearray(REGION_MAGIC)
+    _pad(out)
+    out += data[SECTOR_SIZE:HEADER_SIZE]
+    table = bytearray(TABLE_SIZE)
+    body = bytearray()
+    base = (len(out) + TABLE_SIZE) // SECTOR_SIZE
+    try:
+        for i in range(CHUNK_COUNT):
+            entry, = struct.unpack_from('>I', data, i * 4)
+            offset, count = entry >> 8, entry & 0xff
+            start = offset * SECTOR_SIZE
+            if offset < 2 or count == 0 or start + 5 > len(data):
+                # the game treats a broken location as a missing chunk too
+                continue
+            length, type_ = struct.unpack_from('>IB', data, start)
+            payload = data[start + 5:start + 4 + length]
+            if length == 0 or len(payload) != length - 1:
+                continue
+            raw = None if type_ & COMPRESSION_EXTERNAL else _decompress(type_, payload)
+            stored = bytes([type_, 0 if raw is None else 1]) + (payload if raw is None else raw)
+            struct.pack_into('>II', table, i * 8, base + len(body) // SECTOR_SIZE, len(stored))
+            body += stored
+            _pad(body)
+    except (zlib.error, OSError, EOFError, struct.error):
+        return data
+    return bytes(out + table + body)
+
+def smudge_region(data: bytes) -> bytes:
+    """
+    Canonical form back to a region file, `data` itself if it is not in the canonical form
+    """
+    if not data.startswith(REGION_MAGIC):
+        return data
+    timestamps = data[SECTOR_SIZE:HEADER_SIZE]
+    table = data[HEADER_SIZE:HEADER_SIZE + TABLE_SIZE]
+    locations = bytearray(SECTOR_SIZE)
+    body = bytearray()
+    for i in range(CHUNK_COUNT):
+        sector, length = struct.unpack_from('>II', table, i * 8)
+        if length < 2:
+            continue
+        start = sector * SECTOR_SIZE
+        type_, compressed = data[start], data[start + 1]
+        payload = data[start + 2:start + length]
+        if compressed:
+            payload = _compress(type_, payload)
+        first = len(body) // SECTOR_SIZE
+        body += struct.pack('>IB', len(payload) + 1, type_) + payload
+        _pad(body)
+        struct.pack_into('>I', locations, i * 4, ((first + 2) << 8) | min(255, len(body) // SECTOR_SIZE - first))
+    return bytes(locations + timestamps + body)
+
+def clean_external(data: bytes) -> bytes:
+    """
+    External chunk file (zlib stream, almost always) to the canonical form
+    """
+    if data.startswith(MCC_MAGIC):
+        return data
+    try:
+        return MCC_MAGIC + b'\x01' + zlib.decompress(data)
+    except zlib.error:
+        return MCC_MAGIC + b'\x00' + data
+
+def smudge_external(data: bytes) -> bytes:
+    if not data.startswith(MCC_MAGIC) or len(data) <= len(MCC_MAGIC):
+        return data
+    payload = data[len(MCC_MAGIC) + 1:]
+    return zlib.compress(payload, 6) if data[len(MCC_MAGIC)] else payload
+
+def clean(path: str, data: bytes) -> bytes:
+    if path.endswith('.mcc'):
+        return clean_external(data)
+    if path.endswith('.mca'):
+        return clean_region(data)
+    return data
+
+def smudge(path: str, data: bytes) -> bytes:
+    if data.startswith(REGION_MAGIC):
+        return smudge_region(data)
+    if data.startswith(MCC_MAGIC):
+        return smudge_external(data)
+    return data
+
+######## Long-running filter process protocol ########
+
+MAX_PACKET = 65516
+
+def _read_packet(stdin):
+    head = stdin.read(4)
+    if len(head) == 0:
+        raise EOFError()
+    size = int(head, 16)
+    if size == 0:
+        return None
+    return stdin.read(size - 4)
+
+def _read_list(stdin) -> list:
+    res = []
+    while True:
+        pkt = _read_packet(stdin)
+        if pkt is None:
+            return res
+        res.append(pkt.decode('utf-8').rstrip('\n'))
+
+def _read_content(stdin) -> bytes:
+    buf = bytearray()
+    while True:
+        pkt = _read_packet(stdin)
+        if pkt is None:
+            return bytes(buf)
+        buf += pkt
+
+def _write_packet(stdout, data: bytes):
+    stdout.write(b'%04x' % (len(data) + 4))
+    stdout.write(data)
+
+def _write_text(stdout, *lines: str):
+    for line in lines:
+        _write_packet(stdout, (line + '\n').encode('utf-8'))
+    stdout.write(b'0000')
+    stdout.flush()
+
+def _write_content(stdout, data: bytes):
+    for i in range(0, len(data), MAX_PACKET):
+        _write_packet(stdout, data[i:i + MAX_PACKET])
+    stdout.write(b'0000')
+
+def serve(stdin, stdout, smudge_only: bool = False):
+    welcome = _read_list(stdin)
+    if 'git-filter-client' not in welcome or 'version=2' not in welcome:
+        raise RuntimeError('unsupported filter protocol: {}'.format(welcome))
+    _write_text(stdout, 'git-filter-server', 'version=2')
+    offered = _read_list(stdin)
+    supported = ['capability=smudge'] if smudge_only else ['capability=clean', 'capability=smudge']
+    _write_text(stdout, *[cap for cap in supported if cap in offered])
+    while True:
+        try:
+            headers = dict(line.split('=', 1) for line in _read_list(stdin))
+        except EOFError:
+            return
+        content = _read_content(stdin)
+        command, path = headers.get('command'), headers.get('pathname', '')
+        try:
+            if command == 'clean' and not smudge_only:
+                result = clean(path, content)
+            elif command == 'smudge':
+                result = smudge(path, content)
+            else:
+                raise ValueError('unsupported command {}'.format(command))
+        except Exception as e:
+            sys.stderr.write('region filter: {} {} failed: {}\n'.format(command, path, e))
+            _write_text(stdout, 'status=error')
+            continue
+        _write_text(stdout, 'status=success')
+        _write_content(stdout, result)
+        # an empty list keeps the status
+        stdout.write(b'0000')
+        stdout.flush()
+
+def main(argv: list):
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    if len(argv) >= 1 and argv[0] == 'process':
+        serve(stdin, stdout, smudge_only='--smudge-only' in argv[1:])
+    elif len(argv) >= 1 and argv[0] in ('clean', 'smudge'):
+        path = argv[1] if len(argv) >= 2 else ''
+        data = stdin.read()
+        stdout.write(clean(path, data) if argv[0] == 'clean' else smudge(path, data))
+        stdout.flush()
+    else:
+        sys.stderr.write('usage: region_filter.py process [--smudge-only] | clean <path> | smudge <path>\n')
+        return 2
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
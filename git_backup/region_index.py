@@ -0,0 +1,283 @@
+import os
+import json
+import re
+
+from threading import Lock
+from typing import List, Optional
+from git_backup.backup_index import get_index
+from git_backup.git import run_git_cmd, get_cat_file
+from git_backup.region import HEADER_SIZE, SECTOR_SIZE, CHUNK_COUNT
+from git_backup.utils import get_metadata_path, log_info
+
+REGION_INDEX_FILE = 'regions.jsonl'
+REGION_FILE_RE = re.compile(r'^(?:(.*)/)?(region|entities|poi)/r\.(-?\d+)\.(-?\d+)\.mca$')
+NULL_OID = '0' * 40
+DIMENSION_ALIASES = {
+    'overworld': '',
+    'the_nether': 'DIM-1',
+    'nether': 'DIM-1',
+    'the_end': 'DIM1',
+    'end': 'DIM1',
+}
+
+class RegionIndex:
+    """
+    The region files each backup changed, `{commit: {'saved': time, 'regions': {rel: chunks}}}`,
+    `chunks` the sorted chunk indexes (`x + z * 32` in the region) or None when unknown.
+    `by_name` maps `r.<x>.<z>.mca` to `[(commit, rel, chunks), ...]` for the lookups.
+    It is stored as JSON lines, a backup appends a line and a later line of a commit replaces an earlier one
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.commits = {}
+        self.by_name = {}
+
+    def load(self):
+        self.commits = {}
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as fd:
+                for line in fd:
+                    try:
+                        rec = json.loads(line)
+                        self.commits[rec['hash']] = rec
+                    except (ValueError, KeyError, TypeError):
+                        # a line cut short by a crash
+                        continue
+        self._reindex()
+        return self
+
+    def _reindex(self):
+        self.by_name = {}
+        for oid, rec in self.commits.items():
+            for rel, chunks in rec['regions'].items():
+                self.by_name.setdefault(rel.rsplit('/', 1)[-1], []).append((oid, rel, chunks))
+
+    def append(self, records: List[dict]):
+        with open(self.path, 'a') as fd:
+            for rec in records:
+                fd.write(json.dumps(rec, separators=(',', ':')) + '\n')
+                self.commits[rec['hash']] = rec
+                for rel, chunks in rec['regions'].items():
+                    self.by_name.setdefault(rel.rsplit('/', 1)[-1], []).append((rec['hash'], rel, chunks))
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fd:
+            for rec in self.commits.values():
+                fd.write(json.dumps(rec, separators=(',', ':')) + '\n')
+        os.replace(tmp, self.path)
+        self._reindex()
+
+_region_index: Optional[RegionIndex] = None
+_region_index_lock = Lock()
+_backfill_lock = Lock()
+
+def _load_region_index(config) -> RegionIndex:
+    global _region_index
+    path = get_metadata_path(config, REGION_INDEX_FILE)
+    if _region_index is None or _region_index.path != path:
+        _region_index = RegionIndex(path).load()
+    return _region_index
+
+class _HeaderSink:
+    """
+    A file object keeping the first `HEADER_SIZE` bytes written to it
+    """
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, buf: bytes):
+        if len(self.data) < HEADER_SIZE:
+            self.data += buf[:HEADER_SIZE - len(self.data)]
+        return len(buf)
+
+def _blob_timestamps(config, oid: str) -> Optional[bytes]:
+    # the timestamp table sits at the same offset in a region file and in its canonical form
+    sink = _HeaderSink()
+    if oid == NULL_OID or get_cat_file(config).copy_to(oid, sink) is None or len(sink.data) < HEADER_SIZE:
+        return None
+    return bytes(sink.data[SECTOR_SIZE:HEADER_SIZE])
+
+def _file_timestamps(path: str) -> Optional[bytes]:
+    try:
+        with open(path, 'rb') as fd:
+            header = fd.read(HEADER_SIZE)
+    except OSError:
+        return None
+    return header[SECTOR_SIZE:] if len(header) == HEADER_SIZE else None
+
+def _chunks(old: Optional[bytes], new: Optional[bytes], since: float = None) -> Optional[list]:
+    """
+    The chunks whose timestamp differs between two timestamp tables, or without the old table
+    the chunks present and saved at or after `since`. None if it can not be told
+    """
+    if new is None:
+        return None
+    res = []
+    for i in range(CHUNK_COUNT):
+        ts = new[i * 4:i * 4 + 4]
+        if old is not None:
+            if ts != old[i * 4:i * 4 + 4]:
+                res.append(i)
+        elif since is not None:
+            # a chunk never generated has timestamp 0
+            if ts != b'\0\0\0\0' and int.from_bytes(ts, 'big') >= int(since):
+                res.append(i)
+        else:
+            return None
+    return res
+
+def _changed_regions(config, oid: str) -> dict:
+    """
+    `{rel: (old blob, new blob)}` of the region grid files `oid` changed against its first parent
+    """
+    ecode, out = run_git_cmd(config, 'diff-tree', '-r', '-z', '--no-renames', '--no-commit-id', '--root', oid)
+    if ecode != 0:
+        raise RuntimeError('diff-tree error({0}): {1}'.format(ecode, out))
+    res = {}
+    items = out.split('\0')
+    for info, rel in zip(items[0::2], items[1::2]):
+        if REGION_FILE_RE.match(rel) is not None:
+            _, _, old, new, _ = info.split(' ', 4)
+            res[rel] = (old, new)
+    return res
+
+def _covers(rec: dict, rel: str) -> bool:
+    if rec.get('paths') is None:
+        return True
+    return any(rel == p or rel.startswith(p.rstrip('/') + '/') for p in rec['paths'])
+
+def index_backup(config, oid: str, saved_time: float, paths: list = None, source_path: str = None):
+    """
+    Record the region files backup `oid` changed, `paths` the paths of a schedule group backup.
+    The changed chunks are the ones of the committed copy in `source_path` (default `server_path`) saved
+    at or after the game finished saving for the previous backup holding the file, which keeps the blobs out of it
+    """
+    changed = _changed_regions(config, oid)
+    if source_path is None:
+        source_path = config.server_path
+    with _region_index_lock:
+        ri = _load_region_index(config)
+        # the earlier records back to the latest full backup, None for a backup missing from the index
+        previous = []
+        for ent in get_index(config).query():
+            if ent['hash'] == oid:
+                continue
+            rec = ri.commits.get(ent['hash'])
+            previous.append(rec)
+            if rec is None or rec.get('paths') is None:
+                break
+    regions = {}
+    for rel, (old, new) in changed.items():
+        rec = next((rec for rec in previous if rec is None or _covers(rec, rel)), None)
+        since = None if rec is None else rec.get('saved')
+        if new == NULL_OID or since is None:
+            regions[rel] = None
+        else:
+            regions[rel] = _chunks(None, _file_timestamps(os.path.join(source_path, rel)), since)
+    with _region_index_lock:
+        _load_region_index(config).append([{'hash': oid, 'saved': saved_time, 'paths': paths, 'regions': regions}])
+
+def backfill_region_index(config, logger=None, progress=None) -> Optional[int]:
+    """
+    Index the backups made before the index existed, comparing the header timestamps of the blobs.
+    Return the number of backups indexed, None if a backfill is already running
+    """
+    if not _backfill_lock.acquire(blocking=False):
+        return None
+    try:
+        index = get_index(config)
+        with _region_index_lock:
+            done = set(_load_region_index(config).commits)
+        todo = [ent['hash'] for ent in index.query() if ent['hash'] not in done]
+        batch = []
+        for n, oid in enumerate(todo):
+            regions = {}
+            for rel, (old, new) in _changed_regions(config, oid).items():
+                regions[rel] = None if new == NULL_OID else \
+                    _chunks(_blob_timestamps(config, old), _blob_timestamps(config, new), 0)
+            batch.append({'hash': oid, 'saved': None, 'paths': None, 'regions': regions})
+            if len(batch) >= 50 or n == len(todo) - 1:
+                with _region_index_lock:
+                    _load_region_index(config).append(batch)
+                batch = []
+                if progress is not None:
+                    progress(n + 1, len(todo))
+        log_info(logger, 'region index: backfilled {} backups'.format(len(todo)))
+        return len(todo)
+    finally:
+        _backfill_lock.release()
+
+def rewrite_region_index(config, order: List[str], mapping: dict):
+    """
+    Move the records to the new hashes after the history was rewritten, `order` the old backups oldest first.
+    A kept backup now also holds the changes of the dropped backups before it
+    """
+    with _region_index_lock:
+        ri = _load_region_index(config)
+        pending = {}
+        complete = True
+        for oid in order:
+            rec = ri.commits.pop(oid, None)
+            if rec is None:
+                complete = False
+            else:
+                for rel, chunks in rec['regions'].items():
+                    if chunks is None or rel in pending and pending[rel] is None:
+                        pending[rel] = None
+                    else:
+                        pending[rel] = sorted(set(pending.get(rel, [])) | set(chunks))
+            new = mapping.get(oid)
+            if new is None:
+                continue
+            # a kept backup after a dropped one that was never indexed is left to the backfill
+            if complete:
+                ri.commits[new] = dict(rec, hash=new, regions=pending)
+            pending = {}
+            complete = True
+        ri.save()
+
+def _dimension_of(rel: str) -> str:
+    return REGION_FILE_RE.match(rel).group(1) or ''
+
+def _match_dimension(dim_path: str, dim: Optional[str]) -> bool:
+    if dim is None:
+        return True
+    dim = dim.replace('\\', '/').strip('/')
+    alias = DIMENSION_ALIASES.get(dim.lower().replace('minecraft:', ''))
+    if alias is not None:
+        last = dim_path.rsplit('/', 1)[-1]
+        if alias == '':
+            return last not in ('DIM-1', 'DIM1') and '/dimensions/' not in '/' + dim_path + '/'
+        return last == alias
+    return dim_path == dim or dim_path.endswith('/' + dim)
+
+def find_changes(config, x: int, z: int, dim: str = None) -> tuple:
+    """
+    Return `(hits, indexed, total)`: the backups that changed the chunk holding block `x` `z`, latest first,
+    as `[(entry, dimension folder, exact), ...]`, `exact` False when only the region file is known to have changed.
+    `indexed` of the `total` backups are in the region index
+    """
+    rx, rz = x >> 9, z >> 9
+    chunk = ((x >> 4) & 31) + ((z >> 4) & 31) * 32
+    name = 'r.{}.{}.mca'.format(rx, rz)
+    index = get_index(config)
+    entries = index.query()
+    with _region_index_lock:
+        ri = _load_region_index(config)
+        records = list(ri.by_name.get(name, []))
+        indexed = sum(1 for ent in entries if ent['hash'] in ri.commits)
+    found = {}
+    for oid, rel, chunks in records:
+        dim_path = _dimension_of(rel)
+        if not _match_dimension(dim_path, dim) or chunks is not None and chunk not in chunks:
+            continue
+        exact = chunks is not None
+        key = (oid, dim_path)
+        found[key] = found.get(key, False) or exact
+    hits = []
+    for ent in entries:
+        for (oid, dim_path), exact in found.items():
+            if oid == ent['hash']:
+                hits.append((ent, dim_path, exact))
+    return hits, indexed, len(entries)
@@ -0,0 +1,165 @@
+import os
+import posixpath
+import re
+
+from typing import Optional
+from git_backup import region_filter
+from git_backup.git import get_cat_file, ls_tree
+from git_backup.manifest import Manifest
+from git_backup.sync import SyncStats, walk_files
+from git_backup.utils import log_info
+
+def write_blob(config, oid: str, path: str):
+    """
+    Write blob `oid` to `path` straight from the object store
+    """
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    if os.path.isdir(path) and not os.path.islink(path):
+        raise IsADirectoryError(path)
+    tmp = path + '.gbk-tmp'
+    with open(tmp, 'wb') as fd:
+        if region_filter.is_filtered(path):
+            # cat-file does not smudge, the blob may be in the canonical form
+            res = get_cat_file(config).query(oid)
+            size = None if res is None else fd.write(region_filter.smudge(path, res[3]))
+        else:
+            size = get_cat_file(config).copy_to(oid, fd)
+    if size is None:
+        os.remove(tmp)
+        raise RuntimeError('Object {} not found'.format(oid))
+    os.replace(tmp, path)
+    return size
+
+def diff_restore(config, slot: str, manifest: Manifest, logger=None) -> SyncStats:
+    """
+    Make `need_backup` in `server_path` match the tree of `slot`, only writing the files whose content differs
+    and only deleting the files which are not in `slot`.
+    A file whose stat still matches the manifest is known to hold the blob of `manifest.head`
+
+    Return None if the slot can not be restored file by file (it contains symbolic links)
+    """
+    stats = SyncStats()
+    target = ls_tree(config, slot, config.need_backup)
+    if any(mode == '120000' for mode, _, _ in target.values()):
+        return None
+    known = {}
+    if manifest.head is not None and len(manifest.entries) > 0:
+        known = ls_tree(config, manifest.head, config.need_backup)
+
+    seen = set()
+    for basename in config.need_backup:
+        for rel, path, st in walk_files(config.server_path, basename, config.ignores):
+            stats.files_total += 1
+            seen.add(rel)
+            ent = target.get(rel)
+            if ent is None:
+                os.remove(path)
+                stats.files_deleted += 1
+                continue
+            base = known.get(rel)
+            if base is not None and base[1] == ent[1] and manifest.match(rel, st):
+                stats.bytes_skipped += ent[2]
+                continue
+            stats.bytes_copied += write_blob(config, ent[1], path)
+            stats.files_copied += 1
+    for rel, (_, oid, _) in target.items():
+        if rel not in seen:
+            stats.bytes_copied += write_blob(config, oid, os.path.join(config.server_path, rel))
+            stats.files_copied += 1
+            stats.files_total += 1
+    stats.bytes_total = stats.bytes_copied + stats.bytes_skipped
+    log_info(logger, 'differential restore: {}, skipped {} bytes'.format(stats.finish(), stats.bytes_skipped))
+    return stats
+
+# <dimension folder>:<x1>,<z1>[,<x2>,<z2>] in region coordinates, a region is 512x512 blocks
+REGION_SPEC_RE = re.compile(r'^(.+):(-?\d+),(-?\d+)(?:,(-?\d+),(-?\d+))?$')
+REGION_FILE_RE = re.compile(r'^r\.(-?\d+)\.(-?\d+)\.mca$')
+# the folders of a dimension holding files on the region grid
+REGION_DIRS = ('region', 'entities', 'poi')
+
+def _resolve_path(config, slot: str, path: str) -> Optional[str]:
+    """
+    `path` as a path in `need_backup` which exists in `server_path` or in `slot`. It is also tried
+    relative to every entry of `need_backup`, so `playerdata/<uuid>.dat` finds `world/playerdata/<uuid>.dat`
+    """
+    files = [file.replace(os.sep, '/') for file in config.need_backup]
+    path = path.replace('\\', '/').strip('/')
+    for cand in [path] + ['{}/{}'.format(file, path) for file in files]:
+        cand = posixpath.normpath(cand)
+        if not any(cand == file or cand.startswith(file + '/') for file in files):
+            continue
+        if os.path.lexists(os.path.join(config.server_path, cand)) or len(ls_tree(config, slot, [cand])) > 0:
+            return cand
+    return None
+
+def parse_restore_spec(config, slot: str, spec: str) -> tuple:
+    """
+    Return `(roots, match)` of a partial restore: the paths to look under and whether a file under them
+    is selected. `spec` is a path in `need_backup` (a dimension folder, `playerdata/<uuid>.dat`, ...)
+    or `<dimension folder>:<x1>,<z1>[,<x2>,<z2>]`, the region files of that rectangle of region coordinates
+    """
+    m = REGION_SPEC_RE.match(spec)
+    if m is not None:
+        dim = _resolve_path(config, slot, m.group(1))
+        if dim is None:
+            raise ValueError('{} is not a folder in need_backup'.format(m.group(1)))
+        x1, z1 = int(m.group(2)), int(m.group(3))
+        x2, z2 = (x1, z1) if m.group(4) is None else (int(m.group(4)), int(m.group(5)))
+        x1, x2 = min(x1, x2), max(x1, x2)
+        z1, z2 = min(z1, z2), max(z1, z2)
+        roots = ['{}/{}'.format(dim, sub) for sub in REGION_DIRS]
+
+        def match(rel: str) -> bool:
+            parent, _, name = rel.rpartition('/')
+            f = REGION_FILE_RE.match(name)
+            return parent in roots and f is not None and \
+                x1 <= int(f.group(1)) <= x2 and z1 <= int(f.group(2)) <= z2
+        return roots, match
+    path = _resolve_path(config, slot, spec)
+    if path is None:
+        raise ValueError('{} is not in need_backup'.format(spec))
+    return [path], lambda rel: rel == path or rel.startswith(path + '/')
+
+def partial_restore(config, slot: str, spec: str, manifest: Manifest, logger=None) -> SyncStats:
+    """
+    Make the files selected by `spec` in `server_path` match the tree of `slot`: the blobs are written
+    straight from the object store and the selected files not in `slot` are deleted, nothing else is touched.
+    The backup branch stays where it is, the next backup records the restored files
+    """
+    roots, match = parse_restore_spec(config, slot, spec)
+    target = {rel: ent for rel, ent in ls_tree(config, slot, roots).items() if match(rel)}
+    if any(mode == '120000' for mode, _, _ in target.values()):
+        raise RuntimeError('{} contains symbolic links in {}'.format(spec, slot))
+    known = {}
+    if manifest.head is not None and len(manifest.entries) > 0:
+        known = ls_tree(config, manifest.head, roots)
+
+    stats = SyncStats()
+    seen = set()
+    for root in roots:
+        for rel, path, st in walk_files(config.server_path, root, config.ignores):
+            if not match(rel):
+                continue
+            stats.files_total += 1
+            seen.add(rel)
+            ent = target.get(rel)
+            if ent is None:
+                os.remove(path)
+                stats.files_deleted += 1
+                continue
+            base = known.get(rel)
+            if base is not None and base[1] == ent[1] and manifest.match(rel, st):
+                stats.bytes_skipped += ent[2]
+                continue
+            stats.bytes_copied += write_blob(config, ent[1], path)
+            stats.files_copied += 1
+    for rel, (_, oid, _) in target.items():
+        if rel not in seen:
+            stats.bytes_copied += write_blob(config, oid, os.path.join(config.server_path, rel))
+            stats.files_copied += 1
+            stats.files_total += 1
+    stats.bytes_total = stats.bytes_copied + stats.bytes_skipped
+    log_info(logger, 'partial restore of {}: {}, skipped {} bytes'.format(spec, stats.finish(), stats.bytes_skipped))
+    return stats
@@ -0,0 +1,172 @@
+import subprocess
+import time
+
+from typing import List, Optional
+from git_backup.backup_index import get_index, rewrite_index
+from git_backup.region_index import rewrite_region_index
+from git_backup.constants import PRE_RESTORE_REF
+from git_backup.git import git_argv, run_git_cmd, read_commit, resolve_ref
+from git_backup.manifest import load_manifest
+from git_backup.utils import debug_message, decode_output, log_info
+
+class RetentionPlan:
+    """
+    The backups of the backup branch a retention policy keeps and drops, oldest first
+    """
+    def __init__(self, kept: List[dict], dropped: List[dict]):
+        self.kept = kept
+        self.dropped = dropped
+        self.estimated_bytes: Optional[int] = None
+
+def _bucket(t: float, every: int) -> int:
+    # buckets follow the local clock, so a daily bucket is a calendar day
+    return int((t - time.timezone) // every)
+
+def plan_retention(config, now: float = None) -> RetentionPlan:
+    """
+    Everything younger than `keep_all` is kept. An older backup falls under the first rule whose
+    `within` covers its age (0 covers any age) and only the latest backup of each `every` seconds is kept.
+    A backup older than every rule is dropped, the latest backup is always kept
+    """
+    if now is None:
+        now = time.time()
+    policy = config.retention
+    rules = sorted(policy['rules'], key=lambda r: r['within'] if r['within'] > 0 else float('inf'))
+    entries = get_index(config).entries
+    kept, dropped = [], []
+    seen = set()
+    # latest first, so the first backup seen in a bucket is the one kept.
+    # The backups kept anyway fill their bucket too, the choice does not change when they age
+    for i, ent in enumerate(reversed(entries)):
+        age = now - ent['time']
+        key = None
+        for n, rule in enumerate(rules):
+            if rule['within'] <= 0 or age <= rule['within']:
+                key = (n, _bucket(ent['time'], max(1, rule['every'])))
+                break
+        keep = i == 0 or age <= policy['keep_all'] or key is not None and key not in seen
+        if keep and key is not None:
+            seen.add(key)
+        (kept if keep else dropped).append(ent)
+    kept.reverse()
+    dropped.reverse()
+    return RetentionPlan(kept, dropped)
+
+def _rev_list_objects(config, revs: list, no_walk: bool = False) -> set:
+    args = ['--objects', '--stdin'] + (['--no-walk'] if no_walk else [])
+    ecode, out = run_git_cmd(config, 'rev-list', *args, input='\n'.join(revs).encode('utf-8') + b'\n')
+    if ecode != 0:
+        raise RuntimeError('rev-list error({0}): {1}'.format(ecode, out))
+    return {line.split(' ', 1)[0] for line in out.splitlines() if len(line) > 0}
+
+def _tracking_refs(config) -> list:
+    """
+    The remote-tracking refs of the backup branch, they keep the old history reachable until the next push
+    """
+    ecode, out = run_git_cmd(config, 'for-each-ref', '--format=%(refname)', 'refs/remotes/')
+    suffix = '/' + config.git_cfg['branch_name']
+    return [ref for ref in out.splitlines() if ref.endswith(suffix)] if ecode == 0 else []
+
+def _snapshot_refs(config) -> list:
+    ecode, out = run_git_cmd(config, 'for-each-ref', '--format=%(objectname) %(refname)', PRE_RESTORE_REF + '/')
+    return [tuple(line.split(' ', 1)) for line in out.splitlines()] if ecode == 0 else []
+
+def estimate_reclaim(config, plan: RetentionPlan) -> int:
+    """
+    The on-disk size of the objects only the dropped backups reach. Deltas are repacked
+    against other bases afterwards, so it is an estimate
+    """
+    branch = 'refs/heads/{}'.format(config.git_cfg['branch_name'])
+    old = _rev_list_objects(config, [branch] + _tracking_refs(config))
+    keep = _rev_list_objects(config, [ent['hash'] for ent in plan.kept] +
+                             [oid for oid, _ in _snapshot_refs(config)], no_walk=True)
+    dropped = old - keep
+    if len(dropped) == 0:
+        return 0
+    ecode, out = run_git_cmd(config, 'cat-file', '--batch-check=%(objectsize:disk)',
+                             input='\n'.join(dropped).encode('utf-8') + b'\n')
+    if ecode != 0:
+        raise RuntimeError('cat-file error({0}): {1}'.format(ecode, out))
+    return sum(int(line) for line in out.splitlines() if line.isdigit())
+
+def _write_commit(stdin, ref: str, commit, parent: Optional[str], mark: int = None):
+    oid, headers, message = commit
+    data = message.encode('utf-8')
+    stdin.write('commit {}\n'.format(ref).encode('utf-8'))
+    if mark is not None:
+        stdin.write(b'mark :%d\n' % mark)
+    if 'author' in headers:
+        stdin.write('author {}\n'.format(headers['author']).encode('utf-8'))
+    stdin.write('committer {}\n'.format(headers['committer']).encode('utf-8'))
+    stdin.write(b'data %d\n' % len(data))
+    stdin.write(data)
+    stdin.write(b'\n')
+    if parent is not None:
+        stdin.write('from {}\n'.format(parent).encode('utf-8'))
+    stdin.write(b'deleteall\n')
+    # an empty path is the root, the whole tree of the original commit
+    stdin.write('M 040000 {} ""\n'.format(headers['tree']).encode('utf-8'))
+    stdin.write(b'\n')
+
+def apply_retention(config, plan: RetentionPlan, logger=None) -> dict:
+    """
+    Rebuild the backup branch from the kept backups, each with its original tree, message and dates.
+    The pre-restore snapshots are moved onto the nearest kept ancestor of their parent and the
+    remote-tracking refs of the branch are deleted, so nothing reaches the dropped backups anymore.
+    Return `{old hash: new hash}` of the kept backups
+    """
+    if len(plan.dropped) == 0:
+        return {}
+    branch = 'refs/heads/{}'.format(config.git_cfg['branch_name'])
+    old_head = resolve_ref(config, branch)
+    entries = get_index(config).entries
+    marks = {ent['hash']: n + 1 for n, ent in enumerate(plan.kept)}
+    # the mark of the nearest kept backup at or before each backup of the old history
+    nearest = {}
+    mark = None
+    for ent in entries:
+        if ent['hash'] in marks:
+            mark = ':{}'.format(marks[ent['hash']])
+        nearest[ent['hash']] = mark
+
+    proc = subprocess.Popen(git_argv(config, 'fast-import', '--quiet', '--done', '--force'),
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    try:
+        stdin = proc.stdin
+        stdin.write('reset {}\n'.format(branch).encode('utf-8'))
+        parent = None
+        for ent in plan.kept:
+            _write_commit(stdin, branch, read_commit(config, ent['hash']), parent, mark=marks[ent['hash']])
+            parent = ':{}'.format(marks[ent['hash']])
+        for oid, ref in _snapshot_refs(config):
+            commit = read_commit(config, oid)
+            parent = nearest.get(commit[1].get('parent'))
+            stdin.write('reset {}\n'.format(ref).encode('utf-8'))
+            _write_commit(stdin, ref, commit, parent)
+        stdin.write(b'done\n')
+        stdin.close()
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    out = decode_output(proc.stdout.read())
+    ecode = proc.wait()
+    debug_message(config.debug, 'fast-import:', ecode, out)
+    if ecode != 0:
+        raise RuntimeError('git fast-import error({0}): {1}'.format(ecode, out))
+
+    ecode, out = run_git_cmd(config, 'rev-list', '--first-parent', '--reverse', branch)
+    new_hashes = out.split()
+    if ecode != 0 or len(new_hashes) != len(plan.kept):
+        raise RuntimeError('rewritten history does not match the kept backups: {}'.format(out))
+    mapping = {ent['hash']: new for ent, new in zip(plan.kept, new_hashes)}
+    for ref in _tracking_refs(config):
+        run_git_cmd(config, 'update-ref', '-d', ref)
+    rewrite_region_index(config, [ent['hash'] for ent in entries], mapping)
+    rewrite_index(config, mapping)
+    manifest = load_manifest(config)
+    if manifest.head == old_head:
+        manifest.head = mapping.get(old_head)
+        manifest.save()
+    log_info(logger, 'retention: kept {} backups, dropped {}'.format(len(plan.kept), len(plan.dropped)))
+    return mapping
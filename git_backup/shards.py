@@ -0,0 +1,132 @@
+import os
+import subprocess
+import time
+
+from typing import Optional
+from git_backup.backup_index import get_index, save_shard_entries, reload_sealed, record_backup
+from git_backup.constants import SHARD_REF
+from git_backup.git import git_argv, run_git_cmd, read_commit, resolve_ref, count_objects
+from git_backup.manifest import load_manifest
+from git_backup.sizes import invalidate_sizes
+from git_backup.utils import debug_message, decode_output, get_format_time, log_info
+
+def _pack_dir(config) -> str:
+    return os.path.join(config.backup_path, '.git', 'objects', 'pack')
+
+def list_shards(config) -> list:
+    """
+    Return `[(name, tip), ...]` of the sealed shards, oldest first
+    """
+    ecode, out = run_git_cmd(config, 'for-each-ref', '--sort=refname', '--format=%(objectname) %(refname)',
+                             SHARD_REF + '/')
+    if ecode != 0:
+        raise RuntimeError('for-each-ref error({0}): {1}'.format(ecode, out))
+    res = []
+    for line in out.splitlines():
+        oid, ref = line.split(' ', 1)
+        res.append((ref[len(SHARD_REF) + 1:], oid))
+    return res
+
+def active_size(config) -> int:
+    """
+    Bytes of the loose objects and the packs not kept by a sealed shard
+    """
+    size = count_objects(config).get('size', 0)
+    pack_dir = _pack_dir(config)
+    if os.path.isdir(pack_dir):
+        names = set(os.listdir(pack_dir))
+        for name in names:
+            if name.endswith('.pack') and name[:-len('.pack')] + '.keep' not in names:
+                size += os.path.getsize(os.path.join(pack_dir, name))
+    return size
+
+def rollover_due(config) -> Optional[str]:
+    """
+    Return why the active shard should be sealed now, or None
+    """
+    cfg = config.shard
+    if not cfg['enabled']:
+        return None
+    now = time.time()
+    if cfg['last_rollover_time'] <= 0:
+        # the period counts from when sharding was turned on
+        cfg['last_rollover_time'] = now
+    if cfg['period'] > 0 and now - cfg['last_rollover_time'] >= cfg['period']:
+        return 'period'
+    if cfg['max_size'] > 0 and active_size(config) >= cfg['max_size']:
+        return 'size'
+    return None
+
+def _commit_tree(config, ref: str, tree: str, message: str, parent: Optional[str]) -> str:
+    name, email = config.git_cfg['user_name'], config.git_cfg['user_email']
+    data = message.encode('utf-8')
+    stream = b''.join([
+        'reset {}\n'.format(ref).encode('utf-8'),
+        'commit {}\n'.format(ref).encode('utf-8'),
+        'committer {} <{}> {} {}\n'.format(name, email, int(time.time()), time.strftime('%z')).encode('utf-8'),
+        b'data %d\n' % len(data), data, b'\n',
+        b'' if parent is None else 'from {}\n'.format(parent).encode('utf-8'),
+        # an empty path is the root
+        'M 040000 {} ""\n\ndone\n'.format(tree).encode('utf-8'),
+    ])
+    proc = subprocess.run(git_argv(config, 'fast-import', '--quiet', '--done', '--force'), input=stream,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    debug_message(config.debug, 'fast-import:', proc.returncode, proc.stdout)
+    if proc.returncode != 0:
+        raise RuntimeError('git fast-import error({0}): {1}'.format(proc.returncode, decode_output(proc.stdout)))
+    return resolve_ref(config, ref)
+
+def seal_shard(config, logger=None) -> str:
+    """
+    Seal the history of the backup branch as a shard: record its tip under `SHARD_REF`, pack everything
+    into a pack marked `.keep` so later repacks and gc leave it alone, and write the commit-graph.
+    The branch restarts from a root commit with the tree of the latest backup
+    """
+    branch = 'refs/heads/{}'.format(config.git_cfg['branch_name'])
+    tip = resolve_ref(config, branch)
+    if tip is None:
+        raise RuntimeError('the backup branch has no commit')
+    name = time.strftime('%Y%m%d-%H%M%S')
+    entries = list(get_index(config).entries)
+
+    ecode, out = run_git_cmd(config, 'update-ref', '{}/{}'.format(SHARD_REF, name), tip)
+    if ecode != 0:
+        raise RuntimeError('update-ref error({0}): {1}'.format(ecode, out))
+    # -l, the objects borrowed from a shared store stay there
+    ecode, out = run_git_cmd(config, 'repack', '-a', '-d', '-l', '-q')
+    if ecode != 0:
+        raise RuntimeError('repack error({0}): {1}'.format(ecode, out))
+    pack_dir = _pack_dir(config)
+    names = set(os.listdir(pack_dir))
+    for pack in names:
+        keep = pack[:-len('.pack')] + '.keep'
+        if pack.endswith('.pack') and keep not in names:
+            with open(os.path.join(pack_dir, keep), 'w') as fd:
+                fd.write('GitBackUp shard {}\n'.format(name))
+    run_git_cmd(config, 'commit-graph', 'write', '--reachable')
+    save_shard_entries(config, name, entries)
+
+    tree = read_commit(config, tip)[1]['tree']
+    new_root = _commit_tree(config, branch, tree, '{}=Shard {} sealed'.format(get_format_time(), name), None)
+    manifest = load_manifest(config)
+    if manifest.head == tip:
+        manifest.head = new_root
+        manifest.save()
+    reload_sealed(config)
+    get_index(config)
+    invalidate_sizes()
+    config.shard['last_rollover_time'] = time.time()
+    log_info(logger, 'sealed shard {} at {}, {} backups'.format(name, tip[:10], len(entries)))
+    return name
+
+def graft_sealed(config, slot: str, comment: str) -> str:
+    """
+    Commit the tree of `slot` from a sealed shard on top of the backup branch, so restoring it
+    does not pull the sealed history back into the active shard
+    """
+    branch = 'refs/heads/{}'.format(config.git_cfg['branch_name'])
+    tree = read_commit(config, slot)[1]['tree']
+    oid = _commit_tree(config, branch, tree, '{}=Restored {} {}'.format(get_format_time(), slot[:10], comment),
+                       resolve_ref(config, branch))
+    record_backup(config)
+    return oid
@@ -0,0 +1,191 @@
+import os
+import re
+
+from typing import Optional
+from git_backup.git import run_git_cmd, count_objects
+from git_backup.sizes import invalidate_sizes
+from git_backup.utils import run_cmd, log_info, log_warning
+
+INSTANCE_REF = 'refs/instances'
+LOCK_FILE = 'gbk-consolidate.lock'
+# "<name>\t<repository>" of every instance that consolidated into the store
+INSTANCES_FILE = 'gbk-instances'
+
+def store_path(config) -> Optional[str]:
+    cfg = config.shared_store
+    if not cfg['enabled']:
+        return None
+    return os.path.abspath(os.path.expanduser(cfg['path']))
+
+def instance_name(config) -> str:
+    """
+    The name the refs of this instance get in the shared store, by default the directory name of `backup_path`
+    """
+    name = config.shared_store.get('instance') or os.path.basename(os.path.abspath(config.backup_path))
+    return re.sub(r'[^A-Za-z0-9._-]', '_', name)
+
+def _store_cmd(config, child: str, *args, input: bytes = None):
+    return run_cmd([config.git_path, '-C', store_path(config), '--no-pager', child, *args], config.debug, input=input)
+
+def _store_objects(config) -> dict:
+    """
+    `git count-objects -v` of the shared store, the sizes are in bytes
+    """
+    ecode, out = _store_cmd(config, 'count-objects', '-v')
+    if ecode != 0:
+        raise RuntimeError('count-objects error({0}): {1}'.format(ecode, out))
+    res = {}
+    for line in out.splitlines():
+        k, _, v = line.partition(':')
+        if v.strip().isdigit():
+            res[k.strip()] = int(v.strip())
+    for k in ('size', 'size-pack', 'size-garbage'):
+        res[k] = res.get(k, 0) * 1024
+    return res
+
+def _local_size(objects: dict) -> int:
+    return objects.get('size', 0) + objects.get('size-pack', 0)
+
+def setup_shared_store(config, logger=None):
+    """
+    Create the shared store (a bare repository) if it is missing and let the repository of `backup_path`
+    borrow its objects through `objects/info/alternates`
+    """
+    path = store_path(config)
+    if path is None:
+        return
+    if not os.path.isdir(path):
+        log_info(logger, 'git init --bare {}'.format(path))
+        ecode, out = run_cmd([config.git_path, 'init', '-q', '--bare', path], config.debug)
+        if ecode != 0:
+            raise RuntimeError('Init shared store error({0}): {1}'.format(ecode, out))
+        # an object some instance borrows must never be pruned by an automatic gc of the store
+        _store_cmd(config, 'config', 'gc.auto', '0')
+    objects = os.path.join(path, 'objects')
+    alternates = os.path.join(config.backup_path, '.git', 'objects', 'info', 'alternates')
+    lines = []
+    if os.path.isfile(alternates):
+        with open(alternates, 'r', encoding='utf-8') as fd:
+            lines = [line.strip() for line in fd if len(line.strip()) > 0]
+    if objects not in lines:
+        os.makedirs(os.path.dirname(alternates), exist_ok=True)
+        with open(alternates, 'w', encoding='utf-8') as fd:
+            fd.write('\n'.join(lines + [objects]) + '\n')
+        log_info(logger, 'borrowing objects from {}'.format(objects))
+
+def find_duplicates(config) -> dict:
+    """
+    Count the objects of the shared store reached by more than one instance and the bytes
+    their extra copies would take if every instance stored its own
+    """
+    ecode, out = _store_cmd(config, 'for-each-ref', '--format=%(objectname) %(refname)', INSTANCE_REF + '/')
+    if ecode != 0:
+        raise RuntimeError('for-each-ref error({0}): {1}'.format(ecode, out))
+    tips = {}
+    for line in out.splitlines():
+        oid, ref = line.split(' ', 1)
+        tips.setdefault(ref.split('/')[2], []).append(oid)
+    owners = {}
+    for oids in tips.values():
+        ecode, out = _store_cmd(config, 'rev-list', '--objects', '--no-object-names', '--stdin',
+                                input='\n'.join(oids).encode('utf-8') + b'\n')
+        if ecode != 0:
+            raise RuntimeError('rev-list error({0}): {1}'.format(ecode, out))
+        for oid in out.split():
+            owners[oid] = owners.get(oid, 0) + 1
+    shared = [oid for oid, n in owners.items() if n > 1]
+    saved = 0
+    if len(shared) > 0:
+        ecode, out = _store_cmd(config, 'cat-file', '--batch-check=%(objectsize:disk)',
+                                input='\n'.join(shared).encode('utf-8') + b'\n')
+        if ecode != 0:
+            raise RuntimeError('cat-file error({0}): {1}'.format(ecode, out))
+        for oid, size in zip(shared, out.splitlines()):
+            if size.isdigit():
+                saved += int(size) * (owners[oid] - 1)
+    return {'instances': len(tips), 'objects': len(owners), 'shared': len(shared), 'saved': saved}
+
+def _load_instances(path: str) -> dict:
+    res = {}
+    file = os.path.join(path, INSTANCES_FILE)
+    if os.path.isfile(file):
+        with open(file, 'r', encoding='utf-8') as fd:
+            for line in fd:
+                name, _, repo = line.rstrip('\n').partition('\t')
+                if len(name) > 0 and len(repo) > 0:
+                    res[name] = repo
+    return res
+
+def _register_instance(path: str, name: str, repo: str) -> dict:
+    instances = _load_instances(path)
+    if instances.get(name) != repo:
+        instances[name] = repo
+        tmp = os.path.join(path, INSTANCES_FILE + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as fd:
+            fd.writelines('{}\t{}\n'.format(k, v) for k, v in sorted(instances.items()))
+        os.replace(tmp, os.path.join(path, INSTANCES_FILE))
+    return instances
+
+def _fetch_instance(config, name: str, repo: str):
+    return _store_cmd(config, 'fetch', '-q', '--no-tags', '--prune', repo,
+                      '+refs/*:{}/{}/*'.format(INSTANCE_REF, name))
+
+def consolidate(config, logger=None) -> dict:
+    """
+    Move the objects of this instance into the shared store: every ref of the repository is fetched
+    under `refs/instances/<name>/` of the store, then this repository is repacked without the objects the store has.
+
+    The refs of the other instances that consolidated before are fetched again, so the store drops what
+    no instance reaches anymore. An unreachable object is only deleted once it is older than `prune_expire`:
+    an instance may have reused it since its last consolidate, and git refreshes the time of a borrowed
+    object it would otherwise have written. The refs of an instance whose repository is gone are kept,
+    its objects stay until those refs are deleted. The `.keep` packs of sealed shards stay as they are
+    """
+    path = store_path(config)
+    if path is None:
+        raise RuntimeError('shared_store is not enabled')
+    name = instance_name(config)
+    lock = os.path.join(path, LOCK_FILE)
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        raise RuntimeError('{} exists, another instance is consolidating'.format(lock))
+    try:
+        os.write(fd, name.encode('utf-8'))
+        os.close(fd)
+        local_before = _local_size(count_objects(config))
+        store_before = _local_size(_store_objects(config))
+        repo = os.path.abspath(config.backup_path)
+        ecode, out = _fetch_instance(config, name, repo)
+        if ecode != 0:
+            raise RuntimeError('fetch error({0}): {1}'.format(ecode, out))
+        for other, other_repo in _register_instance(path, name, repo).items():
+            if other == name or not os.path.isdir(os.path.join(other_repo, '.git')):
+                continue
+            ecode, out = _fetch_instance(config, other, other_repo)
+            if ecode != 0:
+                # its old refs stay, so do the objects they reach
+                log_warning(logger, 'can not fetch instance {} from {}: {}'.format(other, other_repo, out))
+        expire = config.shared_store.get('prune_expire', '2.weeks.ago')
+        if expire in ('', 'never'):
+            ecode, out = _store_cmd(config, 'repack', '-a', '-d', '-q', '--keep-unreachable')
+        else:
+            ecode, out = _store_cmd(config, 'repack', '-A', '-d', '-q', '--unpack-unreachable={}'.format(expire))
+        if ecode != 0:
+            raise RuntimeError('repack shared store error({0}): {1}'.format(ecode, out))
+        if expire not in ('', 'never'):
+            ecode, out = _store_cmd(config, 'prune', '--expire={}'.format(expire))
+            if ecode != 0:
+                raise RuntimeError('prune shared store error({0}): {1}'.format(ecode, out))
+        # -l leaves out every object found through the alternates
+        ecode, out = run_git_cmd(config, 'repack', '-a', '-d', '-l', '-q')
+        if ecode != 0:
+            raise RuntimeError('repack error({0}): {1}'.format(ecode, out))
+        invalidate_sizes()
+        res = find_duplicates(config)
+        res.update(local_before=local_before, local_after=_local_size(count_objects(config)),
+                   store_before=store_before, store=_local_size(_store_objects(config)))
+    finally:
+        os.remove(lock)
+    log_info(logger, 'consolidated {} into {}: {}'.format(name, path, res))
+    return res
@@ -0,0 +1,70 @@
+import os
+import json
+
+from threading import Lock
+from git_backup.git import count_objects
+from git_backup.utils import get_metadata_path
+
+SIZES_FILE = 'sizes.json'
+
+# {backup_path: {'worktree': size, 'store': size}}
+_cache = {}
+_cache_lock = Lock()
+
+def _sizes(config) -> dict:
+    return _cache.setdefault(os.path.abspath(config.backup_path), {})
+
+def _walk_worktree_size(config) -> int:
+    size = 0
+    for root, dirs, files in os.walk(config.backup_path):
+        if '.git' in dirs:
+            dirs.remove('.git')
+        size += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return size
+
+def _save(config):
+    with open(get_metadata_path(config, SIZES_FILE), 'w') as fd:
+        json.dump({'worktree': _sizes(config)['worktree']}, fd)
+
+def _load_worktree_size(config) -> int:
+    path = get_metadata_path(config, SIZES_FILE)
+    if os.path.isfile(path):
+        try:
+            with open(path, 'r') as fd:
+                return int(json.load(fd)['worktree'])
+        except (ValueError, KeyError, TypeError):
+            pass
+    _sizes(config)['worktree'] = _walk_worktree_size(config)
+    _save(config)
+    return _sizes(config)['worktree']
+
+def invalidate_sizes(worktree: bool = False):
+    """
+    Forget the object store sizes (and the working tree sizes) after a repository changed
+    """
+    with _cache_lock:
+        for sizes in _cache.values():
+            sizes.pop('store', None)
+            if worktree:
+                sizes.pop('worktree', None)
+
+def set_worktree_size(config, size: int):
+    """
+    Record the working tree size counted by the copy stage
+    """
+    with _cache_lock:
+        _sizes(config)['worktree'] = size
+        _save(config)
+
+def get_sizes(config):
+    """
+    Return `(working tree size, object store size)` of `backup_path` in bytes
+    """
+    with _cache_lock:
+        sizes = _sizes(config)
+        if 'worktree' not in sizes:
+            sizes['worktree'] = _load_worktree_size(config)
+        if 'store' not in sizes:
+            objects = count_objects(config)
+            sizes['store'] = objects['size'] + objects['size-pack'] + objects['size-garbage']
+        return sizes['worktree'], sizes['store']
@@ -0,0 +1,316 @@
+import os
+import errno
+import shutil
+import fnmatch
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Optional
+from git_backup.governor import bind, copy_rate, throttle_io
+from git_backup.manifest import Manifest
+from git_backup.region import is_region_file, patch_region
+from git_backup.utils import log_info, log_warning, remove_files
+
+COPY_BUFFER_SIZE = 1024 * 1024
+# _IOW(0x94, 9, int), share the extents of a file on btrfs, xfs and the like
+FICLONE = 0x40049409
+_clone_unsupported = set()
+
+def clone_file(src_path: str, dst_path: str) -> bool:
+    """
+    Make `dst_path` a reflink copy of `src_path`, which takes no time and no space until either is modified.
+    Return False if the file system (or the OS) can not, `dst_path` is left untouched then
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    dev = os.stat(os.path.dirname(os.path.abspath(dst_path))).st_dev
+    if dev in _clone_unsupported:
+        return False
+    tmp = dst_path + '.gbk-clone'
+    try:
+        with open(src_path, 'rb') as src, open(tmp, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError as e:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+            _clone_unsupported.add(dev)
+            return False
+        raise
+    shutil.copystat(src_path, tmp)
+    os.replace(tmp, dst_path)
+    return True
+
+class SyncStats:
+    def __init__(self):
+        self.files_total = 0
+        self.files_copied = 0
+        self.files_deleted = 0
+        self.bytes_total = 0
+        self.bytes_copied = 0
+        self.bytes_skipped = 0
+        self.regions_patched = 0
+        self.chunks_changed = 0
+        self.files_cloned = 0
+        self.start_time = time.time()
+        self.elapsed = 0.0
+        self.lock = Lock()
+
+    def add(self, **kwargs):
+        with self.lock:
+            for k, v in kwargs.items():
+                setattr(self, k, getattr(self, k) + v)
+
+    def finish(self):
+        self.elapsed = time.time() - self.start_time
+        return self
+
+    def throughput(self) -> str:
+        elapsed = max(self.elapsed, 1e-6)
+        return '{0:.1f} MB/s, {1:.1f} files/s'.format(
+            self.bytes_copied / 2 ** 20 / elapsed, self.files_copied / elapsed)
+
+    def __str__(self):
+        return ('files: {0} (copied {1}, deleted {2}), bytes copied: {3} / {4}, regions patched: {5} ({6} chunks), '
+                'took {7:.1f}s ({8})').format(
+            self.files_total, self.files_copied, self.files_deleted, self.bytes_copied, self.bytes_total,
+            self.regions_patched, self.chunks_changed, self.elapsed, self.throughput())
+
+class _SyncContext:
+    def __init__(self, ignores, manifest: Optional[Manifest], region_patch: bool, stats: SyncStats,
+                 split_size: int, reflink: bool = False):
+        self.ignores = ignores
+        self.manifest = manifest
+        self.region_patch = region_patch
+        self.stats = stats
+        self.split_size = split_size
+        self.reflink = reflink
+        self.entries = {}
+        self.tasks = []
+
+class _SplitCopy:
+    """
+    A large file copied as several ranges, the last finished range applies the file stat
+    """
+    def __init__(self, src_path: str, dst_path: str, size: int, split_size: int):
+        self.src_path = src_path
+        self.dst_path = dst_path
+        self.lock = Lock()
+        self.ranges = [(start, min(split_size, size - start)) for start in range(0, size, split_size)]
+        self.remaining = len(self.ranges)
+        with open(dst_path, 'wb') as fd:
+            fd.truncate(size)
+
+    def copy_range(self, start: int, length: int):
+        with open(self.src_path, 'rb') as src, open(self.dst_path, 'r+b') as dst:
+            src.seek(start)
+            dst.seek(start)
+            while length > 0:
+                buf = src.read(min(length, COPY_BUFFER_SIZE))
+                if len(buf) == 0:
+                    break
+                throttle_io(len(buf))
+                dst.write(buf)
+                length -= len(buf)
+        with self.lock:
+            self.remaining -= 1
+            done = self.remaining == 0
+        if done:
+            shutil.copystat(self.src_path, self.dst_path)
+
+def _is_ignored(name: str, ignores) -> bool:
+    return any(fnmatch.fnmatch(name, pattern) for pattern in ignores)
+
+def _walk_dir(path: str, rel: str, ignores):
+    with os.scandir(path) as it:
+        entries = [e for e in it if not _is_ignored(e.name, ignores)]
+    for e in entries:
+        if e.is_dir():
+            yield from _walk_dir(e.path, rel + '/' + e.name, ignores)
+        elif e.is_file():
+            yield rel + '/' + e.name, e.path, e.stat()
+
+def walk_files(root: str, basename: str, ignores=[]):
+    """
+    Yield `(rel, path, stat)` of every file under `root/basename`, following symbolic links
+    """
+    path = os.path.join(root, basename)
+    rel = basename.replace(os.sep, '/')
+    if os.path.isdir(path):
+        yield from _walk_dir(path, rel, ignores)
+    elif os.path.isfile(path):
+        yield rel, path, os.stat(path)
+
+def _remove_entry(entry: os.DirEntry, stats: SyncStats):
+    if entry.is_dir(follow_symlinks=False):
+        for _, _, files in os.walk(entry.path):
+            stats.files_deleted += len(files)
+        shutil.rmtree(entry.path)
+    else:
+        os.unlink(entry.path)
+        stats.files_deleted += 1
+
+def _sync_dir(src_dir: str, dst_dir: str, rel: str, ctx: _SyncContext):
+    if os.path.islink(dst_dir) or os.path.isfile(dst_dir):
+        os.unlink(dst_dir)
+    if not os.path.isdir(dst_dir):
+        os.makedirs(dst_dir)
+
+    src_entries = {}
+    with os.scandir(src_dir) as it:
+        for e in it:
+            if not _is_ignored(e.name, ctx.ignores) and (e.is_dir() or e.is_file()):
+                src_entries[e.name] = e
+    dst_entries = {}
+    with os.scandir(dst_dir) as it:
+        for e in it:
+            src = src_entries.get(e.name)
+            # symbolic links are followed while copying, so the mirror never contains one
+            if src is None or e.is_symlink() or e.is_dir() != src.is_dir():
+                _remove_entry(e, ctx.stats)
+            else:
+                dst_entries[e.name] = e
+
+    for name, src in src_entries.items():
+        src_rel = rel + '/' + name
+        dst = dst_entries.get(name)
+        dst_path = os.path.join(dst_dir, name)
+        if src.is_dir():
+            _sync_dir(src.path, dst_path, src_rel, ctx)
+        elif src.is_file():
+            _sync_file(src.path, dst_path, src_rel, src.stat(), dst is not None, ctx)
+
+def _sync_file(src_path: str, dst_path: str, rel: str, st: os.stat_result, dst_exists: bool,
+               ctx: _SyncContext):
+    stats = ctx.stats
+    stats.files_total += 1
+    stats.bytes_total += st.st_size
+    ctx.entries[rel] = [st.st_size, st.st_mtime_ns]
+    if dst_exists:
+        if ctx.manifest is not None and ctx.manifest.match(rel, st):
+            return
+        dst_st = os.stat(dst_path)
+        if dst_st.st_size == st.st_size and dst_st.st_mtime_ns == st.st_mtime_ns:
+            return
+    if ctx.reflink:
+        # a reflink beats patching and splitting, only the files it fails for are copied
+        ctx.tasks.append((_clone_task, (src_path, dst_path, rel, st, dst_exists, ctx)))
+        return
+    ctx.tasks.extend(_copy_tasks(src_path, dst_path, rel, st, dst_exists, ctx))
+
+def _copy_tasks(src_path: str, dst_path: str, rel: str, st: os.stat_result, dst_exists: bool,
+                ctx: _SyncContext) -> list:
+    stats = ctx.stats
+    if dst_exists and ctx.region_patch and is_region_file(rel):
+        return [(_patch_task, (src_path, dst_path, st.st_size, stats))]
+    if 0 < ctx.split_size < st.st_size:
+        split = _SplitCopy(src_path, dst_path, st.st_size, ctx.split_size)
+        stats.add(files_copied=1, bytes_copied=st.st_size)
+        return [(split.copy_range, (start, length)) for start, length in split.ranges]
+    return [(_copy_task, (src_path, dst_path, st.st_size, stats))]
+
+def _clone_task(src_path: str, dst_path: str, rel: str, st: os.stat_result, dst_exists: bool,
+                ctx: _SyncContext):
+    if clone_file(src_path, dst_path):
+        ctx.stats.add(files_copied=1, files_cloned=1, bytes_copied=st.st_size)
+        return
+    for func, args in _copy_tasks(src_path, dst_path, rel, st, dst_exists, ctx):
+        func(*args)
+
+def _copy_task(src_path: str, dst_path: str, size: int, stats: SyncStats):
+    if copy_rate() > 0:
+        with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+            while True:
+                buf = src.read(COPY_BUFFER_SIZE)
+                if len(buf) == 0:
+                    break
+                throttle_io(len(buf))
+                dst.write(buf)
+        shutil.copystat(src_path, dst_path)
+    else:
+        # copy2 keeps the mtime, so the next sync and git's stat cache both see it as unchanged
+        shutil.copy2(src_path, dst_path)
+    stats.add(files_copied=1, bytes_copied=size)
+
+def _patch_task(src_path: str, dst_path: str, size: int, stats: SyncStats):
+    res = patch_region(src_path, dst_path)
+    if res is None:
+        _copy_task(src_path, dst_path, size, stats)
+    else:
+        # the chunks are already written, the limit holds on average
+        throttle_io(res[1])
+        stats.add(files_copied=1, regions_patched=1, chunks_changed=res[0], bytes_copied=res[1])
+
+def _run_tasks(tasks, threads: int):
+    if threads <= 1 or len(tasks) <= 1:
+        for func, args in tasks:
+            func(*args)
+        return
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='GBU-copy') as pool:
+        # the workers are new threads, they only run at full speed when the caller does
+        futures = [pool.submit(bind(func), *args) for func, args in tasks]
+        for f in futures:
+            f.result()
+
+def sync_files(src: str, dst: str, basename: str, ignores=[], manifest: Optional[Manifest] = None,
+               region_patch: bool = False, threads: int = 1, split_size: int = 0,
+               stats: Optional[SyncStats] = None, reflink: bool = False, logger=None) -> SyncStats:
+    """
+    Mirror `src/basename` into `dst/basename`, only copying the files whose size or mtime changed
+    and only deleting the files which vanished from `src`.
+    With `reflink`, changed files are cloned where the file system supports it.
+    With `region_patch`, changed region files only get their changed chunks written.
+    The copies are spread over `threads` workers, files larger than `split_size` are copied in ranges
+    """
+    if stats is None:
+        stats = SyncStats()
+    ctx = _SyncContext(ignores, manifest, region_patch, stats, split_size, reflink=reflink)
+    src_path = os.path.join(src, basename)
+    dst_path = os.path.join(dst, basename)
+    rel = basename.replace(os.sep, '/')
+
+    while os.path.islink(src_path):
+        link_path = os.readlink(src_path)
+        if not os.path.islink(dst_path) or os.readlink(dst_path) != link_path:
+            log_info(logger, 'syncing {} -> {} (symbolic link)'.format(src_path, dst_path))
+            if os.path.lexists(dst_path):
+                remove_files(dst, os.path.relpath(dst_path, dst), logger=logger)
+            dst_dir = os.path.dirname(dst_path)
+            if not os.path.isdir(dst_dir):
+                os.makedirs(dst_dir)
+            os.symlink(link_path, dst_path)
+        src_path = link_path if os.path.isabs(link_path) else os.path.normpath(os.path.join(os.path.dirname(src_path), link_path))
+        dst_path = os.path.join(dst, os.path.relpath(src_path, src))
+
+    log_info(logger, 'syncing {} -> {}'.format(src_path, dst_path))
+    if os.path.isdir(src_path):
+        _sync_dir(src_path, dst_path, rel, ctx)
+    elif os.path.isfile(src_path):
+        dst_dir = os.path.dirname(dst_path)
+        if not os.path.isdir(dst_dir):
+            os.makedirs(dst_dir)
+        if os.path.isdir(dst_path) and not os.path.islink(dst_path):
+            shutil.rmtree(dst_path)
+        dst_exists = os.path.isfile(dst_path) and not os.path.islink(dst_path)
+        _sync_file(src_path, dst_path, rel, os.stat(src_path), dst_exists, ctx)
+    else:
+        log_warning(logger, '{} does not exist while syncing ({} -> {})'.format(src_path, src_path, dst_path))
+        if os.path.lexists(dst_path):
+            remove_files(dst, os.path.relpath(dst_path, dst), logger=logger)
+    _run_tasks(ctx.tasks, threads)
+    if manifest is not None:
+        manifest.update_prefix(rel, ctx.entries)
+    return stats
+
+def copy_files(src: str, dst: str, basename: str, ignores=[], threads: int = 1, split_size: int = 0,
+               stats: Optional[SyncStats] = None, logger=None) -> SyncStats:
+    """
+    Replace `dst/basename` with a full copy of `src/basename`
+    """
+    if os.path.lexists(os.path.join(dst, basename)):
+        remove_files(dst, basename, logger=logger)
+    return sync_files(src, dst, basename, ignores, threads=threads, split_size=split_size,
+                      stats=stats, logger=logger)
@@ -0,0 +1,70 @@
+"""
+Relay stdin to a command with a byte rate limit, stdout and stderr are passed through.
+
+This file only uses the standard library, it is copied into the repository and git runs it around
+the transport of a push: `python throttle.py <bytes per second> <command> [<args>...]`
+"""
+import os
+import subprocess
+import sys
+import threading
+import time
+
+BLOCK_SIZE = 16 * 1024
+
+class TokenBucket:
+    """
+    Allow `rate` bytes per second on average, with bursts of at most one second worth
+    """
+    def __init__(self, rate: int):
+        self.rate = rate
+        self.tokens = 0.0
+        self.last = time.monotonic()
+
+    def consume(self, size: int):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        self.tokens = min(float(self.rate), self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= size
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+
+def _copy(rate: int, proc: subprocess.Popen):
+    bucket = TokenBucket(rate)
+    stdin = sys.stdin.buffer
+    try:
+        while True:
+            buf = stdin.read1(BLOCK_SIZE)
+            if len(buf) == 0:
+                break
+            bucket.consume(len(buf))
+            proc.stdin.write(buf)
+            proc.stdin.flush()
+    except (BrokenPipeError, ValueError):
+        pass
+    finally:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+
+def relay(rate: int, argv: list) -> int:
+    proc = subprocess.Popen(argv, stdin=subprocess.PIPE)
+    threading.Thread(target=_copy, args=(rate, proc), daemon=True).start()
+    # the other end waits for the output of the command, which ends only when this process exits too
+    return proc.wait()
+
+def main(argv: list) -> int:
+    if len(argv) < 2:
+        sys.stderr.write('usage: throttle.py <bytes per second> <command> [<args>...]\n')
+        return 2
+    # git runs this through the shell, the wrapped command and the transport arguments are already split
+    return relay(int(argv[0]), argv[1:])
+
+if __name__ == '__main__':
+    code = main(sys.argv[1:])
+    sys.stdout.flush()
+    # do not wait for the copy thread blocked on stdin
+    os._exit(code)
@@ -0,0 +1,126 @@
+import os
+import json
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+from git_backup.utils import get_metadata_path
+
+TIMING_FILE = 'timing.jsonl'
+
+_history = deque(maxlen=200)
+_history_lock = Lock()
+# the records in the timing file, it is cut down to the ring buffer once it holds twice as many
+_file_records = 0
+
+class OperationTimer:
+    """
+    Wall time of each phase of one operation, plus the bytes and files it touched
+    """
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.start_time = time.time()
+        self.phases = {}
+        self.bytes = 0
+        self.files = 0
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.time() - start)
+
+    def add_phase(self, name: str, duration: float):
+        self.phases[name] = self.phases.get(name, 0.0) + duration
+
+    def add_io(self, bytes_: int = 0, files: int = 0):
+        self.bytes += bytes_
+        self.files += files
+
+    def to_record(self, success: bool) -> dict:
+        return {
+            'operation': self.operation,
+            'time': self.start_time,
+            'total': time.time() - self.start_time,
+            'success': success,
+            'phases': self.phases,
+            'bytes': self.bytes,
+            'files': self.files,
+        }
+
+def _compact(path: str):
+    global _file_records
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fd:
+        for record in _history:
+            fd.write(json.dumps(record, separators=(',', ':')) + '\n')
+    os.replace(tmp, path)
+    _file_records = len(_history)
+
+def load_history(config):
+    """
+    Fill the ring buffer with the tail of the timing file, dropping the older records from the file
+    """
+    global _history, _file_records
+    path = get_metadata_path(config, TIMING_FILE)
+    with _history_lock:
+        _history = deque(maxlen=max(1, config.timing_history_size))
+        _file_records = 0
+        if not os.path.isfile(path):
+            return
+        with open(path, 'r') as fd:
+            for line in fd:
+                _file_records += 1
+                try:
+                    _history.append(json.loads(line))
+                except ValueError:
+                    continue
+        if _file_records > _history.maxlen:
+            _compact(path)
+
+def record_operation(config, timer: OperationTimer, success: bool = True):
+    global _file_records
+    record = timer.to_record(success)
+    path = get_metadata_path(config, TIMING_FILE)
+    with _history_lock:
+        _history.append(record)
+        with open(path, 'a') as fd:
+            fd.write(json.dumps(record, separators=(',', ':')) + '\n')
+        _file_records += 1
+        if _file_records > 2 * _history.maxlen:
+            _compact(path)
+    return record
+
+def get_history(operation: str = None) -> list:
+    with _history_lock:
+        return [r for r in _history if operation is None or r['operation'] == operation]
+
+def _percentile(values: list, pct: float) -> float:
+    values = sorted(values)
+    idx = max(0, min(len(values) - 1, int(round(pct / 100 * len(values) + 0.5)) - 1))
+    return values[idx]
+
+def summarize(operation: str = None) -> dict:
+    """
+    Return `{operation: {'count': n, 'phases': {phase: (p50, p95)}, 'bytes': p50, 'files': p50}}`
+    of the successful operations in the ring buffer
+    """
+    with _history_lock:
+        records = [r for r in _history if r['success'] and (operation is None or r['operation'] == operation)]
+    res = {}
+    for op in dict.fromkeys(r['operation'] for r in records):
+        ops = [r for r in records if r['operation'] == op]
+        phases = {}
+        for r in ops:
+            for name, dur in list(r['phases'].items()) + [('total', r['total'])]:
+                phases.setdefault(name, []).append(dur)
+        res[op] = {
+            'count': len(ops),
+            'phases': {name: (_percentile(v, 50), _percentile(v, 95)) for name, v in phases.items()},
+            'bytes': _percentile([r['bytes'] for r in ops], 50),
+            'files': _percentile([r['files'] for r in ops], 50),
+        }
+    return res
@@ -0,0 +1,108 @@
+import time
+
+import pytest
+
+pytest.importorskip('mcdreforged')
+
+from benchmark.stub import StubServer, StubSource, install, logger
+from benchmark.runner import make_config
+from benchmark.world import WorldSpec, generate_world, mutate_world
+from git_backup import common as GL
+from git_backup.backup_index import get_index
+from git_backup.constants import PRE_RESTORE_REF
+from git_backup.git import setup_git, run_git_cmd, read_commit, close_cat_files
+from git_backup.ops import create_backup, restore_backup, prune_backup, get_backup_info, list_snapshots
+from git_backup.region_index import REGION_INDEX_FILE, RegionIndex
+from git_backup.retention import plan_retention
+from git_backup.utils import get_metadata_path
+
+DAY = 60 * 60 * 24
+WEEK = 7 * DAY
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    server = StubServer()
+    install(server)
+    GL.plugin_unloaded = False
+    config = make_config(str(tmp_path), {
+        'git_cfg': {'use_remote': False},
+        'retention': {'enabled': True, 'keep_all': DAY, 'rules': [{'every': WEEK, 'within': 0}]},
+    })
+    GL.config = config
+    spec = WorldSpec(regions=4, players=2, dimensions=1)
+    generate_world(config.server_path, spec)
+    setup_git(config, logger=logger)
+    # the start of a weekly retention bucket a few weeks ago, backups are placed around it
+    start = ((int(time.time()) - time.timezone) // WEEK - 4) * WEEK + time.timezone
+
+    def backup(offset: int, comment: str):
+        # the index takes the backup time from the committer date
+        date = '@{} +0000'.format(start + offset)
+        monkeypatch.setenv('GIT_COMMITTER_DATE', date)
+        monkeypatch.setenv('GIT_AUTHOR_DATE', date)
+        mutate_world(config.server_path, spec, 'scatter', offset)
+        create_backup(StubSource(server), comment, config, logger=logger)
+        monkeypatch.delenv('GIT_COMMITTER_DATE')
+        monkeypatch.delenv('GIT_AUTHOR_DATE')
+
+    yield config, server, backup
+    close_cat_files()
+
+def _git(config, *args) -> str:
+    ecode, out = run_git_cmd(config, *args)
+    assert ecode == 0, out
+    return out.strip()
+
+def test_prune_applies_retention(repo):
+    config, server, backup = repo
+    backup(-DAY, 'a')
+    backup(DAY, 'b')
+    backup(2 * DAY, 'c')
+    # restoring the latest backup records the world as a pre-restore snapshot on top of "c"
+    restore_backup(StubSource(server), get_backup_info(config, 1), config, logger=logger)
+    backup(3 * DAY, 'd')
+    backup(4 * WEEK, 'new')
+
+    plan = plan_retention(config)
+    # only the latest backup of the week of "b", "c" and "d" is kept
+    assert [ent['comment'] for ent in plan.dropped] == ['b', 'c']
+    trees = {ent['hash']: read_commit(config, ent['hash'])[1]['tree'] for ent in get_index(config).entries}
+    comments = [ent['comment'] for ent in plan.kept]
+    regions = RegionIndex(get_metadata_path(config, REGION_INDEX_FILE)).load().commits
+    by_comment = {ent['comment']: regions[ent['hash']]['regions'] for ent in get_index(config).entries
+                  if ent['hash'] in regions}
+    assert {'a', 'b', 'c', 'd', 'new'} <= set(by_comment)
+
+    source = StubSource(server)
+    prune_backup(source, config, logger=logger)
+    assert not any('prune_backup.fail' in reply for reply in source.replies)
+
+    entries = get_index(config).entries
+    assert [ent['comment'] for ent in entries] == comments
+    branch = 'refs/heads/{}'.format(config.git_cfg['branch_name'])
+    assert _git(config, 'rev-list', '--first-parent', '--reverse', branch).split() == [ent['hash'] for ent in entries]
+    for old, ent in zip(plan.kept, entries):
+        assert read_commit(config, ent['hash'])[1]['tree'] == trees[old['hash']]
+    for ent in plan.dropped:
+        assert run_git_cmd(config, 'cat-file', '-e', ent['hash'] + '^{commit}')[0] != 0
+
+    snapshots = list_snapshots(config)
+    assert len(snapshots) == 1 and snapshots[0][1].startswith(PRE_RESTORE_REF + '/')
+    # moved onto "a", the nearest kept backup before "c"
+    assert read_commit(config, snapshots[0][0])[1]['parent'] == entries[comments.index('a')]['hash']
+
+    # the records follow the new hashes, "d" also holds the changes of "b" and "c"
+    regions = RegionIndex(get_metadata_path(config, REGION_INDEX_FILE)).load().commits
+    assert set(regions) <= {ent['hash'] for ent in entries}
+    for ent in entries:
+        if ent['comment'] in ('a', 'new'):
+            assert regions[ent['hash']]['regions'] == by_comment[ent['comment']]
+        elif ent['comment'] == 'd':
+            merged = {}
+            for comment in ('b', 'c', 'd'):
+                for rel, chunks in by_comment[comment].items():
+                    merged[rel] = None if chunks is None or merged.get(rel, []) is None \
+                        else sorted(set(merged.get(rel, [])) | set(chunks))
+            assert regions[ent['hash']]['regions'] == merged
+
+    _git(config, 'fsck', '--strict', '--no-dangling')